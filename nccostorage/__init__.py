@@ -1,14 +1,23 @@
+import concurrent.futures
 import logging
 import sys
 
 from aiohttp import web, web_exceptions
 from prometheus_async import aio
 
-from nccostorage import api, middleware
-from nccostorage.bucket import BucketOperations, DictionaryBucketStorage
+from nccostorage import api, jsoncodec, middleware, workers
+from nccostorage.admission import DEFAULT_INTERVAL, DEFAULT_MAX_QUEUE, DEFAULT_TARGET_WAIT, AdmissionController
+from nccostorage.bucket import BucketOperations, DictionaryBucketStorage, NccoCodec, Quotas
+from nccostorage.bucket.codec import DEFAULT_COMPRESSION_THRESHOLD
 from nccostorage.bucket.instrumentation import InstrumentedBucketStorage
-from nccostorage.renderer import Jinja2NccoRenderer
-from nccostorage.renderer.instrumentation import InstrumentedRenderer
+from nccostorage.bucket.persistence import PersistentBucketStorage
+from nccostorage.compression import DEFAULT_MIN_SIZE, DEFAULT_VARIANT_CACHE_BYTES, ResponseCompressor, VariantCache
+from nccostorage.renderer import (DEFAULT_INLINE_COMPLEXITY, DEFAULT_MAX_ITERATIONS, DEFAULT_MAX_OUTPUT_BYTES,
+                                  DEFAULT_MAX_RENDER_TIME, DEFAULT_RENDER_CACHE_TTL, DEFAULT_RENDER_TIMEOUT,
+                                  DEFAULT_TEMPLATE_CACHE_SIZE, CachingNccoRenderer, Jinja2NccoRenderer,
+                                  PooledNccoRenderer, RenderCache, SandboxedNccoRenderer, TemplateCache)
+from nccostorage.renderer.instrumentation import (InstrumentedExecutor, InstrumentedRenderCache, InstrumentedRenderer,
+                                                  InstrumentedTemplateCache)
 
 
 def configure_logging():
@@ -27,9 +36,7 @@ def configure_logging():
     logger.addHandler(handler)
 
 
-def setup_middlewares(app):
-    import json
-
+def setup_middlewares(app, compressor=None, admission_controller=None):
     def handle_json_error(_ex):
         err = api.error.ApiError(status=400, text='request body must be json')
         return api.error.to_response(err)
@@ -39,30 +46,164 @@ def setup_middlewares(app):
         return api.error.to_response(err)
 
     error_middleware = middleware.create_error_handler({
-        json.decoder.JSONDecodeError: handle_json_error,
+        jsoncodec.JSONDecodeError: handle_json_error,
         api.error.ApiError: api.error.to_response,
         web_exceptions.HTTPError: handle_web_error,
     })
 
+    # metrics go first, so they time the error handler too and see its statuses
+    app.middlewares.append(middleware.create_metrics_handler())
+    if admission_controller is not None:
+        app.middlewares.append(middleware.create_admission_handler(admission_controller))
+    if compressor is not None:
+        # outside the error handler, so error bodies get compressed as well
+        app.middlewares.append(middleware.create_compression_handler(compressor))
     app.middlewares.append(error_middleware)
 
 
+def create_storage(storage_config):
+    backend = storage_config.get('backend', 'memory')
+
+    if backend == 'memory':
+        storage = DictionaryBucketStorage(quotas=Quotas(max_buckets=storage_config.get('max_buckets'),
+                                                        max_nccos_per_bucket=storage_config.get('max_nccos_per_bucket'),
+                                                        max_ncco_bytes=storage_config.get('max_ncco_bytes'),
+                                                        max_total_bytes=storage_config.get('max_total_bytes')),
+                                          memory_budget=storage_config.get('memory_budget'),
+                                          eviction_policy=storage_config.get('eviction_policy', 'expiry'))
+        if storage_config.get('directory') is not None:
+            storage = PersistentBucketStorage(storage, storage_config['directory'])
+        return storage
+    elif backend == 'redis':
+        # redis is an optional dependency, only needed for this backend
+        from nccostorage.bucket.redis_storage import DEFAULT_MAX_CONNECTIONS, RedisBucketStorage
+
+        return RedisBucketStorage.from_url(storage_config['url'],
+                                           max_connections=storage_config.get('max_connections', DEFAULT_MAX_CONNECTIONS))
+    elif backend == 'remote':
+        from nccostorage.bucket.remote import DEFAULT_POOL_SIZE, RemoteBucketStorage
+
+        return RemoteBucketStorage(storage_config['socket'], pool_size=storage_config.get('pool_size', DEFAULT_POOL_SIZE))
+    else:
+        raise ValueError(f'unknown storage backend {backend}')
+
+
+def create_renderer(renderer_config):
+    """
+    Returns the renderer and the executor it renders on, if any.
+    """
+    template_cache_size = renderer_config.get('template_cache_size', DEFAULT_TEMPLATE_CACHE_SIZE)
+    template_cache = InstrumentedTemplateCache(TemplateCache(max_size=template_cache_size))
+    if renderer_config.get('sandbox', False):
+        renderer = SandboxedNccoRenderer(template_cache=template_cache,
+                                         max_iterations=renderer_config.get('max_iterations', DEFAULT_MAX_ITERATIONS),
+                                         max_output_bytes=renderer_config.get('max_output_bytes', DEFAULT_MAX_OUTPUT_BYTES),
+                                         max_render_time=renderer_config.get('max_render_time', DEFAULT_MAX_RENDER_TIME))
+    else:
+        renderer = Jinja2NccoRenderer(template_cache=template_cache)
+
+    executor = None
+    pool = renderer_config.get('pool')
+    if pool is not None:
+        pool_size = renderer_config.get('pool_size')
+        if pool == 'thread':
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=pool_size)
+        elif pool == 'process':
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=pool_size)
+        else:
+            raise ValueError(f'unknown render pool {pool}')
+
+        renderer = PooledNccoRenderer(renderer, InstrumentedExecutor(executor),
+                                      inline_complexity=renderer_config.get('inline_complexity', DEFAULT_INLINE_COMPLEXITY),
+                                      timeout=renderer_config.get('timeout', DEFAULT_RENDER_TIMEOUT),
+                                      isolated=pool == 'process')
+
+    render_cache_bytes = renderer_config.get('render_cache_bytes', 0)
+    if render_cache_bytes > 0:
+        render_cache = RenderCache(max_bytes=render_cache_bytes,
+                                   ttl=renderer_config.get('render_cache_ttl', DEFAULT_RENDER_CACHE_TTL))
+        renderer = CachingNccoRenderer(renderer, InstrumentedRenderCache(render_cache))
+
+    return InstrumentedRenderer(renderer, sample_rate=renderer_config.get('latency_sample_rate', 1.0)), executor
+
+
+def create_compressor(server_config):
+    """
+    Returns the response compressor, or None if responses are sent as they are.
+    """
+    if not server_config.get('compression', True):
+        return None
+
+    variant_cache_bytes = server_config.get('compression_cache_bytes', DEFAULT_VARIANT_CACHE_BYTES)
+    return ResponseCompressor(min_size=server_config.get('compression_min_size', DEFAULT_MIN_SIZE),
+                              cache=VariantCache(max_bytes=variant_cache_bytes) if variant_cache_bytes > 0 else None)
+
+
+def create_admission_controller(server_config):
+    """
+    Returns the admission controller, or None if every request is let in.
+
+    It's opt-in: it can only see requests waiting on the app, and with the
+    in-memory storage they mostly wait before they reach it.
+    """
+    max_in_flight = server_config.get('max_in_flight', 0)
+    if max_in_flight <= 0:
+        return None
+
+    return AdmissionController(max_in_flight=max_in_flight,
+                               target=server_config.get('admission_target_wait', DEFAULT_TARGET_WAIT),
+                               interval=server_config.get('admission_interval', DEFAULT_INTERVAL),
+                               max_queue=server_config.get('admission_max_queue', DEFAULT_MAX_QUEUE))
+
+
 def create_app(config):
     configure_logging()
 
     app = web.Application()
 
-    storage = InstrumentedBucketStorage(DictionaryBucketStorage())
-    buckets = BucketOperations(storage)
-    ncco_renderer = InstrumentedRenderer(Jinja2NccoRenderer())
+    storage_config = config.get('storage', {})
+    storage = create_storage(storage_config)
+    if storage_config.get('backend') != 'remote':
+        # remote storage is instrumented by the process that owns it
+        storage = InstrumentedBucketStorage(storage, read_sample_rate=storage_config.get('latency_sample_rate', 1.0))
+    codec = NccoCodec(compression=storage_config.get('compression'),
+                      threshold=storage_config.get('compression_threshold', DEFAULT_COMPRESSION_THRESHOLD))
+    buckets = BucketOperations(storage, codec)
+    ncco_renderer, render_executor = create_renderer(config.get('renderer', {}))
+
+    # expired and evicted nccos will never be rendered again
+    def invalidate_renders(_name, ncco_data):
+        ncco_renderer.invalidate(codec.decode_all(ncco_data).values())
+
+    storage.add_expiry_listener(invalidate_renders)
+    storage.add_eviction_listener(invalidate_renders)
+
+    async def open_storage(_app):
+        await storage.open()
+
+    async def close_storage(_app):
+        await storage.close()
+
+    app.on_startup.append(open_storage)
+    app.on_cleanup.append(close_storage)
+
+    if render_executor is not None:
+        async def shutdown_render_executor(_app):
+            render_executor.shutdown(wait=False)
+
+        app.on_cleanup.append(shutdown_render_executor)
 
     # bucket operations
     api.bucket.setup_routes(app, buckets)
     # ncco operations
     api.ncco.setup_routes(app, buckets, ncco_renderer)
 
-    app.router.add_get('/metrics', aio.web.server_stats)
+    if workers.is_multiprocess():
+        app.router.add_get('/metrics', workers.multiprocess_stats)
+    else:
+        app.router.add_get('/metrics', aio.web.server_stats)
 
-    setup_middlewares(app)
+    server_config = config.get('server', {})
+    setup_middlewares(app, create_compressor(server_config), create_admission_controller(server_config))
 
     return app
@@ -0,0 +1,104 @@
+"""
+Admission control: caps the requests handled at once and sheds the rest under overload.
+
+Requests over the cap queue by priority, so renders, which are on the
+critical path of live calls, go ahead of reads and reads ahead of writes.
+The queue is managed with CoDel: as long as queued requests got a slot
+within target at least once per interval, the queue is only absorbing a
+burst and requests wait up to interval. Once the wait has stayed over
+target for a whole interval the queue is standing, so requests only wait
+up to target and writes are rejected right away, failing fast rather than
+piling up past their callers' timeouts.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+
+PRIORITY_RENDER = 0
+PRIORITY_READ = 1
+PRIORITY_WRITE = 2
+
+DEFAULT_MAX_IN_FLIGHT = 128
+DEFAULT_TARGET_WAIT = 0.005
+DEFAULT_INTERVAL = 0.1
+DEFAULT_MAX_QUEUE = 1024
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class AdmissionController(object):
+
+    def __init__(self, max_in_flight=DEFAULT_MAX_IN_FLIGHT, target=DEFAULT_TARGET_WAIT, interval=DEFAULT_INTERVAL,
+                 max_queue=DEFAULT_MAX_QUEUE, clock=time.monotonic):
+        self.max_in_flight = max_in_flight
+        self.target = target
+        self.interval = interval
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.queued = 0
+        self.overloaded = False
+        self._clock = clock
+        # heap of (priority, arrival order, future), futures of requests that gave up are left in until popped
+        self._queue = []
+        self._arrivals = itertools.count()
+        self._interval_end = None
+        self._min_wait = None
+
+    async def acquire(self, priority):
+        """
+        Waits for a slot and returns the time spent waiting.
+
+        Raises AdmissionRejected if the request is shed, in which case release
+        must not be called.
+        """
+        if self.in_flight < self.max_in_flight and not self._queue:
+            self.in_flight += 1
+            self._record_wait(0.0)
+            return 0.0
+
+        if self.queued >= self.max_queue or (self.overloaded and priority >= PRIORITY_WRITE):
+            raise AdmissionRejected()
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._arrivals), future))
+
+        start = self._clock()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(future, self.target if self.overloaded else self.interval)
+        except asyncio.TimeoutError:
+            self._record_wait(self._clock() - start)
+            raise AdmissionRejected()
+        except BaseException:
+            # cancelled after being handed a slot, pass it on
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+        finally:
+            self.queued -= 1
+
+        wait = self._clock() - start
+        self._record_wait(wait)
+        return wait
+
+    def release(self):
+        # the slot goes straight to the next waiter, so in_flight stays as is
+        while self._queue:
+            _, _, future = heapq.heappop(self._queue)
+            if not future.done():
+                future.set_result(None)
+                return
+
+        self.in_flight -= 1
+
+    def _record_wait(self, wait):
+        now = self._clock()
+        if self._interval_end is None or now >= self._interval_end:
+            self.overloaded = self._min_wait is not None and self._min_wait > self.target
+            self._min_wait = wait
+            self._interval_end = now + self.interval
+        else:
+            self._min_wait = min(self._min_wait, wait)
@@ -1,12 +1,15 @@
-import json
-
 from aiohttp import web
 
 from nccostorage.api import error
-from nccostorage.bucket import BucketOperations, DuplicateBucketError
+from nccostorage.api.response import json_response, read_json
+from nccostorage.bucket import BucketOperations, DuplicateBucketError, QuotaExceededError
+from nccostorage.bucket.core import DEFAULT_LIST_COUNT
 from nccostorage.middleware import requires_json
 
 
+MAX_LIST_LIMIT = 1000
+
+
 def _validate_ttl(ttl):
     if ttl is None or ttl < 60:
         return 60
@@ -17,34 +20,91 @@ def _validate_ttl(ttl):
 
 
 async def create_bucket(request):
-    body = await request.json()
+    body = await read_json(request)
     bucket_name = body.get('id')
     ttl = _validate_ttl(body.get('ttl'))
 
     if bucket_name is None:
         raise error.ApiError(status=400, text="missing 'id' in request body")
+    # names are sorted for listings and matched against urls, so anything but a string breaks both
+    if not isinstance(bucket_name, str) or not bucket_name:
+        raise error.ApiError(status=400, text="'id' must be a non-empty string")
 
     buckets: BucketOperations = request.app['buckets']
     try:
         await buckets.create(bucket_name, ttl=ttl)
     except DuplicateBucketError:
         raise error.ApiError(status=409, text=f'bucket with id {bucket_name} already exists')
+    except QuotaExceededError as ex:
+        raise error.quota_exceeded(ex)
 
     res_body = {
         'id': bucket_name,
         'ttl': ttl
     }
-    return web.Response(status=201, text=json.dumps(res_body), content_type='application/json')
+    return json_response(res_body, status=201)
+
+
+def _stats_body(stats):
+    return {
+        'id': stats.name,
+        'nccos': stats.nccos,
+        'size_bytes': stats.size_bytes,
+        'ttl': stats.ttl,
+        'expires_at': round(stats.expires_at, 3),
+    }
+
+
+def _validate_limit(limit):
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise error.ApiError(status=400, text="'limit' must be an integer")
+
+    if not 1 <= limit <= MAX_LIST_LIMIT:
+        raise error.ApiError(status=400, text=f"'limit' must be between 1 and {MAX_LIST_LIMIT}")
+
+    return limit
+
+
+async def list_buckets(request):
+    limit = _validate_limit(request.query.get('limit', DEFAULT_LIST_COUNT))
+    cursor = request.query.get('cursor')
+
+    buckets: BucketOperations = request.app['buckets']
+    next_cursor, page = await buckets.list(cursor, limit)
+
+    res_body = {
+        'buckets': [_stats_body(stats) for stats in page],
+        'next_cursor': next_cursor,
+    }
+    return json_response(res_body)
+
+
+async def lookup_bucket(request):
+    bucket_id = request.match_info['bucket_id']
+
+    buckets: BucketOperations = request.app['buckets']
+    stats = await buckets.stats(bucket_id)
+    if stats is None:
+        raise error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
+
+    return json_response(_stats_body(stats))
 
 
 async def remove_bucket(request):
     bucket_id = request.match_info['bucket_id']
 
     buckets: BucketOperations = request.app['buckets']
-    bucket_name = await buckets.remove(bucket_id)
-    if bucket_name is None:
+    bucket_info = await buckets.remove(bucket_id)
+    if bucket_info is None:
         raise error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
 
+    # only wired when the ncco routes are set up
+    ncco_renderer = request.app.get('ncco_renderer')
+    if ncco_renderer is not None:
+        ncco_renderer.invalidate(bucket_info.nccos.values())
+
     return web.Response(status=204)
 
 
@@ -52,6 +112,8 @@ def setup_routes(app, buckets):
     _wire_bucket_operations(app, buckets)
 
     app.router.add_post('/bucket', requires_json(create_bucket))
+    app.router.add_get('/bucket', list_buckets)
+    app.router.add_get('/bucket/{bucket_id}', lookup_bucket)
     app.router.add_delete('/bucket/{bucket_id}', remove_bucket)
 
     return app
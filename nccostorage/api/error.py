@@ -1,4 +1,5 @@
-from aiohttp import web
+from nccostorage.api.response import json_response
+from nccostorage.bucket import NccoTooLargeError
 
 
 class ApiError(Exception):
@@ -10,4 +11,12 @@ class ApiError(Exception):
 
 def to_response(api_error):
     api_response = {'status': 'error', 'text': api_error.text}
-    return web.json_response(api_response, status=api_error.status)
+    return json_response(api_response, status=api_error.status)
+
+
+def quota_exceeded(quota_error):
+    """
+    ApiError for a storage quota error: 413 for an ncco over the size limit, 429 for the other quotas.
+    """
+    status = 413 if isinstance(quota_error, NccoTooLargeError) else 429
+    return ApiError(str(quota_error), status=status)
@@ -1,71 +1,191 @@
-import json
+import uuid
 
-from aiohttp import web
+from aiohttp import hdrs, web
+from aiohttp.helpers import ETAG_ANY
 
+from nccostorage import compression, jsoncodec
 from nccostorage.api import error
-from nccostorage.bucket import BucketOperations
-from nccostorage.renderer import RenderError
+from nccostorage.api.response import json_response, read_json
+from nccostorage.bucket import BucketNotFoundError, BucketOperations, QuotaExceededError
+from nccostorage.renderer import InvalidNccoError, RenderBudgetError, RenderError, RenderTimeoutError
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson')
+
+# nccos held in memory at a time while exporting or importing a bucket
+EXPORT_CHUNK_SIZE = 1000
+IMPORT_CHUNK_SIZE = 1000
+# an imported line is held to the limit aiohttp puts on the body of the add endpoint
+MAX_IMPORT_LINE_BYTES = 1024 ** 2
+
+# tells render etags apart from lookup ones, the bodies differ for the same ncco
+RENDER_ETAG_SUFFIX = 'render'
+
+
+def _bucket_not_found(bucket_id):
+    return error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
+
+
+def _not_modified(request, etag):
+    """
+    True if one of the request's If-None-Match etags matches, weak ones included.
+    """
+    if_none_match = request.if_none_match
+    return if_none_match is not None and any(tag.value in (etag, ETAG_ANY) for tag in if_none_match)
+
+
+def _set_cache_headers(response, etag, ttl):
+    response.etag = etag
+    # caches must not outlive the bucket
+    response.headers[hdrs.CACHE_CONTROL] = f'max-age={max(0, int(ttl))}'
+    return response
+
+
+def _normalise_ncco(ncco):
+    """
+    Returns the ncco as compact json, or as is if it is a template that isn't json on its own.
+    """
+    if isinstance(ncco, str):
+        try:
+            ncco = jsoncodec.loads(ncco)
+        except jsoncodec.JSONDecodeError:
+            return ncco
+
+    return jsoncodec.dumps(ncco).decode('utf-8')
+
+
+async def _read_ncco_batch(request):
+    """
+    Reads the nccos of a batch, sent either as a json array or as one json value per line (NDJSON).
+    """
+    if request.content_type in NDJSON_CONTENT_TYPES:
+        body = await request.read()
+        return [jsoncodec.loads(line) for line in body.splitlines() if line.strip()]
+
+    nccos = await read_json(request)
+    if not isinstance(nccos, list):
+        raise error.ApiError(status=400, text='request body must be a json array of nccos')
+    return nccos
 
 
 async def add_ncco_to_bucket(request):
     bucket_id = request.match_info['bucket_id']
 
+    # a missing bucket is a 404 whatever the body holds
     buckets: BucketOperations = request.app['buckets']
     bucket = await buckets.lookup(bucket_id)
     if bucket is None:
-        raise error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
+        raise _bucket_not_found(bucket_id)
 
-    body = await request.json()
+    body = await read_json(request)
 
     ncco = body.get('ncco')
     if ncco is None:
         raise error.ApiError(status=400, text="missing 'ncco' in request body")
 
-    ncco_str = str(ncco)
-    ncco_id = await bucket.add(ncco_str)
+    ncco_str = _normalise_ncco(ncco)
+
+    ncco_renderer = request.app['ncco_renderer']
+    try:
+        ncco_renderer.prepare(ncco_str)
+    except InvalidNccoError as ex:
+        raise error.ApiError(status=400, text=str(ex))
+
+    try:
+        ncco_id = await bucket.add(ncco_str)
+    except BucketNotFoundError:
+        # expired while the body was read
+        raise _bucket_not_found(bucket_id)
+    except QuotaExceededError as ex:
+        raise error.quota_exceeded(ex)
 
     res_body = {
         'ncco_id': ncco_id,
         'ncco': ncco_str
     }
 
-    return web.Response(status=201, text=json.dumps(res_body), content_type='application/json')
+    return json_response(res_body, status=201)
 
 
-async def lookup_ncco(request):
+async def add_nccos_to_bucket(request):
     bucket_id = request.match_info['bucket_id']
 
     buckets: BucketOperations = request.app['buckets']
     bucket = await buckets.lookup(bucket_id)
     if bucket is None:
-        raise error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
+        raise _bucket_not_found(bucket_id)
+
+    nccos = await _read_ncco_batch(request)
+    if not nccos:
+        raise error.ApiError(status=400, text='no nccos in request body')
+
+    # compile everything first, so a bad ncco doesn't leave half the batch stored
+    ncco_renderer = request.app['ncco_renderer']
+    ncco_strs = []
+    for index, ncco in enumerate(nccos):
+        ncco_str = _normalise_ncco(ncco)
+        try:
+            ncco_renderer.prepare(ncco_str)
+        except InvalidNccoError as ex:
+            raise error.ApiError(status=400, text=f'ncco at index {index} is invalid: {ex}')
+        ncco_strs.append(ncco_str)
+
+    try:
+        ncco_ids = await bucket.add_nccos(ncco_strs)
+    except BucketNotFoundError:
+        raise _bucket_not_found(bucket_id)
+    except QuotaExceededError as ex:
+        raise error.quota_exceeded(ex)
+
+    res_body = {
+        'ncco_ids': ncco_ids,
+    }
+
+    return json_response(res_body, status=201)
+
+
+async def lookup_ncco(request):
+    bucket_id = request.match_info['bucket_id']
+
+    buckets: BucketOperations = request.app['buckets']
+    bucket = buckets.get(bucket_id)
 
     ncco_id = request.match_info['ncco_id']
-    ncco = await bucket.lookup(ncco_id)
+    try:
+        entry = await bucket.lookup_entry(ncco_id)
+    except BucketNotFoundError:
+        raise _bucket_not_found(bucket_id)
 
-    if ncco is None:
+    if entry is None:
         raise error.ApiError(status=404, text=f'ncco with id {ncco_id} not found')
 
+    if _not_modified(request, entry.etag):
+        return _set_cache_headers(web.Response(status=304), entry.etag, entry.ttl)
+
     res_body = {
         'ncco_id': ncco_id,
-        'ncco': ncco,
+        'ncco': entry.ncco,
     }
 
-    return web.Response(text=json.dumps(res_body), content_type='application/json')
+    return _set_cache_headers(json_response(res_body), entry.etag, entry.ttl)
 
 
 async def remove_ncco(request):
     bucket_id = request.match_info['bucket_id']
 
     buckets: BucketOperations = request.app['buckets']
-    bucket = await buckets.lookup(bucket_id)
-    if bucket is None:
-        raise error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
+    bucket = buckets.get(bucket_id)
 
     ncco_id = request.match_info['ncco_id']
-    if await bucket.remove(ncco_id) is None:
+    try:
+        ncco = await bucket.remove(ncco_id)
+    except BucketNotFoundError:
+        raise _bucket_not_found(bucket_id)
+    if ncco is None:
         raise error.ApiError(status=404, text=f'ncco with id {ncco_id} not found')
 
+    ncco_renderer = request.app['ncco_renderer']
+    ncco_renderer.invalidate([ncco])
+
     return web.Response(status=204)
 
 
@@ -73,30 +193,202 @@ async def render_ncco(request):
     bucket_id = request.match_info['bucket_id']
 
     buckets: BucketOperations = request.app['buckets']
-    bucket = await buckets.lookup(bucket_id)
-    if bucket is None:
-        raise error.ApiError(status=404, text=f'bucket with id {bucket_id} not found')
+    bucket = buckets.get(bucket_id)
 
     ncco_id = request.match_info['ncco_id']
-    ncco = await bucket.lookup(ncco_id)
+    try:
+        entry = await bucket.lookup_entry(ncco_id)
+    except BucketNotFoundError:
+        raise _bucket_not_found(bucket_id)
 
-    if ncco is None:
+    if entry is None:
         raise error.ApiError(status=404, text=f'ncco with id {ncco_id} not found')
 
+    ncco = entry.ncco
     ncco_renderer = request.app['ncco_renderer']
     query_params = request.query
 
+    # only static renders get an etag, and they are the same whatever the params,
+    # so a match is answered without rendering. prepare is cached, so checking
+    # first is cheap, and keeps If-None-Match: * from skipping a templated render.
+    try:
+        is_static = ncco_renderer.prepare(ncco).is_static
+    except InvalidNccoError as ex:
+        raise error.ApiError(status=400, text=str(ex))
+    etag = f'{entry.etag}-{RENDER_ETAG_SUFFIX}'
+    if is_static and _not_modified(request, etag):
+        return _set_cache_headers(web.Response(status=304), etag, entry.ttl)
+
     try:
-        result = ncco_renderer.render(ncco, query_params)
+        result = await ncco_renderer.render(ncco, query_params)
     except RenderError:
         raise error.ApiError(status=400, text=f'missing params while rendering ncco with id {ncco_id}')
+    except InvalidNccoError as ex:
+        raise error.ApiError(status=400, text=str(ex))
+    except RenderTimeoutError:
+        raise error.ApiError(status=503, text=f'timed out rendering ncco with id {ncco_id}')
+    except RenderBudgetError as ex:
+        raise error.ApiError(status=422, text=f'failed to render ncco with id {ncco_id}: {ex}')
+
+    # the renderer already returns validated json bytes
+    response = web.Response(status=200, body=result, content_type='application/json', charset='utf-8')
+    if is_static:
+        _set_cache_headers(response, etag, entry.ttl)
+    # other bodies are one-offs, not worth keeping compressed
+    if is_static or getattr(ncco_renderer, 'caches_renders', False):
+        compression.mark_cacheable(response)
+
+    return response
+
+
+async def export_bucket(request):
+    """
+    Streams every ncco of the bucket as NDJSON lines of {"ncco_id": ..., "ncco": ...}.
+    """
+    bucket_id = request.match_info['bucket_id']
 
+    buckets: BucketOperations = request.app['buckets']
+    bucket = buckets.get(bucket_id)
     try:
-        resp = json.loads(result)
-    except json.decoder.JSONDecodeError:
-        raise error.ApiError(status=400, text=f'rendered ncco is not valid json')
+        cursor, page = await bucket.scan(count=EXPORT_CHUNK_SIZE)
+    except BucketNotFoundError:
+        raise _bucket_not_found(bucket_id)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    await response.prepare(request)
+
+    while True:
+        await response.write(b''.join(jsoncodec.dumps({'ncco_id': ncco_id, 'ncco': ncco}) + b'\n'
+                                      for ncco_id, ncco in page))
+        if cursor == 0:
+            break
+        try:
+            cursor, page = await bucket.scan(cursor, EXPORT_CHUNK_SIZE)
+        except BucketNotFoundError:
+            # expired or removed halfway, the status is already sent so just end the stream
+            break
+
+    await response.write_eof()
+    return response
+
+
+def _parse_import_ncco_id(ncco_id, line_number):
+    # uuid.UUID fails with an AttributeError on anything but a string
+    if isinstance(ncco_id, str):
+        try:
+            return str(uuid.UUID(ncco_id))
+        except ValueError:
+            pass
+
+    raise error.ApiError(status=400, text=f'invalid ncco_id at line {line_number}')
+
+
+def _parse_import_line(ncco_renderer, line_number, line):
+    entry = jsoncodec.loads(line)
+    if isinstance(entry, dict):
+        ncco_id, ncco = entry.get('ncco_id'), entry.get('ncco')
+    else:
+        ncco_id, ncco = None, entry
+
+    if ncco is None:
+        raise error.ApiError(status=400, text=f"missing 'ncco' at line {line_number}")
+
+    if ncco_id is None:
+        ncco_id = str(uuid.uuid4())
+    else:
+        ncco_id = _parse_import_ncco_id(ncco_id, line_number)
+
+    ncco_str = _normalise_ncco(ncco)
+    try:
+        ncco_renderer.prepare(ncco_str)
+    except InvalidNccoError as ex:
+        raise error.ApiError(status=400, text=f'ncco at line {line_number} is invalid: {ex}')
+
+    return ncco_id, ncco_str
+
+
+async def _read_lines(content, max_line_bytes):
+    """
+    Yields the lines of a body, without their line breaks.
+
+    StreamReader's own readline refuses lines longer than its buffer, which
+    is well below what a single ncco may take, so lines are split here.
+    Raises ValueError once a line goes over max_line_bytes.
+    """
+    pending = bytearray()
+    async for data in content.iter_any():
+        start = 0
+        end = data.find(b'\n')
+        while end != -1:
+            pending += data[start:end]
+            if len(pending) > max_line_bytes:
+                raise ValueError('line too long')
+            yield bytes(pending)
+            pending.clear()
+            start = end + 1
+            end = data.find(b'\n', start)
+
+        pending += data[start:]
+        if len(pending) > max_line_bytes:
+            raise ValueError('line too long')
+
+    if pending:
+        yield bytes(pending)
+
+
+async def import_bucket(request):
+    """
+    Adds the nccos of an NDJSON body as produced by export_bucket, keeping their ids.
+
+    The body is read and stored in chunks, so a failure halfway leaves the
+    chunks before it stored. Lines holding a bare ncco get a new id.
+    """
+    bucket_id = request.match_info['bucket_id']
+
+    buckets: BucketOperations = request.app['buckets']
+    if await buckets.lookup(bucket_id) is None:
+        raise _bucket_not_found(bucket_id)
+    bucket = buckets.get(bucket_id)
+
+    ncco_renderer = request.app['ncco_renderer']
+
+    async def flush(chunk):
+        try:
+            await bucket.put_nccos(chunk)
+        except BucketNotFoundError:
+            raise _bucket_not_found(bucket_id)
+        except QuotaExceededError as ex:
+            raise error.quota_exceeded(ex)
+
+    imported = 0
+    chunk = {}
+    line_number = 0
+    try:
+        async for line in _read_lines(request.content, MAX_IMPORT_LINE_BYTES):
+            line_number += 1
+            if not line.strip():
+                continue
+
+            ncco_id, ncco_str = _parse_import_line(ncco_renderer, line_number, line)
+            chunk[ncco_id] = ncco_str
+            if len(chunk) >= IMPORT_CHUNK_SIZE:
+                await flush(chunk)
+                imported += len(chunk)
+                chunk = {}
+    except jsoncodec.JSONDecodeError:
+        raise error.ApiError(status=400, text=f'line {line_number} is not json')
+    except ValueError:
+        raise error.ApiError(status=413, text=f'line {line_number + 1} is over the limit of {MAX_IMPORT_LINE_BYTES} bytes')
+
+    if chunk:
+        await flush(chunk)
+        imported += len(chunk)
+
+    res_body = {
+        'imported': imported,
+    }
 
-    return web.Response(status=200, text=json.dumps(resp), content_type='application/json')
+    return json_response(res_body)
 
 
 def setup_routes(app, buckets, ncco_renderer):
@@ -104,6 +396,9 @@ def setup_routes(app, buckets, ncco_renderer):
     app['ncco_renderer'] = ncco_renderer
 
     app.router.add_post('/bucket/{bucket_id}/ncco', add_ncco_to_bucket)
+    app.router.add_post('/bucket/{bucket_id}/nccos', add_nccos_to_bucket)
+    app.router.add_get('/bucket/{bucket_id}/export', export_bucket)
+    app.router.add_post('/bucket/{bucket_id}/import', import_bucket)
     app.router.add_get('/bucket/{bucket_id}/ncco/{ncco_id}', lookup_ncco)
     app.router.add_delete('/bucket/{bucket_id}/ncco/{ncco_id}', remove_ncco)
     app.router.add_get('/bucket/{bucket_id}/ncco/{ncco_id}/render', render_ncco)
@@ -0,0 +1,14 @@
+from aiohttp import web
+
+from nccostorage import jsoncodec
+
+
+def json_response(data, status=200):
+    return web.Response(status=status, body=jsoncodec.dumps(data), content_type='application/json', charset='utf-8')
+
+
+async def read_json(request):
+    """
+    Decodes the request body straight from bytes, skipping the str round-trip of request.json().
+    """
+    return jsoncodec.loads(await request.read())
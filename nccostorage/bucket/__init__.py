@@ -1,12 +1,23 @@
-from nccostorage.bucket import core
+from nccostorage.bucket import codec, core
 
 # ERRORS
 BucketStorageError = core.BucketStorageError
 DuplicateBucketError = core.DuplicateBucketError
+BucketNotFoundError = core.BucketNotFoundError
+QuotaExceededError = core.QuotaExceededError
+NccoTooLargeError = core.NccoTooLargeError
+
+# Storage Format
+NccoCodec = codec.NccoCodec
 
 # Storage Implementation
 DictionaryBucketStorage = core.DictionaryBucketStorage
+Quotas = core.Quotas
+
+# Stats
+BucketStats = core.BucketStats
 
 # Fluent API
 BucketOperations = core.BucketOperations
 Bucket = core.Bucket
+NccoEntry = core.NccoEntry
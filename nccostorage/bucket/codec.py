@@ -0,0 +1,102 @@
+"""
+Storage format of nccos.
+
+Storages keep nccos as opaque bytes: the utf-8 encoded source, compressed
+when it is bigger than a threshold. Compressed values start with a marker
+byte, a control character that can't start json or template source, so
+plain and compressed values can live side by side and the compression
+settings can change between restarts.
+
+Every value is prefixed by another marker and a digest of the source,
+computed when the ncco is written, which versions the ncco without
+having to decode it. Values written before the digest are still read.
+"""
+import hashlib
+import zlib
+
+DEFAULT_COMPRESSION_THRESHOLD = 1024
+
+_ZLIB_MARKER = b'\x01'
+_ZSTD_MARKER = b'\x02'
+_DIGEST_MARKER = b'\x03'
+_DIGEST_SIZE = 8
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=_DIGEST_SIZE).digest()
+
+
+def _zstd():
+    # zstandard is an optional dependency, only needed for zstd compression
+    import zstandard
+    return zstandard
+
+
+class NccoCodec(object):
+    """
+    Encodes ncco source into the bytes handed to the storage and back.
+
+    compression is None, 'zlib' or 'zstd'. Values shorter than threshold
+    bytes, or that don't shrink, are kept uncompressed.
+    """
+
+    def __init__(self, compression=None, threshold=DEFAULT_COMPRESSION_THRESHOLD):
+        if compression not in (None, 'zlib', 'zstd'):
+            raise ValueError(f'unknown ncco compression {compression}')
+
+        self.compression = compression
+        self.threshold = threshold
+        self._compressor = None
+        self._decompressor = None
+        if compression == 'zstd':
+            self._compressor = _zstd().ZstdCompressor()
+
+    def encode(self, ncco):
+        data = ncco.encode('utf-8')
+        return _DIGEST_MARKER + _digest(data) + self._compress(data)
+
+    def decode(self, data):
+        # str values were written by storages that predate this format
+        if data is None or isinstance(data, str):
+            return data
+
+        marker = data[:1]
+        if marker == _DIGEST_MARKER:
+            data = data[1 + _DIGEST_SIZE:]
+            marker = data[:1]
+
+        if marker == _ZLIB_MARKER:
+            data = zlib.decompress(data[1:])
+        elif marker == _ZSTD_MARKER:
+            if self._decompressor is None:
+                self._decompressor = _zstd().ZstdDecompressor()
+            data = self._decompressor.decompress(data[1:])
+
+        return data.decode('utf-8')
+
+    def digest(self, data):
+        """
+        Returns the digest of the ncco as a hex string, the same for equal sources whatever their compression.
+        """
+        if isinstance(data, bytes) and data[:1] == _DIGEST_MARKER:
+            return data[1:1 + _DIGEST_SIZE].hex()
+
+        # written before values carried their digest
+        return _digest(self.decode(data).encode('utf-8')).hex()
+
+    def decode_all(self, ncco_data):
+        """
+        Decodes every value of an ncco_id -> data mapping.
+        """
+        return {ncco_id: self.decode(data) for ncco_id, data in ncco_data.items()}
+
+    def _compress(self, data):
+        if self.compression is None or len(data) < self.threshold:
+            return data
+
+        if self.compression == 'zlib':
+            compressed = _ZLIB_MARKER + zlib.compress(data)
+        else:
+            compressed = _ZSTD_MARKER + self._compressor.compress(data)
+
+        return compressed if len(compressed) < len(data) else data
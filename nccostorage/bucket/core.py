@@ -1,11 +1,40 @@
+import asyncio
+import bisect
 import asyncio.locks as locks
-from uuid import uuid4 as uuid
+import heapq
+import itertools
+import logging
+import operator
+import time
+import uuid
+
+from nccostorage.bucket.codec import NccoCodec
+from nccostorage.bucket.eviction import create_eviction_index
 
 DEFAULT_TTL = 86400
+DEFAULT_SCAN_COUNT = 1000
+DEFAULT_LIST_COUNT = 100
+
+
+def _new_ncco_id():
+    return uuid.uuid4().int
 
 
-def _bucket_key_for(name):
-    return f'bucket_{name}'
+def _parse_ncco_id(ncco_id):
+    """
+    Returns the int form of an ncco id, or None if it can't be one of ours.
+    """
+    # much cheaper than uuid.UUID(ncco_id), and this runs on every lookup
+    if len(ncco_id) != 36:
+        return None
+    try:
+        return int(ncco_id.replace('-', ''), 16)
+    except ValueError:
+        return None
+
+
+def _format_ncco_id(ncco_id):
+    return str(uuid.UUID(int=ncco_id))
 
 
 class BucketStorageError(Exception):
@@ -16,69 +45,550 @@ class DuplicateBucketError(BucketStorageError):
     pass
 
 
+class BucketNotFoundError(BucketStorageError):
+    pass
+
+
+class QuotaExceededError(BucketStorageError):
+    pass
+
+
+class NccoTooLargeError(QuotaExceededError):
+    pass
+
+
+class Quotas(object):
+    """
+    Limits of a DictionaryBucketStorage, None for no limit.
+
+    Sizes are those of the stored nccos, after compression, in bytes.
+    """
+
+    __slots__ = ('max_buckets', 'max_nccos_per_bucket', 'max_ncco_bytes', 'max_total_bytes')
+
+    def __init__(self, max_buckets=None, max_nccos_per_bucket=None, max_ncco_bytes=None, max_total_bytes=None):
+        self.max_buckets = max_buckets
+        self.max_nccos_per_bucket = max_nccos_per_bucket
+        self.max_ncco_bytes = max_ncco_bytes
+        self.max_total_bytes = max_total_bytes
+
+
+class BucketStats(object):
+    """
+    Size and lifetime of a bucket. expires_at is a unix timestamp.
+    """
+
+    __slots__ = ('name', 'nccos', 'size_bytes', 'ttl', 'expires_at')
+
+    def __init__(self, name, nccos, size_bytes, ttl, expires_at):
+        self.name = name
+        self.nccos = nccos
+        self.size_bytes = size_bytes
+        self.ttl = ttl
+        self.expires_at = expires_at
+
+
+class _BucketRecord(object):
+    """
+    A bucket as kept by DictionaryBucketStorage, with its nccos keyed by the int form of their id.
+
+    size_bytes is the total size of the stored nccos, kept up on every change,
+    removed_nccos counts the nccos removed one by one so scans can tell their
+    offset still holds.
+    """
+
+    __slots__ = ('name', 'ttl', 'deadline', 'nccos', 'size_bytes', 'removed_nccos')
+
+    def __init__(self, name, ttl, deadline, nccos):
+        self.name = name
+        self.ttl = ttl
+        self.deadline = deadline
+        self.nccos = nccos
+        self.size_bytes = sum(len(ncco) for ncco in nccos.values())
+        self.removed_nccos = 0
+
+
 class DictionaryBucketStorage(object):
+    """
+    In-memory bucket storage.
 
-    def __init__(self):
+    Buckets are _BucketRecords keyed by name and ncco ids are kept as ints,
+    a third of the size of their str form, which only exists at the
+    boundary of this class.
+
+    Writes over the quotas raise QuotaExceededError, checked against counts
+    kept up on every change rather than by going through the buckets.
+    Restored buckets are let in whatever the quotas.
+
+    With a memory_budget, writes that take the stored bytes over it evict
+    whole buckets, other than the one written to, in the order of the
+    eviction_policy (see nccostorage.bucket.eviction) until they fit again.
+    """
+
+    def __init__(self, clock=time.monotonic, lock_reads=False, quotas=None, memory_budget=None,
+                 eviction_policy='expiry'):
         self._store = {}
+        # sorted bucket names, so listing can resume from any name in O(log n)
+        self._names = []
+        self._ncco_count = 0
+        self._size_bytes = 0
+        self.quotas = quotas if quotas is not None else Quotas()
+        self.memory_budget = memory_budget
+        self.eviction_policy = eviction_policy
+        self._eviction_index = create_eviction_index(eviction_policy) if memory_budget is not None else None
+        self._eviction_listeners = []
+        # reads are plain dict lookups with no await in between, so on a
+        # single event loop they don't need the lock. Writes keep it.
         self._lock = locks.Lock()
+        self._lock_reads = lock_reads
+
+        # expiry bookkeeping: a min-heap of (deadline, name) entries. Heap
+        # entries are never removed eagerly, stale ones are skipped when
+        # they reach the top, or dropped when the heap is rebuilt once they
+        # outnumber the live buckets.
+        self._clock = clock
+        self._expiry_queue = []
+        self._expiry_timer = None
+        self._expiry_timer_deadline = None
+        self._expiry_listeners = []
+
+    def add_expiry_listener(self, listener):
+        """
+        Registers a callable invoked with (name, ncco_data) for every expired bucket.
+
+        ncco_data is keyed by int ids, most listeners only need its size or
+        values and formatting every id would hold up the event loop.
+        """
+        self._expiry_listeners.append(listener)
+
+    def add_eviction_listener(self, listener):
+        """
+        Registers a callable invoked with (name, ncco_data) for every bucket evicted to stay within the memory budget.
+
+        ncco_data is keyed by int ids, like for expiry listeners.
+        """
+        self._eviction_listeners.append(listener)
+
+    async def open(self):
+        """
+        Prepares the storage for use, returning the (buckets, nccos) counts it starts with.
+        """
+        return 0, 0
+
+    async def close(self):
+        if self._expiry_timer is not None:
+            self._expiry_timer.cancel()
+            self._expiry_timer = None
 
     async def create(self, name, ttl=None):
         if ttl is None:
             ttl = DEFAULT_TTL
 
-        bucket_data = dict()
-        key = _bucket_key_for(name)
-
         async with self._lock:
-            if key in self._store:
+            if self._live_bucket(name) is not None:
                 raise DuplicateBucketError(f'duplicate bucket {name}')
-            self._store[key] = bucket_data
+            max_buckets = self.quotas.max_buckets
+            if max_buckets is not None and len(self._store) >= max_buckets:
+                raise QuotaExceededError(f'storage is limited to {max_buckets} buckets')
+            self._add_record(name, ttl, {})
 
         return name
 
-    async def exists(self, name):
-        key = _bucket_key_for(name)
+    async def restore(self, name, ttl, nccos):
+        """
+        Puts back a bucket with its nccos, keyed by int ids as dump yields them,
+        replacing any bucket with the same name.
+        """
         async with self._lock:
-            return key in self._store
+            self._add_record(name, ttl, nccos)
+
+    def live_counts(self):
+        """
+        Returns the (buckets, nccos, bytes) counts, kept up as buckets and nccos come and go.
+        """
+        return len(self._store), self._ncco_count, self._size_bytes
+
+    def dump(self):
+        """
+        Yields (name, remaining ttl, nccos) for every live bucket, nccos being a copy keyed by int ids.
+
+        Formatting millions of ids takes seconds, so that's left to whoever
+        writes them out, off the event loop.
+        """
+        now = self._clock()
+        for record in self._store.values():
+            remaining = record.deadline - now
+            if remaining > 0:
+                yield record.name, remaining, dict(record.nccos)
+
+    async def exists(self, name):
+        if self._lock_reads:
+            async with self._lock:
+                return self._live_bucket(name) is not None
+
+        return self._live_bucket(name) is not None
 
     async def remove(self, name):
-        bucket_key = _bucket_key_for(name)
+        """
+        Returns the nccos of the removed bucket keyed by int ids, or None if there was no such bucket.
+        """
         async with self._lock:
-            ncco_data = self._store.pop(bucket_key, None)
+            record = self._live_bucket(name)
+            if record is None:
+                return None
+            self._remove_record(record)
 
-        return ncco_data
+        # the record is gone, its nccos can be handed out as they are
+        return record.nccos
 
     async def add_ncco(self, bucket_name, ncco):
         async with self._lock:
-            bucket_data = self._store.get(_bucket_key_for(bucket_name))
+            record = self._live_bucket(bucket_name)
 
-            if bucket_data is None:
-                raise BucketStorageError(f'non-existing bucket {bucket_name}')
+            if record is None:
+                raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
 
-            ncco_id = str(uuid())
-            bucket_data[ncco_id] = ncco
+            self._check_quotas(record, (ncco,), 1, len(ncco))
 
-            return ncco_id
+            ncco_id = _new_ncco_id()
+            record.nccos[ncco_id] = ncco
+            record.size_bytes += len(ncco)
+            self._size_bytes += len(ncco)
+            self._ncco_count += 1
+            self._evict_over_budget(record)
 
-    async def get_ncco(self, bucket_name, ncco_id):
+            return _format_ncco_id(ncco_id)
+
+    async def add_nccos(self, bucket_name, nccos):
+        """
+        Adds every ncco under a single lock acquisition, returning their ids in order.
+        """
+        async with self._lock:
+            record = self._live_bucket(bucket_name)
+
+            if record is None:
+                raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+            added_bytes = sum(len(ncco) for ncco in nccos)
+            self._check_quotas(record, nccos, len(nccos), added_bytes)
+
+            ncco_ids = [_new_ncco_id() for _ in nccos]
+            record.nccos.update(zip(ncco_ids, nccos))
+            record.size_bytes += added_bytes
+            self._size_bytes += added_bytes
+            self._ncco_count += len(nccos)
+            self._evict_over_budget(record)
+
+            return [_format_ncco_id(ncco_id) for ncco_id in ncco_ids]
+
+    async def put_nccos(self, bucket_name, ncco_data):
+        """
+        Stores the nccos under the ids they come with, returning how many of them are new.
+        """
+        nccos = {uuid.UUID(ncco_id).int: ncco for ncco_id, ncco in ncco_data.items()}
         async with self._lock:
-            bucket_data = self._store.get(_bucket_key_for(bucket_name))
-            if bucket_data is None:
-                raise BucketStorageError(f'non-existing bucket {bucket_name}')
+            record = self._live_bucket(bucket_name)
+
+            if record is None:
+                raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+            existing = 0
+            added_bytes = 0
+            for ncco_id, ncco in nccos.items():
+                replaced = record.nccos.get(ncco_id)
+                if replaced is not None:
+                    existing += 1
+                    added_bytes -= len(replaced)
+                added_bytes += len(ncco)
+            self._check_quotas(record, nccos.values(), len(nccos) - existing, added_bytes)
+
+            record.nccos.update(nccos)
+            record.size_bytes += added_bytes
+            self._size_bytes += added_bytes
+            self._ncco_count += len(nccos) - existing
+            self._evict_over_budget(record)
+
+            return len(nccos) - existing
+
+    async def scan_nccos(self, bucket_name, cursor=0, count=DEFAULT_SCAN_COUNT):
+        """
+        Returns (next cursor, [(ncco_id, ncco)]) with up to count nccos from cursor on.
+
+        Start with cursor 0 and stop once the next cursor is 0 again, other
+        cursors are opaque. nccos added or removed in between calls may or may
+        not be returned, those there all along are returned at least once.
+        """
+        if self._lock_reads:
+            async with self._lock:
+                return self._scan_nccos(bucket_name, cursor, count)
+
+        return self._scan_nccos(bucket_name, cursor, count)
+
+    async def get_ncco(self, bucket_name, ncco_id):
+        if self._lock_reads:
+            async with self._lock:
+                return self._get_ncco(bucket_name, ncco_id)
+
+        return self._get_ncco(bucket_name, ncco_id)
+
+    async def get_ncco_with_ttl(self, bucket_name, ncco_id):
+        """
+        Returns (ncco, seconds the bucket has left to live), the ncco being None if it doesn't exist.
+        """
+        if self._lock_reads:
+            async with self._lock:
+                return self._get_ncco_with_ttl(bucket_name, ncco_id)
 
-            return bucket_data.get(ncco_id)
+        return self._get_ncco_with_ttl(bucket_name, ncco_id)
 
     async def remove_ncco(self, bucket_name, ncco_id):
         async with self._lock:
-            bucket_data = self._store.get(_bucket_key_for(bucket_name))
-            if bucket_data is None:
-                raise BucketStorageError(f'non-existing bucket {bucket_name}')
+            record = self._live_bucket(bucket_name)
+            if record is None:
+                raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+            ncco = record.nccos.pop(_parse_ncco_id(ncco_id), None)
+            if ncco is not None:
+                record.size_bytes -= len(ncco)
+                record.removed_nccos += 1
+                self._size_bytes -= len(ncco)
+                self._ncco_count -= 1
+            return ncco
+
+    async def bucket_stats(self, name):
+        """
+        Returns the BucketStats of the bucket, or None if it doesn't exist.
+        """
+        record = self._live_bucket(name)
+        if record is None:
+            return None
 
-            return bucket_data.pop(ncco_id, None)
+        return self._stats_for(record, time.time(), self._clock())
+
+    async def list_buckets(self, cursor=None, count=DEFAULT_LIST_COUNT):
+        """
+        Returns (next cursor, [BucketStats]) for up to count buckets, sorted by name.
+
+        Start with cursor None and stop once the next cursor is None again.
+        """
+        wall_now, now = time.time(), self._clock()
+        start = 0 if cursor is None else bisect.bisect_right(self._names, cursor)
+
+        page = []
+        for name in itertools.islice(self._names, start, start + count):
+            record = self._store[name]
+            # expired buckets still waiting for the timer are left out
+            if record.deadline > now:
+                page.append(self._stats_for(record, wall_now, now))
+
+        next_cursor = self._names[start + count - 1] if start + count < len(self._names) else None
+        return next_cursor, page
+
+    def _scan_nccos(self, bucket_name, cursor, count):
+        record = self._live_bucket(bucket_name)
+        if record is None:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        start = self._scan_start(record, cursor)
+        # nccos are scanned in insertion order, skipping to the start is a C loop
+        entries = list(itertools.islice(record.nccos.items(), start, start + count))
+        next_cursor = 0
+        if start + count < len(record.nccos):
+            next_cursor = (start + count, entries[-1][0], record.removed_nccos)
+
+        return next_cursor, [(_format_ncco_id(ncco_id), ncco) for ncco_id, ncco in entries]
+
+    @staticmethod
+    def _scan_start(record, cursor):
+        """
+        Returns the offset to resume a scan from.
+
+        The cursor holds the offset after the last scanned ncco, its id and
+        how many nccos had been removed. Removals since shift the nccos left
+        to scan towards the start, so the last id is looked up again, and if
+        it was removed too the scan goes back by the number of removals,
+        repeating some nccos rather than skipping any.
+        """
+        if cursor == 0:
+            return 0
+
+        offset, last_id, removed_nccos = cursor
+        if record.removed_nccos == removed_nccos:
+            return offset
+
+        try:
+            return operator.indexOf(itertools.islice(record.nccos, offset), last_id) + 1
+        except ValueError:
+            return max(offset - (record.removed_nccos - removed_nccos), 0)
+
+    def _get_ncco(self, bucket_name, ncco_id):
+        record = self._live_bucket(bucket_name)
+        if record is None:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        if self._eviction_index is not None:
+            self._eviction_index.touch(record)
+        return record.nccos.get(_parse_ncco_id(ncco_id))
+
+    def _get_ncco_with_ttl(self, bucket_name, ncco_id):
+        record = self._live_bucket(bucket_name)
+        if record is None:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        if self._eviction_index is not None:
+            self._eviction_index.touch(record)
+        return record.nccos.get(_parse_ncco_id(ncco_id)), record.deadline - self._clock()
+
+    def _check_quotas(self, record, nccos, added_nccos, added_bytes):
+        """
+        Raises QuotaExceededError if adding the nccos to the record would go over a quota.
+
+        Writes that don't grow the storage always go through, so it can
+        shrink back under quotas lowered since.
+        """
+        quotas = self.quotas
+        if quotas.max_ncco_bytes is not None:
+            for ncco in nccos:
+                if len(ncco) > quotas.max_ncco_bytes:
+                    raise NccoTooLargeError(f'ncco of {len(ncco)} bytes is over the limit of {quotas.max_ncco_bytes} bytes')
+
+        max_nccos = quotas.max_nccos_per_bucket
+        if max_nccos is not None and added_nccos > 0 and len(record.nccos) + added_nccos > max_nccos:
+            raise QuotaExceededError(f'bucket {record.name} is limited to {max_nccos} nccos')
+
+        max_bytes = quotas.max_total_bytes
+        if max_bytes is not None and added_bytes > 0 and self._size_bytes + added_bytes > max_bytes:
+            raise QuotaExceededError(f'storage is limited to {max_bytes} bytes of nccos')
+
+    def _evict_over_budget(self, written):
+        if self.memory_budget is None:
+            return
+
+        while self._size_bytes > self.memory_budget:
+            name = self._eviction_index.victim(exclude=written.name)
+            if name is None:
+                return
+            self._evict(self._store[name])
+
+    def _evict(self, record):
+        self._remove_record(record)
+
+        logger = logging.getLogger(__name__)
+        logger.warning(f'msg="evicted bucket over memory budget" bucket={record.name} policy={self.eviction_policy} '
+                       f'nccos={len(record.nccos)} size_bytes={record.size_bytes} budget={self.memory_budget}')
+
+        for listener in self._eviction_listeners:
+            listener(record.name, record.nccos)
+
+    def _live_bucket(self, name):
+        """
+        Returns the bucket record, expiring the bucket first if its ttl has run out.
+        """
+        record = self._store.get(name)
+        if record is not None and record.deadline <= self._clock():
+            self._expire(record)
+            return None
+
+        return record
+
+    def _stats_for(self, record, wall_now, now):
+        return BucketStats(record.name, len(record.nccos), record.size_bytes, record.ttl,
+                           wall_now + record.deadline - now)
+
+    def _expire(self, record):
+        self._remove_record(record)
+
+        for listener in self._expiry_listeners:
+            listener(record.name, record.nccos)
+
+    def _add_record(self, name, ttl, nccos):
+        deadline = self._clock() + ttl
+        replaced = self._store.get(name)
+        if replaced is None:
+            bisect.insort(self._names, name)
+        else:
+            self._ncco_count -= len(replaced.nccos)
+            self._size_bytes -= replaced.size_bytes
+            if self._eviction_index is not None:
+                self._eviction_index.remove(replaced)
+        record = self._store[name] = _BucketRecord(name, ttl, deadline, nccos)
+        self._ncco_count += len(nccos)
+        self._size_bytes += record.size_bytes
+        if self._eviction_index is not None:
+            self._eviction_index.add(record)
+        heapq.heappush(self._expiry_queue, (deadline, name))
+        if replaced is not None:
+            self._compact_expiry_queue()
+        self._schedule_expiry()
+
+    def _remove_record(self, record):
+        del self._store[record.name]
+        self._ncco_count -= len(record.nccos)
+        self._size_bytes -= record.size_bytes
+        if self._eviction_index is not None:
+            self._eviction_index.remove(record)
+        del self._names[bisect.bisect_left(self._names, record.name)]
+        self._compact_expiry_queue()
+
+    def _compact_expiry_queue(self):
+        # every live bucket has one entry, so the rest are stale
+        if len(self._expiry_queue) > 2 * len(self._store):
+            self._expiry_queue = [(record.deadline, record.name) for record in self._store.values()]
+            heapq.heapify(self._expiry_queue)
+
+    def _schedule_expiry(self):
+        if not self._expiry_queue:
+            return
+
+        deadline = self._expiry_queue[0][0]
+        if self._expiry_timer is not None:
+            if self._expiry_timer_deadline <= deadline:
+                return
+            self._expiry_timer.cancel()
+
+        delay = max(0, deadline - self._clock())
+        self._expiry_timer = asyncio.get_event_loop().call_later(delay, self._expire_buckets)
+        self._expiry_timer_deadline = deadline
+
+    def _expire_buckets(self):
+        self._expiry_timer = None
+
+        now = self._clock()
+        while self._expiry_queue and self._expiry_queue[0][0] <= now:
+            deadline, name = heapq.heappop(self._expiry_queue)
+            record = self._store.get(name)
+            # skip entries of buckets that were removed or re-created since
+            if record is not None and record.deadline == deadline:
+                self._expire(record)
+
+        self._schedule_expiry()
+
+
+class NccoEntry(object):
+    """
+    A stored ncco with its version and the seconds its bucket has left to live.
+
+    The ncco is only decoded when it's asked for, so answering a conditional
+    request never has to.
+    """
+
+    __slots__ = ('etag', 'ttl', '_data', '_codec')
+
+    def __init__(self, data, ttl, codec):
+        self.etag = codec.digest(data)
+        self.ttl = ttl
+        self._data = data
+        self._codec = codec
+
+    @property
+    def ncco(self):
+        return self._codec.decode(self._data)
 
 
 class BucketInfo(object):
 
+    __slots__ = ('name', 'nccos')
+
     def __init__(self, name, nccos):
         self.name = name
         self.nccos = nccos
@@ -89,41 +599,84 @@ class BucketInfo(object):
 
 class BucketOperations(object):
 
-    def __init__(self, storage):
+    def __init__(self, storage, codec=None):
         self.storage = storage
+        self.codec = codec if codec is not None else NccoCodec()
 
     async def create(self, name, ttl=None):
         ttl = ttl or DEFAULT_TTL
         await self.storage.create(name, ttl=ttl)
 
-        return Bucket(name, self.storage)
+        return Bucket(name, self.storage, self.codec)
+
+    def get(self, name):
+        """
+        Returns a handle to the bucket without checking that it exists.
+
+        Operations on the handle raise BucketNotFoundError if it doesn't, which
+        saves a storage round-trip when the caller is going to use it anyway.
+        """
+        return Bucket(name, self.storage, self.codec)
 
     async def lookup(self, name):
         if await self.storage.exists(name):
-            return Bucket(name, self.storage)
+            return Bucket(name, self.storage, self.codec)
 
         return None
 
+    async def stats(self, name):
+        return await self.storage.bucket_stats(name)
+
+    async def list(self, cursor=None, count=DEFAULT_LIST_COUNT):
+        """
+        Returns (next cursor, [BucketStats]), see list_buckets on the storage.
+        """
+        return await self.storage.list_buckets(cursor, count)
+
     async def remove(self, name):
         ncco_data = await self.storage.remove(name)
 
         if ncco_data is None:
             return None
 
-        return BucketInfo(name, ncco_data)
+        return BucketInfo(name, self.codec.decode_all(ncco_data))
 
 
 class Bucket(object):
 
-    def __init__(self, name, storage):
+    __slots__ = ('name', 'storage', 'codec')
+
+    def __init__(self, name, storage, codec=None):
         self.name = name
         self.storage = storage
+        self.codec = codec if codec is not None else NccoCodec()
 
     async def add(self, ncco):
-        return await self.storage.add_ncco(self.name, ncco)
+        return await self.storage.add_ncco(self.name, self.codec.encode(ncco))
+
+    async def add_nccos(self, nccos):
+        return await self.storage.add_nccos(self.name, [self.codec.encode(ncco) for ncco in nccos])
+
+    async def put_nccos(self, ncco_data):
+        return await self.storage.put_nccos(self.name, {ncco_id: self.codec.encode(ncco)
+                                                         for ncco_id, ncco in ncco_data.items()})
+
+    async def scan(self, cursor=0, count=DEFAULT_SCAN_COUNT):
+        next_cursor, page = await self.storage.scan_nccos(self.name, cursor, count)
+        return next_cursor, [(ncco_id, self.codec.decode(ncco)) for ncco_id, ncco in page]
 
     async def remove(self, ncco_id):
-        return await self.storage.remove_ncco(self.name, ncco_id)
+        return self.codec.decode(await self.storage.remove_ncco(self.name, ncco_id))
 
     async def lookup(self, ncco_id):
-        return await self.storage.get_ncco(self.name, ncco_id)
+        return self.codec.decode(await self.storage.get_ncco(self.name, ncco_id))
+
+    async def lookup_entry(self, ncco_id):
+        """
+        Returns the NccoEntry of the ncco, or None if it doesn't exist.
+        """
+        data, ttl = await self.storage.get_ncco_with_ttl(self.name, ncco_id)
+        if data is None:
+            return None
+
+        return NccoEntry(data, ttl, self.codec)
@@ -0,0 +1,138 @@
+"""
+Eviction policies for the memory budget of DictionaryBucketStorage.
+
+Each policy keeps an index of the buckets that gives the next one to evict
+without going through them all:
+
+    expiry  the bucket closest to expiring, from a min-heap of deadlines
+    lru     the bucket whose nccos were read least recently, from an ordered dict
+    lfu     the bucket whose nccos were read least often, from ordered dicts of
+            buckets per read count, oldest first within a count
+"""
+import collections
+import heapq
+
+EVICTION_POLICIES = ('expiry', 'lru', 'lfu')
+
+
+class ExpiryIndex(object):
+
+    def __init__(self):
+        # min-heap of (deadline, name), entries of removed buckets are skipped when they reach the top
+        # or dropped when the heap is rebuilt once they outnumber the live ones
+        self._heap = []
+        self._deadlines = {}
+
+    def add(self, record):
+        self._deadlines[record.name] = record.deadline
+        heapq.heappush(self._heap, (record.deadline, record.name))
+
+    def remove(self, record):
+        self._deadlines.pop(record.name, None)
+        if len(self._heap) > 2 * len(self._deadlines):
+            self._heap = [(deadline, name) for name, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def touch(self, record):
+        pass
+
+    def victim(self, exclude=None):
+        """
+        Returns the name of the bucket to evict next, other than exclude, or None if there isn't any.
+        """
+        skipped = None
+        while self._heap:
+            deadline, name = self._heap[0]
+            if self._deadlines.get(name) != deadline:
+                heapq.heappop(self._heap)
+            elif name == exclude:
+                skipped = heapq.heappop(self._heap)
+            else:
+                break
+
+        victim = self._heap[0][1] if self._heap else None
+        if skipped is not None:
+            heapq.heappush(self._heap, skipped)
+        return victim
+
+
+class LruIndex(object):
+
+    def __init__(self):
+        self._names = collections.OrderedDict()
+
+    def add(self, record):
+        self._names[record.name] = None
+
+    def remove(self, record):
+        self._names.pop(record.name, None)
+
+    def touch(self, record):
+        self._names.move_to_end(record.name)
+
+    def victim(self, exclude=None):
+        for name in self._names:
+            if name != exclude:
+                return name
+        return None
+
+
+class LfuIndex(object):
+
+    def __init__(self):
+        # read count -> names of the buckets read that many times, least recently touched first
+        self._by_count = {}
+        self._counts = {}
+        self._min_count = 0
+
+    def add(self, record):
+        self._counts[record.name] = 0
+        self._by_count.setdefault(0, collections.OrderedDict())[record.name] = None
+        self._min_count = 0
+
+    def remove(self, record):
+        count = self._counts.pop(record.name, None)
+        if count is not None:
+            self._discard(record.name, count)
+
+    def touch(self, record):
+        count = self._counts[record.name]
+        self._discard(record.name, count)
+        if count == self._min_count and count not in self._by_count:
+            self._min_count = count + 1
+        self._counts[record.name] = count + 1
+        self._by_count.setdefault(count + 1, collections.OrderedDict())[record.name] = None
+
+    def victim(self, exclude=None):
+        names = self._by_count.get(self._min_count)
+        if names is None:
+            # the minimum went away with a removal, which doesn't track it
+            if not self._by_count:
+                return None
+            self._min_count = min(self._by_count)
+            names = self._by_count[self._min_count]
+
+        for name in names:
+            if name != exclude:
+                return name
+
+        # only the excluded bucket has the lowest count, rare enough to look for the next one
+        higher = [count for count in self._by_count if count > self._min_count]
+        return next(iter(self._by_count[min(higher)])) if higher else None
+
+    def _discard(self, name, count):
+        names = self._by_count[count]
+        del names[name]
+        if not names:
+            del self._by_count[count]
+
+
+def create_eviction_index(policy):
+    if policy == 'expiry':
+        return ExpiryIndex()
+    elif policy == 'lru':
+        return LruIndex()
+    elif policy == 'lfu':
+        return LfuIndex()
+    else:
+        raise ValueError(f'unknown eviction policy {policy}')
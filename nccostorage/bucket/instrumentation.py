@@ -1,10 +1,24 @@
+import asyncio
+import contextlib
+
 from prometheus_async.aio import time
 from prometheus_client import Counter, Gauge, Histogram
 
+from nccostorage.bucket.core import DEFAULT_LIST_COUNT, DEFAULT_SCAN_COUNT, BucketNotFoundError
+from nccostorage.metrics import timed
+
+# pylint: disable-msg=no-value-for-parameter
+LIVE_BUCKETS = Gauge('live_buckets', 'number of live buckets in storage', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+LIVE_NCCOS = Gauge('live_nccos', 'number of live nccos in storage', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+LIVE_BYTES = Gauge('live_bytes', 'size of the live nccos in storage (in bytes)', multiprocess_mode='livesum')
 # pylint: disable-msg=no-value-for-parameter
-LIVE_BUCKETS = Gauge('live_buckets', 'number of live buckets in storage')
+QUOTA_LIMIT = Gauge('quota_limit', 'storage quotas, to compare with the live gauges', ['quota'], multiprocess_mode='liveall')
 # pylint: disable-msg=no-value-for-parameter
-LIVE_NCCOS = Gauge('live_nccos', 'number of live nccos in storage')
+EXPIRED_BUCKETS = Counter('expired_buckets', 'number of buckets removed after their ttl ran out')
+# pylint: disable-msg=no-value-for-parameter
+EVICTED_BUCKETS = Counter('evicted_buckets', 'number of buckets evicted to stay within the memory budget')
 # pylint: disable-msg=no-value-for-parameter
 UPDATE_REQUEST = Counter('update_count', 'storage update method call rate')
 # pylint: disable-msg=no-value-for-parameter
@@ -12,6 +26,8 @@ UPDATE_ERROR = Counter('update_error', 'storage update error rate')
 # pylint: disable-msg=no-value-for-parameter
 UPDATE_TIME = Histogram('update_time', 'storage update request latency (in seconds)')
 # pylint: disable-msg=no-value-for-parameter
+UPDATE_BATCH_ITEMS = Counter('update_batch_items', 'number of nccos written by batch updates')
+# pylint: disable-msg=no-value-for-parameter
 READ_REQUEST = Counter('read_count', 'storage read method call rate')
 # pylint: disable-msg=no-value-for-parameter
 READ_ERROR = Counter('read_error', 'storage read error rate')
@@ -19,18 +35,79 @@ READ_ERROR = Counter('read_error', 'storage read error rate')
 READ_TIME = Histogram('read_time', 'storage read request latency (in seconds)')
 
 
+@contextlib.contextmanager
+def _count_errors(counter):
+    """
+    Counts the exceptions raised in the block, except for missing buckets, which are a plain 404 rather than a failure.
+    """
+    try:
+        yield
+    except BucketNotFoundError:
+        raise
+    except Exception:
+        counter.inc()
+        raise
+
+
 class InstrumentedBucketStorage(object):
+    """
+    Storage wrapper exporting call rates, errors and latencies.
 
-    def __init__(self, storage):
+    live_buckets, live_nccos and live_bytes come from the counts the
+    storage keeps itself (live_counts), read when metrics are scraped.
+    Metrics of a multi-process setup are read from files instead, so the
+    owner of the storage passes a refresh_interval to copy the counts into
+    the gauges periodically. Storages without live_counts, like redis, don't export
+    them. quota_limit holds the storage's quotas, if it has any. Reads are
+    the hottest path, read_sample_rate is the fraction of them observed in
+    read_time.
+    """
+
+    def __init__(self, storage, refresh_interval=None, read_sample_rate=1.0):
         self._storage = storage
+        self._storage.add_expiry_listener(self._on_expiry)
+        self._storage.add_eviction_listener(self._on_eviction)
+        self._refresh_interval = refresh_interval
+        self._refresher = None
+        self._read_sample_rate = read_sample_rate
+
+        live_counts = getattr(storage, 'live_counts', None)
+        self._live_counts = live_counts
+        if live_counts is not None and refresh_interval is None:
+            LIVE_BUCKETS.set_function(lambda: live_counts()[0])
+            LIVE_NCCOS.set_function(lambda: live_counts()[1])
+            LIVE_BYTES.set_function(lambda: live_counts()[2])
+
+        quotas = getattr(storage, 'quotas', None)
+        if quotas is not None:
+            for quota in quotas.__slots__:
+                limit = getattr(quotas, quota)
+                if limit is not None:
+                    QUOTA_LIMIT.labels(quota).set(limit)
+
+    def add_expiry_listener(self, listener):
+        self._storage.add_expiry_listener(listener)
+
+    def add_eviction_listener(self, listener):
+        self._storage.add_eviction_listener(listener)
+
+    async def open(self):
+        counts = await self._storage.open()
+        if self._live_counts is not None and self._refresh_interval is not None:
+            self._refresher = asyncio.ensure_future(self._refresh_live_counts())
+        return counts
+
+    async def close(self):
+        if self._refresher is not None:
+            self._refresher.cancel()
+            self._refresher = None
+        await self._storage.close()
 
     @time(UPDATE_TIME)
     async def create(self, name, ttl=None):
         UPDATE_REQUEST.inc()
-        with UPDATE_ERROR.count_exceptions():
-            result = await self._storage.create(name, ttl)
-            LIVE_BUCKETS.inc()
-            return result
+        with _count_errors(UPDATE_ERROR):
+            return await self._storage.create(name, ttl)
 
     async def exists(self, name):
         return await self._storage.exists(name)
@@ -38,34 +115,69 @@ class InstrumentedBucketStorage(object):
     @time(UPDATE_TIME)
     async def remove(self, name):
         UPDATE_REQUEST.inc()
-        with UPDATE_ERROR.count_exceptions():
-            bucket_info = await self._storage.remove(name)
-            if bucket_info is not None:
-                LIVE_BUCKETS.dec()
-                nccos_deleted = len(bucket_info)
-                # terrible way to decrement the ncco count
-                for _ in range(nccos_deleted):
-                    LIVE_NCCOS.dec()
-            return bucket_info
+        with _count_errors(UPDATE_ERROR):
+            return await self._storage.remove(name)
 
     @time(UPDATE_TIME)
     async def add_ncco(self, bucket_name, ncco):
         UPDATE_REQUEST.inc()
-        with UPDATE_ERROR.count_exceptions():
-            result = await self._storage.add_ncco(bucket_name, ncco)
-            LIVE_NCCOS.inc()
+        with _count_errors(UPDATE_ERROR):
+            return await self._storage.add_ncco(bucket_name, ncco)
+
+    @time(UPDATE_TIME)
+    async def add_nccos(self, bucket_name, nccos):
+        UPDATE_REQUEST.inc()
+        with _count_errors(UPDATE_ERROR):
+            result = await self._storage.add_nccos(bucket_name, nccos)
+            UPDATE_BATCH_ITEMS.inc(len(result))
             return result
 
-    @time(READ_TIME)
+    @time(UPDATE_TIME)
+    async def put_nccos(self, bucket_name, ncco_data):
+        UPDATE_REQUEST.inc()
+        with _count_errors(UPDATE_ERROR):
+            added = await self._storage.put_nccos(bucket_name, ncco_data)
+            UPDATE_BATCH_ITEMS.inc(len(ncco_data))
+            return added
+
+    async def scan_nccos(self, bucket_name, cursor=0, count=DEFAULT_SCAN_COUNT):
+        return await self._read(self._storage.scan_nccos(bucket_name, cursor, count))
+
     async def get_ncco(self, bucket_name, ncco_id):
-        READ_REQUEST.inc()
-        with READ_ERROR.count_exceptions():
-            return await self._storage.get_ncco(bucket_name, ncco_id)
+        return await self._read(self._storage.get_ncco(bucket_name, ncco_id))
+
+    async def get_ncco_with_ttl(self, bucket_name, ncco_id):
+        return await self._read(self._storage.get_ncco_with_ttl(bucket_name, ncco_id))
 
     @time(UPDATE_TIME)
     async def remove_ncco(self, bucket_name, ncco_id):
         UPDATE_REQUEST.inc()
-        with UPDATE_ERROR.count_exceptions():
-            result = await self._storage.remove_ncco(bucket_name, ncco_id)
-            LIVE_NCCOS.dec()
-            return result
+        with _count_errors(UPDATE_ERROR):
+            return await self._storage.remove_ncco(bucket_name, ncco_id)
+
+    async def bucket_stats(self, name):
+        return await self._read(self._storage.bucket_stats(name))
+
+    async def list_buckets(self, cursor=None, count=DEFAULT_LIST_COUNT):
+        return await self._read(self._storage.list_buckets(cursor, count))
+
+    async def _read(self, awaitable):
+        READ_REQUEST.inc()
+        with _count_errors(READ_ERROR):
+            return await timed(READ_TIME, awaitable, self._read_sample_rate)
+
+    async def _refresh_live_counts(self):
+        while True:
+            buckets, nccos, size_bytes = self._live_counts()
+            LIVE_BUCKETS.set(buckets)
+            LIVE_NCCOS.set(nccos)
+            LIVE_BYTES.set(size_bytes)
+            await asyncio.sleep(self._refresh_interval)
+
+    @staticmethod
+    def _on_expiry(_name, _ncco_data):
+        EXPIRED_BUCKETS.inc()
+
+    @staticmethod
+    def _on_eviction(_name, _ncco_data):
+        EVICTED_BUCKETS.inc()
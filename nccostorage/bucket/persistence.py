@@ -0,0 +1,454 @@
+"""
+Durability for the in-memory storage: every mutation is appended to a log
+and the log is periodically compacted into a snapshot.
+
+Files in the data directory:
+
+    snapshot    every live bucket and ncco, plus the index of the first log
+                that isn't covered by it, with ncco ids as 16 raw bytes
+    log.<n>     mutations in the order they were applied
+
+Both use the same binary record layout: a one byte op code followed by a
+fixed number of fields per op, each prefixed by its length as a
+little-endian uint32. Replaying records that are already part of the
+snapshot is harmless, as every op is idempotent when applied in order.
+"""
+import asyncio
+import contextlib
+import logging
+import mmap
+import os
+import struct
+import time
+
+from nccostorage.bucket.core import DEFAULT_LIST_COUNT, DEFAULT_SCAN_COUNT, DEFAULT_TTL
+
+_SNAPSHOT_MAGIC = b'NCCOSNAP2'
+# older snapshots, with ncco ids formatted like in the logs
+_SNAPSHOT_MAGIC_V1 = b'NCCOSNAP1'
+_SNAPSHOT_FILE = 'snapshot'
+_LOG_PREFIX = 'log.'
+
+_OP_CREATE = 1       # name, expires_at
+_OP_REMOVE = 2       # name
+_OP_ADD_NCCO = 3     # bucket name, ncco_id, ncco
+_OP_REMOVE_NCCO = 4  # bucket name, ncco_id
+_OP_NCCO = 5         # ncco_id (raw), ncco (snapshot only, belongs to the last bucket)
+
+_FIELD_COUNTS = {
+    _OP_CREATE: 2,
+    _OP_REMOVE: 1,
+    _OP_ADD_NCCO: 3,
+    _OP_REMOVE_NCCO: 2,
+    _OP_NCCO: 2,
+}
+
+_LENGTH = struct.Struct('<I')
+_OP = struct.Struct('<B')
+_EXPIRES_AT = struct.Struct('<d')
+_LOG_INDEX = struct.Struct('<Q')
+_RAW_ID_SIZE = 16
+
+DEFAULT_COMMIT_INTERVAL = 0.005
+DEFAULT_SNAPSHOT_THRESHOLD = 64 * 1024 * 1024
+
+
+def _encode(op, *fields):
+    parts = [_OP.pack(op)]
+    for field in fields:
+        if isinstance(field, str):
+            field = field.encode('utf-8')
+        parts.append(_LENGTH.pack(len(field)))
+        parts.append(field)
+    return b''.join(parts)
+
+
+def _decode(buf, offset=0):
+    """
+    Yields (op, fields) from buf, stopping at the first incomplete record.
+    """
+    end = len(buf)
+    unpack_length = _LENGTH.unpack_from
+    while offset < end:
+        op = buf[offset]
+        field_count = _FIELD_COUNTS.get(op)
+        if field_count is None:
+            return
+        offset += 1
+
+        fields = []
+        for _ in range(field_count):
+            if offset + 4 > end:
+                return
+            (length,) = unpack_length(buf, offset)
+            offset += 4
+            if offset + length > end:
+                return
+            fields.append(buf[offset:offset + length])
+            offset += length
+
+        yield op, fields
+
+
+@contextlib.contextmanager
+def _mapped(path):
+    """
+    Memory maps the file for reading, empty files can't be mapped so they yield b''.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b''
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield buf
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _parse_ncco_id(field):
+    # the int form the storage keys nccos by, from the formatted uuid
+    return int(bytes(field).replace(b'-', b''), 16)
+
+
+def _parse_raw_ncco_id(field):
+    return int.from_bytes(field, 'big')
+
+
+def _apply(buckets, op, fields):
+    if op == _OP_CREATE:
+        name = fields[0].decode('utf-8')
+        (expires_at,) = _EXPIRES_AT.unpack(fields[1])
+        buckets[name] = (expires_at, {})
+    elif op == _OP_REMOVE:
+        buckets.pop(fields[0].decode('utf-8'), None)
+    elif op == _OP_ADD_NCCO:
+        bucket = buckets.get(fields[0].decode('utf-8'))
+        if bucket is not None:
+            bucket[1][_parse_ncco_id(fields[1])] = bytes(fields[2])
+    elif op == _OP_REMOVE_NCCO:
+        bucket = buckets.get(fields[0].decode('utf-8'))
+        if bucket is not None:
+            bucket[1].pop(_parse_ncco_id(fields[1]), None)
+
+
+class PersistentBucketStorage(object):
+    """
+    Wraps a DictionaryBucketStorage and makes its mutations durable.
+
+    Mutations are applied in memory first and then wait until a background
+    task has written and fsync'ed them, batching every mutation that arrives
+    within commit_interval into a single write (group commit). Once the log
+    grows past snapshot_threshold bytes it is compacted into a new snapshot,
+    written by a task of its own while commits go on to a new log.
+    """
+
+    def __init__(self, storage, directory,
+                 commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 snapshot_threshold=DEFAULT_SNAPSHOT_THRESHOLD):
+        self._storage = storage
+        self._directory = directory
+        self._commit_interval = commit_interval
+        self._snapshot_threshold = snapshot_threshold
+
+        self._log = None
+        self._log_index = 0
+        self._log_size = 0
+
+        self._pending = []
+        self._commit_future = None
+        self._commit_wakeup = None
+        self._committer = None
+        self._snapshotter = None
+        self._closing = False
+
+        # unlike expired buckets, evicted ones would come back on replay
+        self._storage.add_eviction_listener(self._on_eviction)
+
+    def add_expiry_listener(self, listener):
+        self._storage.add_expiry_listener(listener)
+
+    def add_eviction_listener(self, listener):
+        self._storage.add_eviction_listener(listener)
+
+    @property
+    def quotas(self):
+        return self._storage.quotas
+
+    def live_counts(self):
+        return self._storage.live_counts()
+
+    async def open(self):
+        """
+        Replays the snapshot and log tail into the wrapped storage.
+        """
+        logger = logging.getLogger(__name__)
+        os.makedirs(self._directory, exist_ok=True)
+
+        start = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        buckets, next_log_index = await loop.run_in_executor(None, self._replay)
+
+        bucket_count, ncco_count = await self._storage.open()
+        now = time.time()
+        for name, (expires_at, nccos) in buckets.items():
+            ttl = expires_at - now
+            if ttl > 0:
+                await self._storage.restore(name, ttl, nccos)
+                bucket_count += 1
+                ncco_count += len(nccos)
+
+        logger.info(f'msg="restored storage" buckets={bucket_count} nccos={ncco_count} '
+                    f'elapsed={time.perf_counter() - start:.3f}')
+
+        self._open_log(next_log_index)
+        self._commit_wakeup = asyncio.Event()
+        self._committer = asyncio.ensure_future(self._commit_loop())
+
+        return bucket_count, ncco_count
+
+    async def close(self):
+        if self._committer is not None:
+            # let the committer flush whatever is pending before stopping
+            self._closing = True
+            self._commit_wakeup.set()
+            await self._committer
+            self._committer = None
+
+        if self._snapshotter is not None:
+            await self._snapshotter
+
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+        await self._storage.close()
+
+    async def create(self, name, ttl=None):
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        result = await self._storage.create(name, ttl)
+        expires_at = _EXPIRES_AT.pack(time.time() + ttl)
+        await self._append(_encode(_OP_CREATE, name, expires_at))
+        return result
+
+    async def exists(self, name):
+        return await self._storage.exists(name)
+
+    async def remove(self, name):
+        ncco_data = await self._storage.remove(name)
+        if ncco_data is not None:
+            await self._append(_encode(_OP_REMOVE, name))
+        return ncco_data
+
+    async def add_ncco(self, bucket_name, ncco):
+        ncco_id = await self._storage.add_ncco(bucket_name, ncco)
+        await self._append(_encode(_OP_ADD_NCCO, bucket_name, ncco_id, ncco))
+        return ncco_id
+
+    async def add_nccos(self, bucket_name, nccos):
+        ncco_ids = await self._storage.add_nccos(bucket_name, nccos)
+        if ncco_ids:
+            await self._append(b''.join(_encode(_OP_ADD_NCCO, bucket_name, ncco_id, ncco)
+                                        for ncco_id, ncco in zip(ncco_ids, nccos)))
+        return ncco_ids
+
+    async def put_nccos(self, bucket_name, ncco_data):
+        added = await self._storage.put_nccos(bucket_name, ncco_data)
+        if ncco_data:
+            await self._append(b''.join(_encode(_OP_ADD_NCCO, bucket_name, ncco_id, ncco)
+                                        for ncco_id, ncco in ncco_data.items()))
+        return added
+
+    async def scan_nccos(self, bucket_name, cursor=0, count=DEFAULT_SCAN_COUNT):
+        return await self._storage.scan_nccos(bucket_name, cursor, count)
+
+    async def get_ncco(self, bucket_name, ncco_id):
+        return await self._storage.get_ncco(bucket_name, ncco_id)
+
+    async def get_ncco_with_ttl(self, bucket_name, ncco_id):
+        return await self._storage.get_ncco_with_ttl(bucket_name, ncco_id)
+
+    async def remove_ncco(self, bucket_name, ncco_id):
+        ncco = await self._storage.remove_ncco(bucket_name, ncco_id)
+        if ncco is not None:
+            await self._append(_encode(_OP_REMOVE_NCCO, bucket_name, ncco_id))
+        return ncco
+
+    async def bucket_stats(self, name):
+        return await self._storage.bucket_stats(name)
+
+    async def list_buckets(self, cursor=None, count=DEFAULT_LIST_COUNT):
+        return await self._storage.list_buckets(cursor, count)
+
+    #
+    # Group commit
+    #
+
+    async def _append(self, record):
+        await asyncio.shield(self._enqueue(record))
+
+    def _enqueue(self, record):
+        """
+        Adds the record to the next commit, returning the future of that commit.
+        """
+        self._pending.append(record)
+
+        if self._commit_future is None:
+            self._commit_future = asyncio.get_event_loop().create_future()
+            self._commit_wakeup.set()
+
+        return self._commit_future
+
+    def _on_eviction(self, name, _ncco_data):
+        # evictions happen within a write, which waits for this commit too
+        self._enqueue(_encode(_OP_REMOVE, name))
+
+    def _take_pending(self):
+        data, future = b''.join(self._pending), self._commit_future
+        self._pending = []
+        self._commit_future = None
+        self._commit_wakeup.clear()
+        return data, future
+
+    async def _commit_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await self._commit_wakeup.wait()
+            if not self._closing:
+                # let concurrent mutations join this batch
+                await asyncio.sleep(self._commit_interval)
+
+            data, future = self._take_pending()
+            if future is not None:
+                try:
+                    await loop.run_in_executor(None, self._write, data)
+                except Exception as ex:
+                    # the writers get the error, a close waiting on this commit still has to stop
+                    future.set_exception(ex)
+                else:
+                    future.set_result(None)
+
+            if self._closing and not self._pending:
+                return
+
+            if self._log_size >= self._snapshot_threshold and self._snapshotter is None:
+                self._start_snapshot()
+
+    def _write(self, data):
+        self._log.write(data)
+        self._log.flush()
+        os.fsync(self._log.fileno())
+        self._log_size += len(data)
+
+    #
+    # Snapshots
+    #
+
+    def _start_snapshot(self):
+        # copy the state and switch logs without yielding to the loop, so the
+        # snapshot covers every record written to the logs it replaces. Only
+        # the committer calls this, so no write to the old log is in flight.
+        expires_base = time.time()
+        buckets = [(name, expires_base + ttl, nccos) for name, ttl, nccos in self._storage.dump()]
+        self._log.close()
+        self._open_log(self._log_index + 1)
+
+        self._snapshotter = asyncio.ensure_future(self._snapshot(buckets, self._log_index))
+
+    async def _snapshot(self, buckets, log_index):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, self._write_snapshot, buckets, log_index)
+        except Exception:
+            # the logs it would have replaced are kept, so nothing is lost
+            logger = logging.getLogger(__name__)
+            logger.exception(f'msg="failed to write snapshot" log_index={log_index}')
+        finally:
+            self._snapshotter = None
+
+    def _write_snapshot(self, buckets, log_index):
+        tmp_path = os.path.join(self._directory, _SNAPSHOT_FILE + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(_SNAPSHOT_MAGIC)
+            f.write(_LOG_INDEX.pack(log_index))
+            for name, expires_at, nccos in buckets:
+                f.write(_encode(_OP_CREATE, name, _EXPIRES_AT.pack(expires_at)))
+                f.writelines(_encode(_OP_NCCO, ncco_id.to_bytes(_RAW_ID_SIZE, 'big'), ncco)
+                             for ncco_id, ncco in nccos.items())
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, os.path.join(self._directory, _SNAPSHOT_FILE))
+        _fsync_directory(self._directory)
+
+        for index in self._log_indexes():
+            if index < log_index:
+                os.remove(self._log_path(index))
+
+    #
+    # Replay
+    #
+
+    def _replay(self):
+        buckets = {}
+        first_log_index = 0
+
+        snapshot_path = os.path.join(self._directory, _SNAPSHOT_FILE)
+        if os.path.exists(snapshot_path):
+            first_log_index = self._replay_snapshot(snapshot_path, buckets)
+
+        log_indexes = [index for index in self._log_indexes() if index >= first_log_index]
+        for index in log_indexes:
+            with _mapped(self._log_path(index)) as buf:
+                for op, fields in _decode(buf):
+                    _apply(buckets, op, fields)
+
+        next_log_index = max(log_indexes, default=first_log_index - 1) + 1
+        return buckets, next_log_index
+
+    @staticmethod
+    def _replay_snapshot(path, buckets):
+        with _mapped(path) as buf:
+            magic = buf[:len(_SNAPSHOT_MAGIC)]
+            if magic == _SNAPSHOT_MAGIC:
+                parse_ncco_id = _parse_raw_ncco_id
+            elif magic == _SNAPSHOT_MAGIC_V1:
+                parse_ncco_id = _parse_ncco_id
+            else:
+                raise ValueError(f'{path} is not a snapshot')
+
+            offset = len(_SNAPSHOT_MAGIC)
+            (log_index,) = _LOG_INDEX.unpack_from(buf, offset)
+
+            nccos = None
+            for op, fields in _decode(buf, offset + _LOG_INDEX.size):
+                if op == _OP_NCCO:
+                    nccos[parse_ncco_id(fields[0])] = bytes(fields[1])
+                else:
+                    _apply(buckets, op, fields)
+                    nccos = buckets[fields[0].decode('utf-8')][1]
+
+        return log_index
+
+    #
+    # Log files
+    #
+
+    def _log_path(self, index):
+        return os.path.join(self._directory, f'{_LOG_PREFIX}{index}')
+
+    def _log_indexes(self):
+        return sorted(int(f[len(_LOG_PREFIX):]) for f in os.listdir(self._directory)
+                      if f.startswith(_LOG_PREFIX) and f[len(_LOG_PREFIX):].isdigit())
+
+    def _open_log(self, index):
+        self._log = open(self._log_path(index), 'ab')
+        self._log_index = index
+        self._log_size = 0
@@ -0,0 +1,281 @@
+import time
+from uuid import uuid4 as uuid
+
+import redis.asyncio as aioredis
+
+from nccostorage.bucket.core import (DEFAULT_LIST_COUNT, DEFAULT_SCAN_COUNT, DEFAULT_TTL, BucketNotFoundError, BucketStats,
+                                     DuplicateBucketError)
+
+DEFAULT_KEY_PREFIX = 'nccostorage:'
+DEFAULT_MAX_CONNECTIONS = 50
+# more than the one name a create adds, so the index can't outgrow the live buckets by much
+DEFAULT_SWEEP_COUNT = 10
+
+# every bucket is a hash holding its nccos under prefixed fields plus a ttl
+# field, so that empty buckets still exist and carry the native key ttl, and
+# a size field with the total size of its nccos. Bucket names are also kept
+# in a sorted set, which is what listing pages through, and in another one
+# scored by when they expire, so creates can sweep the names of expired
+# buckets out of both.
+_TTL_FIELD = 'ttl'
+_SIZE_FIELD = 'size'
+_NCCO_FIELD_PREFIX = 'ncco:'
+
+# KEYS: bucket, index, expiries. ARGV: ttl, name, now, bucket key prefix, sweep count.
+# Names due to expire are only dropped once their key is really gone, as
+# our clock may be ahead of the server's.
+_CREATE_SCRIPT = """
+local now = tonumber(ARGV[3])
+local due = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now, 'LIMIT', 0, ARGV[5])
+for _, name in ipairs(due) do
+    local pttl = redis.call('PTTL', ARGV[4] .. name)
+    if pttl < 0 then
+        redis.call('ZREM', KEYS[2], name)
+        redis.call('ZREM', KEYS[3], name)
+    else
+        redis.call('ZADD', KEYS[3], tostring(now + pttl / 1000), name)
+    end
+end
+
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'ttl', ARGV[1], 'size', 0)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+redis.call('ZADD', KEYS[2], 0, ARGV[2])
+redis.call('ZADD', KEYS[3], tostring(now + ARGV[1]), ARGV[2])
+return 1
+"""
+
+# takes any number of field/ncco pairs, so batches are a single round-trip.
+# Returns -1 for a missing bucket, otherwise the number of new nccos.
+_PUT_NCCOS_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -1
+end
+local added = 0
+local delta = 0
+for i = 1, #ARGV, 2 do
+    delta = delta + string.len(ARGV[i + 1]) - redis.call('HSTRLEN', KEYS[1], ARGV[i])
+    added = added + redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HINCRBY', KEYS[1], 'size', delta)
+return added
+"""
+
+# returns {0} for a missing bucket, otherwise {1} followed by the removed ncco if there was one
+_REMOVE_NCCO_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return {0}
+end
+local ncco = redis.call('HGET', KEYS[1], ARGV[1])
+if not ncco then
+    return {1}
+end
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'size', -string.len(ncco))
+return {1, ncco}
+"""
+
+
+def _decode(value):
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def _ncco_field_for(ncco_id):
+    return f'{_NCCO_FIELD_PREFIX}{ncco_id}'
+
+
+class RedisBucketStorage(object):
+    """
+    Bucket storage on top of a Redis-protocol server.
+
+    Buckets expire through native key ttls, so expiry listeners are never
+    called: the server doesn't tell us when a key goes away. Memory is
+    bounded by the server's maxmemory, so there are no evictions either.
+    """
+
+    def __init__(self, client, key_prefix=DEFAULT_KEY_PREFIX, sweep_count=DEFAULT_SWEEP_COUNT, clock=time.time):
+        self._client = client
+        self._key_prefix = key_prefix
+        self._sweep_count = sweep_count
+        self._clock = clock
+        self._create_script = client.register_script(_CREATE_SCRIPT)
+        self._put_nccos_script = client.register_script(_PUT_NCCOS_SCRIPT)
+        self._remove_ncco_script = client.register_script(_REMOVE_NCCO_SCRIPT)
+
+    @classmethod
+    def from_url(cls, url, max_connections=DEFAULT_MAX_CONNECTIONS, key_prefix=DEFAULT_KEY_PREFIX):
+        pool = aioredis.ConnectionPool.from_url(url, max_connections=max_connections)
+        return cls(aioredis.Redis(connection_pool=pool), key_prefix=key_prefix)
+
+    def add_expiry_listener(self, listener):
+        pass
+
+    def add_eviction_listener(self, listener):
+        pass
+
+    async def open(self):
+        return 0, 0
+
+    async def close(self):
+        await self._client.aclose()
+
+    async def create(self, name, ttl=None):
+        if ttl is None:
+            ttl = DEFAULT_TTL
+
+        created = await self._create_script(keys=[self._bucket_key_for(name), self._index_key, self._expiries_key],
+                                            args=[ttl, name, self._clock(), self._bucket_key_for(''), self._sweep_count])
+        if not created:
+            raise DuplicateBucketError(f'duplicate bucket {name}')
+
+        return name
+
+    async def exists(self, name):
+        return await self._client.exists(self._bucket_key_for(name)) == 1
+
+    async def remove(self, name):
+        async with self._client.pipeline(transaction=True) as pipe:
+            key = self._bucket_key_for(name)
+            pipe.hgetall(key)
+            pipe.delete(key)
+            pipe.zrem(self._index_key, name)
+            pipe.zrem(self._expiries_key, name)
+            bucket_data, _, _, _ = await pipe.execute()
+
+        if not bucket_data:
+            return None
+
+        prefix_len = len(_NCCO_FIELD_PREFIX)
+        return {_decode(field)[prefix_len:]: ncco for field, ncco in bucket_data.items()
+                if _decode(field).startswith(_NCCO_FIELD_PREFIX)}
+
+    async def add_ncco(self, bucket_name, ncco):
+        ncco_ids = await self.add_nccos(bucket_name, [ncco])
+        return ncco_ids[0]
+
+    async def add_nccos(self, bucket_name, nccos):
+        ncco_ids = [str(uuid()) for _ in nccos]
+        await self.put_nccos(bucket_name, dict(zip(ncco_ids, nccos)))
+        return ncco_ids
+
+    async def put_nccos(self, bucket_name, ncco_data):
+        if not ncco_data:
+            # nothing to write, but a missing bucket is still an error
+            if not await self.exists(bucket_name):
+                raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+            return 0
+
+        args = []
+        for ncco_id, ncco in ncco_data.items():
+            args.append(_ncco_field_for(ncco_id))
+            args.append(ncco)
+
+        added = await self._put_nccos_script(keys=[self._bucket_key_for(bucket_name)], args=args)
+        if added < 0:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        return added
+
+    async def scan_nccos(self, bucket_name, cursor=0, count=DEFAULT_SCAN_COUNT):
+        """
+        HSCAN based, so a page may hold more or fewer than count nccos.
+        """
+        async with self._client.pipeline(transaction=True) as pipe:
+            key = self._bucket_key_for(bucket_name)
+            pipe.exists(key)
+            pipe.hscan(key, cursor, match=f'{_NCCO_FIELD_PREFIX}*', count=count)
+            exists, (next_cursor, fields) = await pipe.execute()
+
+        if not exists:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        prefix_len = len(_NCCO_FIELD_PREFIX)
+        return int(next_cursor), [(_decode(field)[prefix_len:], ncco) for field, ncco in fields.items()]
+
+    async def get_ncco(self, bucket_name, ncco_id):
+        async with self._client.pipeline(transaction=True) as pipe:
+            key = self._bucket_key_for(bucket_name)
+            pipe.exists(key)
+            pipe.hget(key, _ncco_field_for(ncco_id))
+            exists, ncco = await pipe.execute()
+
+        if not exists:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        return ncco
+
+    async def get_ncco_with_ttl(self, bucket_name, ncco_id):
+        async with self._client.pipeline(transaction=True) as pipe:
+            key = self._bucket_key_for(bucket_name)
+            pipe.pttl(key)
+            pipe.hget(key, _ncco_field_for(ncco_id))
+            pttl, ncco = await pipe.execute()
+
+        # -2 for a missing key, buckets always have a ttl
+        if pttl < 0:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        return ncco, pttl / 1000
+
+    async def remove_ncco(self, bucket_name, ncco_id):
+        result = await self._remove_ncco_script(keys=[self._bucket_key_for(bucket_name)], args=[_ncco_field_for(ncco_id)])
+        if not result[0]:
+            raise BucketNotFoundError(f'non-existing bucket {bucket_name}')
+
+        return result[1] if len(result) > 1 else None
+
+    async def bucket_stats(self, name):
+        stats = await self._stats_for([name])
+        return stats[0]
+
+    async def list_buckets(self, cursor=None, count=DEFAULT_LIST_COUNT):
+        """
+        Pages through the bucket index with ZRANGEBYLEX, dropping names whose bucket has expired.
+        """
+        start = '-' if cursor is None else f'({cursor}'
+        names = [_decode(name) for name in await self._client.zrangebylex(self._index_key, start, '+', start=0, num=count)]
+
+        stats = await self._stats_for(names)
+        expired = [name for name, bucket_stats in zip(names, stats) if bucket_stats is None]
+        if expired:
+            async with self._client.pipeline(transaction=False) as pipe:
+                pipe.zrem(self._index_key, *expired)
+                pipe.zrem(self._expiries_key, *expired)
+                await pipe.execute()
+
+        next_cursor = names[-1] if len(names) == count else None
+        return next_cursor, [bucket_stats for bucket_stats in stats if bucket_stats is not None]
+
+    async def _stats_for(self, names):
+        async with self._client.pipeline(transaction=False) as pipe:
+            for name in names:
+                key = self._bucket_key_for(name)
+                pipe.hmget(key, _TTL_FIELD, _SIZE_FIELD)
+                pipe.hlen(key)
+                pipe.pttl(key)
+            results = await pipe.execute()
+
+        now = time.time()
+        stats = []
+        for i, name in enumerate(names):
+            (ttl, size), fields, pttl = results[3 * i:3 * i + 3]
+            if pttl < 0:
+                stats.append(None)
+                continue
+            nccos = fields - 1 - (size is not None)
+            stats.append(BucketStats(name, nccos, int(size or 0), int(ttl), now + pttl / 1000))
+
+        return stats
+
+    @property
+    def _index_key(self):
+        return f'{self._key_prefix}buckets'
+
+    @property
+    def _expiries_key(self):
+        return f'{self._key_prefix}bucket_expiries'
+
+    def _bucket_key_for(self, name):
+        return f'{self._key_prefix}bucket:{name}'
@@ -0,0 +1,166 @@
+"""
+Shares one bucket storage between processes over a Unix socket.
+
+A single storage owner process serves the storage with serve_storage, every
+other process talks to it through a RemoteBucketStorage. Requests and
+responses are pickled frames prefixed by their length as a little-endian
+uint32; each connection handles one request at a time.
+"""
+import asyncio
+import logging
+import os
+import pickle
+import struct
+
+from nccostorage.bucket.core import DEFAULT_LIST_COUNT, DEFAULT_SCAN_COUNT
+
+DEFAULT_POOL_SIZE = 8
+
+# storage methods that can be called remotely
+_METHODS = frozenset(['create', 'exists', 'remove', 'add_ncco', 'add_nccos', 'put_nccos', 'scan_nccos',
+                      'get_ncco', 'get_ncco_with_ttl', 'remove_ncco', 'bucket_stats', 'list_buckets'])
+
+_FRAME_LENGTH = struct.Struct('<I')
+
+
+async def _read_frame(reader):
+    header = await reader.readexactly(_FRAME_LENGTH.size)
+    (length,) = _FRAME_LENGTH.unpack(header)
+    return pickle.loads(await reader.readexactly(length))
+
+
+def _write_frame(writer, message):
+    payload = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(_FRAME_LENGTH.pack(len(payload)) + payload)
+
+
+async def serve_storage(storage, path):
+    """
+    Starts serving the storage on a Unix socket at path and returns the asyncio server.
+    """
+    async def handle_connection(reader, writer):
+        logger = logging.getLogger(__name__)
+        try:
+            while True:
+                method, args = await _read_frame(reader)
+                if method not in _METHODS:
+                    _write_frame(writer, (False, AttributeError(f'unknown storage method {method}')))
+                else:
+                    try:
+                        result = await getattr(storage, method)(*args)
+                    except Exception as ex:
+                        _write_frame(writer, (False, ex))
+                    else:
+                        _write_frame(writer, (True, result))
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        except Exception:
+            logger.error('msg="failed to serve storage connection"', exc_info=True)
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    return await asyncio.start_unix_server(handle_connection, path=path)
+
+
+class RemoteBucketStorage(object):
+    """
+    Bucket storage served by another process, see serve_storage.
+
+    Expiry and eviction happen in the owner process, so their listeners are never called.
+    """
+
+    def __init__(self, path, pool_size=DEFAULT_POOL_SIZE):
+        self._path = path
+        self._pool_size = pool_size
+        self._connections = None
+        self._opened = 0
+
+    def add_expiry_listener(self, listener):
+        pass
+
+    def add_eviction_listener(self, listener):
+        pass
+
+    async def open(self):
+        return 0, 0
+
+    async def close(self):
+        if self._connections is None:
+            return
+
+        while not self._connections.empty():
+            _, writer = self._connections.get_nowait()
+            writer.close()
+            await writer.wait_closed()
+
+    async def create(self, name, ttl=None):
+        return await self._call('create', name, ttl)
+
+    async def exists(self, name):
+        return await self._call('exists', name)
+
+    async def remove(self, name):
+        return await self._call('remove', name)
+
+    async def add_ncco(self, bucket_name, ncco):
+        return await self._call('add_ncco', bucket_name, ncco)
+
+    async def add_nccos(self, bucket_name, nccos):
+        return await self._call('add_nccos', bucket_name, nccos)
+
+    async def put_nccos(self, bucket_name, ncco_data):
+        return await self._call('put_nccos', bucket_name, ncco_data)
+
+    async def scan_nccos(self, bucket_name, cursor=0, count=DEFAULT_SCAN_COUNT):
+        return await self._call('scan_nccos', bucket_name, cursor, count)
+
+    async def get_ncco(self, bucket_name, ncco_id):
+        return await self._call('get_ncco', bucket_name, ncco_id)
+
+    async def get_ncco_with_ttl(self, bucket_name, ncco_id):
+        return await self._call('get_ncco_with_ttl', bucket_name, ncco_id)
+
+    async def remove_ncco(self, bucket_name, ncco_id):
+        return await self._call('remove_ncco', bucket_name, ncco_id)
+
+    async def bucket_stats(self, name):
+        return await self._call('bucket_stats', name)
+
+    async def list_buckets(self, cursor=None, count=DEFAULT_LIST_COUNT):
+        return await self._call('list_buckets', cursor, count)
+
+    async def _call(self, method, *args):
+        reader, writer = await self._acquire()
+        try:
+            _write_frame(writer, (method, args))
+            await writer.drain()
+            ok, result = await _read_frame(reader)
+        except BaseException:
+            # the connection is in an unknown state, don't give it back
+            writer.close()
+            self._opened -= 1
+            raise
+
+        self._connections.put_nowait((reader, writer))
+
+        if not ok:
+            raise result
+        return result
+
+    async def _acquire(self):
+        if self._connections is None:
+            self._connections = asyncio.Queue()
+
+        if self._connections.empty() and self._opened < self._pool_size:
+            self._opened += 1
+            try:
+                return await asyncio.open_unix_connection(self._path)
+            except BaseException:
+                self._opened -= 1
+                raise
+
+        return await self._connections.get()
@@ -0,0 +1,152 @@
+"""
+Response compression negotiated from Accept-Encoding.
+
+Static nccos and cached renders are served as the very same bytes over and
+over, so their compressed variants are kept in a cache keyed by the body
+and computed once rather than on every request. Handlers mark those
+responses with mark_cacheable, any other body is compressed on the fly.
+
+gzip is always available, br only when brotli is installed.
+"""
+import collections
+import gzip
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_VARIANT_CACHE_BYTES = 8 * 1024 * 1024
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# response key set on responses whose body is worth keeping compressed variants of
+CACHEABLE = 'compression_cacheable'
+
+
+def _brotli():
+    # brotli is an optional dependency, br is only offered when it's installed
+    import brotli
+    return brotli
+
+
+def mark_cacheable(response):
+    """
+    Marks a response whose body is served as is over and over, so its compressed variants get cached.
+    """
+    response[CACHEABLE] = True
+    return response
+
+
+def available_encodings():
+    """
+    Returns the supported encodings, best first.
+    """
+    try:
+        _brotli()
+    except ImportError:
+        return ('gzip',)
+
+    return ('br', 'gzip')
+
+
+def negotiate(accept_encoding, encodings):
+    """
+    Returns the first of encodings that Accept-Encoding allows, or None to send the body as is.
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for encoding in encodings:
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def compress(body, encoding):
+    if encoding == 'gzip':
+        # no timestamp, so the same body always compresses to the same bytes
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == 'br':
+        return _brotli().compress(body, quality=BROTLI_QUALITY)
+
+    raise ValueError(f'unknown encoding {encoding}')
+
+
+class VariantCache(object):
+    """
+    LRU cache of the compressed variants of bodies, bounded by their total size in bytes.
+
+    The size counts the bodies used as keys along with their variants.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_VARIANT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        # body -> {encoding: compressed body}
+        self._entries = collections.OrderedDict()
+
+    def get(self, body, encoding):
+        variants = self._entries.get(body)
+        if variants is None:
+            return None
+
+        self._entries.move_to_end(body)
+        return variants.get(encoding)
+
+    def put(self, body, encoding, compressed):
+        if len(body) + len(compressed) > self.max_bytes:
+            return
+
+        variants = self._entries.get(body)
+        if variants is None:
+            variants = self._entries[body] = {}
+            self.size_bytes += len(body)
+        elif encoding in variants:
+            self.size_bytes -= len(variants[encoding])
+        variants[encoding] = compressed
+        self.size_bytes += len(compressed)
+
+        while self.size_bytes > self.max_bytes:
+            evicted_body, evicted = self._entries.popitem(last=False)
+            self.size_bytes -= len(evicted_body) + sum(len(variant) for variant in evicted.values())
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ResponseCompressor(object):
+    """
+    Compresses bodies of at least min_size bytes, going through the variant cache for cacheable ones if there is one.
+    """
+
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, cache=None, encodings=None):
+        self.min_size = min_size
+        self.encodings = encodings if encodings is not None else available_encodings()
+        self._cache = cache
+
+    def compress(self, body, encoding, cacheable=False):
+        """
+        Returns (compressed body, whether it came from the cache).
+        """
+        cache = self._cache if cacheable else None
+        if cache is not None:
+            compressed = cache.get(body, encoding)
+            if compressed is not None:
+                return compressed, True
+
+        compressed = compress(body, encoding)
+        if cache is not None:
+            cache.put(body, encoding, compressed)
+
+        return compressed, False
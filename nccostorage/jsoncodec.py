@@ -0,0 +1,37 @@
+"""
+JSON encoding and decoding shared by the api and the renderer.
+
+orjson is used when it is installed, otherwise the standard library. Both
+encode to compact utf-8 bytes, so responses can be sent without going
+through str first.
+"""
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# orjson's error subclasses the standard one, so this catches both
+JSONDecodeError = json.JSONDecodeError
+
+
+if orjson is not None:
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj)
+else:  # pragma: no cover
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def validate(data):
+    """
+    Raises JSONDecodeError unless data (str or bytes) is a valid json document.
+    """
+    loads(data)
@@ -0,0 +1,20 @@
+import random
+import time
+
+
+async def timed(histogram, awaitable, sample_rate=1.0):
+    """
+    Awaits awaitable and observes how long it took in histogram.
+
+    With a sample_rate below 1 only that fraction of the calls is observed,
+    which keeps the cost of histograms down on high-rate paths. Counters
+    should still be updated on every call.
+    """
+    if sample_rate < 1.0 and random.random() >= sample_rate:
+        return await awaitable
+
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        histogram.observe(time.perf_counter() - start)
@@ -1,8 +1,56 @@
 import logging
+import time
 
-from aiohttp import web
+from aiohttp import hdrs, web
+from aiohttp.helpers import ETag
+from prometheus_client import Counter, Gauge, Histogram
 
+from nccostorage import admission, compression
 from nccostorage.api.error import ApiError, to_response
+from nccostorage.api.response import json_response
+
+# most responses take well under a millisecond, so the buckets start at 100us
+_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+_SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# label for requests that matched no route, so unknown paths don't create new series
+_UNMATCHED_ROUTE = 'unmatched'
+
+# pylint: disable-msg=no-value-for-parameter
+REQUEST_TIME = Histogram('request_time', 'http request latency, middlewares included (in seconds)',
+                         ['route', 'method', 'status'], buckets=_LATENCY_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+REQUEST_SIZE = Histogram('request_size', 'http request body size (in bytes)',
+                         ['route', 'method'], buckets=_SIZE_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+RESPONSE_SIZE = Histogram('response_size', 'http response body size (in bytes)',
+                          ['route', 'method', 'status'], buckets=_SIZE_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+REQUESTS_IN_FLIGHT = Gauge('requests_in_flight', 'number of http requests being handled', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+COMPRESSION_SAVED_BYTES = Counter('response_compression_saved_bytes', 'bytes saved by compressing responses',
+                                  ['encoding'])
+# pylint: disable-msg=no-value-for-parameter
+COMPRESSION_VARIANT_HIT = Counter('response_compression_variant_hit', 'compressed variant cache hit rate')
+# pylint: disable-msg=no-value-for-parameter
+COMPRESSION_VARIANT_MISS = Counter('response_compression_variant_miss', 'compressed variant cache miss rate')
+# pylint: disable-msg=no-value-for-parameter
+ADMISSION_SHED = Counter('admission_shed', 'rate of requests rejected by admission control', ['priority'])
+# pylint: disable-msg=no-value-for-parameter
+ADMISSION_QUEUE_WAIT = Histogram('admission_queue_wait', 'time admitted requests waited for a slot (in seconds)',
+                                 ['priority'], buckets=_LATENCY_BUCKETS)
+# pylint: disable-msg=no-value-for-parameter
+ADMISSION_QUEUED = Gauge('admission_queued', 'number of requests waiting for a slot', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+ADMISSION_OVERLOADED = Gauge('admission_overloaded', '1 while the admission queue is standing', multiprocess_mode='liveall')
+
+_PRIORITY_LABELS = {
+    admission.PRIORITY_RENDER: 'render',
+    admission.PRIORITY_READ: 'read',
+    admission.PRIORITY_WRITE: 'write',
+}
+# seconds clients are told to wait before retrying a shed request
+_RETRY_AFTER = '1'
 
 
 def _lookup_handler(mappings, cls):
@@ -35,10 +83,150 @@ def create_error_handler(mappings):
     return error_handler
 
 
+def _route_label(request):
+    resource = request.match_info.route.resource
+    if resource is None:
+        return _UNMATCHED_ROUTE
+
+    # the route template, like /bucket/{bucket_id}, never the raw path
+    return resource.name or resource.canonical
+
+
+def _response_size(response):
+    if response.content_length is not None:
+        return response.content_length
+
+    # streamed responses have no length up front, but by now they are written
+    return response.body_length
+
+
+def create_metrics_handler():
+    """
+    Records latency, body sizes and concurrency of every request, labelled by route.
+
+    It has to be the outermost middleware, so its latency covers the other
+    middlewares and it sees the status errors were turned into.
+    """
+    @web.middleware
+    async def metrics_handler(request, handler):
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            response = await handler(request)
+        except web.HTTPException as ex:
+            _observe(request, start, ex.status, _response_size(ex))
+            raise
+        except BaseException:
+            _observe(request, start, 500, 0)
+            raise
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+
+        _observe(request, start, response.status, _response_size(response))
+        return response
+
+    return metrics_handler
+
+
+def _observe(request, start, status, response_size):
+    elapsed = time.perf_counter() - start
+    route, method = _route_label(request), request.method
+
+    REQUEST_TIME.labels(route, method, status).observe(elapsed)
+    REQUEST_SIZE.labels(route, method).observe(request.content_length or 0)
+    RESPONSE_SIZE.labels(route, method, status).observe(response_size)
+
+
+def _compressible(response, min_size):
+    if not isinstance(response, web.Response) or response.prepared or not isinstance(response.body, bytes):
+        return False
+
+    return len(response.body) >= min_size and hdrs.CONTENT_ENCODING not in response.headers
+
+
+def create_compression_handler(compressor):
+    """
+    Compresses response bodies of at least compressor.min_size bytes, as the request's Accept-Encoding allows.
+    """
+    @web.middleware
+    async def compression_handler(request, handler):
+        response = await handler(request)
+        if not _compressible(response, compressor.min_size):
+            return response
+
+        # caches must not hand a compressed body to a client that can't take it, or the other way around
+        response.headers.add(hdrs.VARY, hdrs.ACCEPT_ENCODING)
+        encoding = compression.negotiate(request.headers.get(hdrs.ACCEPT_ENCODING), compressor.encodings)
+        if encoding is None:
+            return response
+
+        body = response.body
+        cacheable = response.get(compression.CACHEABLE, False)
+        compressed, cached = compressor.compress(body, encoding, cacheable)
+        if cacheable:
+            (COMPRESSION_VARIANT_HIT if cached else COMPRESSION_VARIANT_MISS).inc()
+        if len(compressed) >= len(body):
+            return response
+
+        COMPRESSION_SAVED_BYTES.labels(encoding).inc(len(body) - len(compressed))
+        response.body = compressed
+        response.headers[hdrs.CONTENT_ENCODING] = encoding
+        # the compressed body isn't byte for byte the one the strong etag stands for
+        etag = response.etag
+        if etag is not None and not etag.is_weak:
+            response.etag = ETag(value=etag.value, is_weak=True)
+
+        return response
+
+    return compression_handler
+
+
+def _priority_for(request):
+    if _route_label(request).endswith('/render'):
+        return admission.PRIORITY_RENDER
+    if request.method in (hdrs.METH_GET, hdrs.METH_HEAD):
+        return admission.PRIORITY_READ
+    return admission.PRIORITY_WRITE
+
+
+def create_admission_handler(controller):
+    """
+    Admits requests through the AdmissionController, answering shed ones with a 503.
+
+    It runs right inside the metrics middleware, so shed requests are still
+    recorded but cost as little as possible.
+    """
+    def update_gauges():
+        # set rather than computed on scrape, which multiprocess metrics can't do
+        ADMISSION_QUEUED.set(controller.queued)
+        ADMISSION_OVERLOADED.set(int(controller.overloaded))
+
+    @web.middleware
+    async def admission_handler(request, handler):
+        priority = _priority_for(request)
+        try:
+            wait = await controller.acquire(priority)
+        except admission.AdmissionRejected:
+            update_gauges()
+            ADMISSION_SHED.labels(_PRIORITY_LABELS[priority]).inc()
+            response = to_response(ApiError('server is overloaded, retry later', status=503))
+            response.headers[hdrs.RETRY_AFTER] = _RETRY_AFTER
+            return response
+
+        update_gauges()
+        ADMISSION_QUEUE_WAIT.labels(_PRIORITY_LABELS[priority]).observe(wait)
+        try:
+            return await handler(request)
+        finally:
+            controller.release()
+
+    return admission_handler
+
+
 def requires_json(handler):
     async def middleware(request):
         if request.content_type != 'application/json':
-            return web.json_response({'status': 'error', 'text': 'request body must be json'}, status=400)
+            return json_response({'status': 'error', 'text': 'request body must be json'}, status=400)
 
         return await handler(request)
 
@@ -1,7 +1,32 @@
-from nccostorage.renderer import core
+from nccostorage.renderer import cache, core
 
 # ERRORS
 RenderError = core.RenderError
+InvalidNccoError = core.InvalidNccoError
+RenderTimeoutError = core.RenderTimeoutError
+RenderBudgetError = core.RenderBudgetError
 
 # Renderer implementation
 Jinja2NccoRenderer = core.Jinja2NccoRenderer
+SandboxedNccoRenderer = core.SandboxedNccoRenderer
+PooledNccoRenderer = core.PooledNccoRenderer
+CompiledNcco = core.CompiledNcco
+
+# Template cache
+TemplateCache = core.TemplateCache
+DEFAULT_TEMPLATE_CACHE_SIZE = core.DEFAULT_TEMPLATE_CACHE_SIZE
+
+# Render pool
+DEFAULT_INLINE_COMPLEXITY = core.DEFAULT_INLINE_COMPLEXITY
+DEFAULT_RENDER_TIMEOUT = core.DEFAULT_RENDER_TIMEOUT
+
+# Sandbox budgets
+DEFAULT_MAX_ITERATIONS = core.DEFAULT_MAX_ITERATIONS
+DEFAULT_MAX_OUTPUT_BYTES = core.DEFAULT_MAX_OUTPUT_BYTES
+DEFAULT_MAX_RENDER_TIME = core.DEFAULT_MAX_RENDER_TIME
+
+# Rendered output cache
+RenderCache = cache.RenderCache
+CachingNccoRenderer = cache.CachingNccoRenderer
+DEFAULT_RENDER_CACHE_BYTES = cache.DEFAULT_RENDER_CACHE_BYTES
+DEFAULT_RENDER_CACHE_TTL = cache.DEFAULT_RENDER_CACHE_TTL
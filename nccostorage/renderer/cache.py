@@ -0,0 +1,112 @@
+import collections
+import time
+
+DEFAULT_RENDER_CACHE_BYTES = 32 * 1024 * 1024
+DEFAULT_RENDER_CACHE_TTL = 60
+
+
+class RenderCache(object):
+    """
+    LRU cache of rendered bodies, bounded by their total size in bytes.
+
+    Entries also expire after ttl seconds, and can be dropped per ncco.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_RENDER_CACHE_BYTES, ttl=DEFAULT_RENDER_CACHE_TTL, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_bytes = 0
+        self._clock = clock
+        # key -> (expires_at, ncco, body)
+        self._entries = collections.OrderedDict()
+        # ncco -> keys of its renders
+        self._keys_by_ncco = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, _, body = entry
+        if expires_at <= self._clock():
+            self._remove(key)
+            return None
+
+        self._entries.move_to_end(key)
+        return body
+
+    def put(self, key, ncco, body):
+        """
+        Stores the body and returns the number of evicted entries.
+        """
+        if len(body) > self.max_bytes:
+            return 0
+
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (self._clock() + self.ttl, ncco, body)
+        self._keys_by_ncco.setdefault(ncco, set()).add(key)
+        self.size_bytes += len(body)
+
+        evicted = 0
+        while self.size_bytes > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            evicted += 1
+
+        return evicted
+
+    def discard_ncco(self, ncco):
+        for key in self._keys_by_ncco.pop(ncco, ()):
+            _, _, body = self._entries.pop(key)
+            self.size_bytes -= len(body)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, ncco, body = self._entries.pop(key)
+        self.size_bytes -= len(body)
+
+        keys = self._keys_by_ncco[ncco]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_ncco[ncco]
+
+
+class CachingNccoRenderer(object):
+    """
+    Serves repeated renders of the same templated ncco and params from a RenderCache.
+
+    Only the params the template references are part of the key, so extra
+    query params don't get in the way of a hit. Static nccos are not cached,
+    their body is already kept by the wrapped renderer.
+    """
+
+    caches_renders = True
+
+    def __init__(self, renderer, cache):
+        self._renderer = renderer
+        self._cache = cache
+
+    def prepare(self, ncco):
+        return self._renderer.prepare(ncco)
+
+    async def render(self, ncco, render_params):
+        compiled = self._renderer.prepare(ncco)
+        if compiled.is_static:
+            return await self._renderer.render(ncco, render_params)
+
+        key = (ncco, tuple((name, render_params.get(name)) for name in sorted(compiled.variables)))
+        body = self._cache.get(key)
+        if body is None:
+            body = await self._renderer.render(ncco, render_params)
+            self._cache.put(key, ncco, body)
+
+        return body
+
+    def invalidate(self, nccos):
+        nccos = list(nccos)
+        for ncco in nccos:
+            self._cache.discard_ncco(ncco)
+        self._renderer.invalidate(nccos)
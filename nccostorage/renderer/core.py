@@ -1,21 +1,602 @@
+import asyncio
+import collections
+import copy
+import functools
+import re
+import threading
+import time
+
 import jinja2
+from jinja2 import compiler, meta, nodes, runtime, sandbox
+
+from nccostorage import jsoncodec
+
+DEFAULT_TEMPLATE_CACHE_SIZE = 1024
+DEFAULT_INLINE_COMPLEXITY = 100
+DEFAULT_RENDER_TIMEOUT = 1.0
+
+DEFAULT_MAX_ITERATIONS = 10000
+DEFAULT_MAX_OUTPUT_BYTES = 1024 * 1024
+DEFAULT_MAX_RENDER_TIME = 0.1
+
+# loops and macros can run any number of times, so weigh them as much as a
+# template that is already big enough to be worth offloading
+_LOOP_COMPLEXITY = DEFAULT_INLINE_COMPLEXITY
+_LOOP_NODES = (nodes.For, nodes.Macro, nodes.CallBlock)
+
+# variables passed through these are meant to be optional
+_GUARD_FILTERS = frozenset(['default', 'd'])
+_GUARD_TESTS = frozenset(['defined', 'undefined'])
+
+# nodes that only ever evaluate some of their children, mapped to the ones they always do
+_CONDITIONAL_NODES = (
+    (nodes.If, ('test',)),
+    (nodes.CondExpr, ('test',)),
+    (nodes.And, ('left',)),
+    (nodes.Or, ('left',)),
+    (nodes.For, ('iter',)),
+    (nodes.Macro, ()),
+    (nodes.CallBlock, ('call',)),
+)
 
 
 class RenderError(Exception):
     pass
 
 
+class InvalidNccoError(Exception):
+    pass
+
+
+class RenderTimeoutError(Exception):
+    pass
+
+
+class RenderBudgetError(Exception):
+    pass
+
+
+class CompiledNcco(object):
+    """
+    Result of analysing an ncco once.
+
+    Static nccos carry their final json body and never touch jinja2, templated
+    ones carry the compiled template, the variables it references, those of
+    them it can't render without and a rough estimate of how expensive it is
+    to render.
+    """
+    __slots__ = ('body', 'template', 'variables', 'required_variables', 'complexity')
+
+    def __init__(self, body=None, template=None, variables=frozenset(), required_variables=None, complexity=0):
+        self.body = body
+        self.template = template
+        self.variables = variables
+        self.required_variables = required_variables if required_variables is not None else variables
+        self.complexity = complexity
+
+    @property
+    def is_static(self):
+        return self.template is None
+
+
+class TemplateCache(object):
+    """
+    Bounded LRU cache of compiled nccos, keyed by the ncco source.
+    """
+
+    def __init__(self, max_size=DEFAULT_TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self._templates = collections.OrderedDict()
+
+    def get(self, key):
+        template = self._templates.get(key)
+        if template is not None:
+            self._templates.move_to_end(key)
+        return template
+
+    def put(self, key, template):
+        """
+        Stores the template and returns the number of evicted entries.
+        """
+        self._templates[key] = template
+        self._templates.move_to_end(key)
+
+        evicted = 0
+        while len(self._templates) > self.max_size:
+            self._templates.popitem(last=False)
+            evicted += 1
+
+        return evicted
+
+    def discard(self, key):
+        return self._templates.pop(key, None) is not None
+
+    def __len__(self):
+        return len(self._templates)
+
+
+def _to_json_body(ncco):
+    # validated once and sent as is, there's no point in re-encoding it
+    body = ncco.encode('utf-8')
+    jsoncodec.validate(body)
+    return body
+
+
+def _guarded_variables(ast):
+    """
+    Returns the names of the variables passed to default or tested with is defined.
+    """
+    guarded = set()
+    for node in ast.find_all((nodes.Filter, nodes.Test)):
+        guards = _GUARD_FILTERS if isinstance(node, nodes.Filter) else _GUARD_TESTS
+        if node.name in guards and isinstance(node.node, nodes.Name):
+            guarded.add(node.node.name)
+    return guarded
+
+
+def _unconditional_variables(node):
+    """
+    Returns the names of the variables read whichever branches the template takes.
+    """
+    if isinstance(node, nodes.Name):
+        return {node.name} if node.ctx == 'load' else set()
+
+    children = None
+    for node_type, fields in _CONDITIONAL_NODES:
+        if isinstance(node, node_type):
+            children = [getattr(node, field) for field in fields]
+            break
+    if children is None:
+        children = node.iter_child_nodes()
+
+    names = set()
+    for child in children:
+        names.update(_unconditional_variables(child))
+    return names
+
+
 class Jinja2NccoRenderer(object):
 
-    def __init__(self):
-        self._env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+    def __init__(self, template_cache=None):
+        self._env = self._create_environment()
+        self._cache = template_cache if template_cache is not None else TemplateCache()
+
+    def _create_environment(self):
+        return jinja2.Environment(undefined=jinja2.StrictUndefined)
 
-    def render(self, ncco, render_params):
-        template = self._env.from_string(ncco)
+    def prepare(self, ncco):
+        """
+        Analyses and compiles the ncco, raising InvalidNccoError if it can never be rendered.
+        """
+        compiled = self._cache.get(ncco)
+        if compiled is None:
+            compiled = self._compile(ncco)
+            self._cache.put(ncco, compiled)
+
+        return compiled
+
+    async def render(self, ncco, render_params):
+        """
+        Renders the ncco and returns the resulting json body as bytes.
+        """
+        return self.render_compiled(self.prepare(ncco), render_params)
+
+    def render_compiled(self, compiled, render_params):
+        if compiled.is_static:
+            return compiled.body
+
+        if not compiled.required_variables.issubset(render_params.keys()):
+            raise RenderError('missing params while rendering ncco')
 
         try:
-            rendered_ncco = template.render(render_params)
+            rendered_ncco = self._render_template(compiled.template, render_params)
         except jinja2.exceptions.UndefinedError:
             raise RenderError('missing params while rendering ncco')
 
-        return rendered_ncco
+        try:
+            return _to_json_body(rendered_ncco)
+        except jsoncodec.JSONDecodeError:
+            raise InvalidNccoError('rendered ncco is not valid json')
+
+    def invalidate(self, nccos):
+        for ncco in nccos:
+            self._cache.discard(ncco)
+
+    def _render_template(self, template, render_params):
+        return template.render(render_params)
+
+    def _is_static(self, ncco):
+        env = self._env
+        delimiters = (env.variable_start_string, env.block_start_string, env.comment_start_string)
+        return not any(delimiter in ncco for delimiter in delimiters)
+
+    def _compile(self, ncco):
+        if self._is_static(ncco):
+            try:
+                return CompiledNcco(body=_to_json_body(ncco))
+            except jsoncodec.JSONDecodeError:
+                raise InvalidNccoError('ncco is not valid json')
+
+        try:
+            ast = self._env.parse(ncco)
+            template = self._env.from_string(ast)
+        except jinja2.exceptions.TemplateSyntaxError:
+            raise InvalidNccoError('ncco is not a valid template')
+
+        variables = meta.find_undeclared_variables(ast).difference(self._env.globals)
+        complexity = sum(_LOOP_COMPLEXITY if isinstance(node, _LOOP_NODES) else 1
+                         for node in ast.find_all(nodes.Node))
+        # a variable that is guarded anywhere or only used in some branches may
+        # well be missing, if it's needed after all StrictUndefined still
+        # catches it while rendering
+        required_variables = variables.intersection(_unconditional_variables(ast)).difference(_guarded_variables(ast))
+        return CompiledNcco(template=template, variables=frozenset(variables),
+                            required_variables=frozenset(required_variables), complexity=complexity)
+
+    def _settings(self):
+        """
+        Constructor arguments needed to create an equivalent renderer, as (name, value) pairs.
+        """
+        return ()
+
+    def __reduce__(self):
+        # compiled templates can't be pickled, a process pool gets its own renderer
+        return _process_local_renderer, (type(self), self._settings())
+
+
+_process_local_renderers = {}
+
+
+def _process_local_renderer(renderer_cls, settings):
+    key = (renderer_cls, settings)
+    renderer = _process_local_renderers.get(key)
+    if renderer is None:
+        renderer = _process_local_renderers[key] = renderer_cls(**dict(settings))
+    return renderer
+
+
+class _RenderBudget(object):
+    __slots__ = ('max_iterations', 'max_output_bytes', 'deadline', 'iterations')
+
+    def __init__(self, max_iterations, max_output_bytes, max_render_time):
+        self.max_iterations = max_iterations
+        self.max_output_bytes = max_output_bytes
+        self.deadline = time.perf_counter() + max_render_time
+        self.iterations = 0
+
+    def check_time(self):
+        if time.perf_counter() > self.deadline:
+            raise RenderBudgetError('ncco took too long to render')
+
+    def tick(self):
+        self.iterations += 1
+        if self.iterations > self.max_iterations:
+            raise RenderBudgetError('ncco went over its loop iteration budget')
+        self.check_time()
+
+
+# budget of the render running on the current thread
+_budgets = threading.local()
+
+
+def _budgeted_range(*args):
+    # iterating it in a loop is charged like any other iterable, this only
+    # stops a huge range from being turned into a list or summed in one go
+    values = range(*args)
+    if len(values) > _budgets.current.max_iterations:
+        raise RenderBudgetError('ncco went over its loop iteration budget')
+
+    return values
+
+
+def _budgeted_iter(iterable):
+    budget = _budgets.current
+    for value in iterable:
+        budget.tick()
+        yield value
+
+
+class _BudgetedCodeGenerator(compiler.CodeGenerator):
+    """
+    Compiles every for loop to iterate through environment.iterate, which charges each iteration,
+    and every ~ concatenation to go through environment.concat, which checks its size first.
+    """
+
+    def visit_For(self, node, frame):
+        # a copy, the parsed ast is still used to find the template variables
+        node = copy.copy(node)
+        node.iter = nodes.Call(nodes.EnvironmentAttribute('iterate', lineno=node.lineno), [node.iter], [], None, None,
+                               lineno=node.lineno)
+        super().visit_For(node, frame)
+
+    def visit_Concat(self, node, frame):
+        # the environment never autoescapes, so this is the plain str join the parent compiles to
+        self.visit(nodes.Call(nodes.EnvironmentAttribute('concat', lineno=node.lineno), node.nodes, [], None, None,
+                              lineno=node.lineno), frame)
+
+
+def _sequence_size(value):
+    return len(value) if isinstance(value, (str, bytes, list, tuple)) else None
+
+
+def _check_output_size(size):
+    if size > _budgets.current.max_output_bytes:
+        raise RenderBudgetError('ncco went over its output budget')
+
+
+# conversions of %-formatting and replacement fields of str.format, with their width and precision
+_PERCENT_CONVERSION = re.compile(r'%(?:\([^)]*\))?[#0\- +]*(\*|\d+)?(?:\.(\*|\d+))?')
+_FORMAT_FIELD = re.compile(r'\{[^{}]*(\{)?')
+_FORMAT_NUMBER = re.compile(r'\d+')
+
+
+def _check_format(format_string, args):
+    """
+    Checks the widths and precisions of a format string before it gets to pad anything.
+
+    Widths taken from the arguments, * in %-formatting or nested fields in
+    str.format, can only be checked against every int argument.
+    """
+    from_args = False
+    for match in _PERCENT_CONVERSION.finditer(format_string):
+        for size in match.groups():
+            if size == '*':
+                from_args = True
+            elif size is not None:
+                _check_output_size(int(size))
+    for match in _FORMAT_FIELD.finditer(format_string):
+        from_args = from_args or match.group(1) is not None
+        for size in _FORMAT_NUMBER.findall(match.group(0)):
+            _check_output_size(int(size))
+
+    if from_args:
+        for arg in args:
+            if isinstance(arg, int):
+                _check_output_size(arg)
+
+
+def _format_args(args):
+    if isinstance(args, tuple):
+        return args
+    if isinstance(args, dict):
+        return tuple(args.values())
+    return (args,)
+
+
+def _joined_size(items, separator):
+    return len(separator) * max(len(items) - 1, 0) + sum(len(item) for item in items if isinstance(item, str))
+
+
+def _replaced_size(s, old, new, count=-1):
+    occurrences = s.count(old)
+    if count is not None and count >= 0:
+        occurrences = min(occurrences, count)
+    return len(s) + occurrences * (len(new) - len(old))
+
+
+def _padded_size(s, width, *_args):
+    return max(len(s), width) if isinstance(width, int) else len(s)
+
+
+def _check_string_filter(name, args, kwargs):
+    """
+    Checks the result size of the filters that can grow a string, before they run.
+
+    Returns the args to call the filter with, join consumes its iterable here.
+    """
+    if name == 'replace':
+        s, old, new = (str(arg) for arg in args[:3])
+        _check_output_size(_replaced_size(s, old, new, *args[3:4], **kwargs))
+    elif name == 'indent':
+        s = str(args[0])
+        width = kwargs.get('width', args[1] if len(args) > 1 else 4)
+        pad = width if isinstance(width, int) else len(str(width))
+        _check_output_size(len(s) + (s.count('\n') + 1) * pad)
+    elif name == 'center':
+        _check_output_size(_padded_size(str(args[0]), kwargs.get('width', args[1] if len(args) > 1 else 80)))
+    elif name == 'format':
+        _check_format(str(args[0]), args[1:] + tuple(kwargs.values()))
+    elif name == 'join':
+        items = list(args[0])
+        _check_output_size(_joined_size(items, str(kwargs.get('d', args[1] if len(args) > 1 else ''))))
+        return (items,) + args[1:]
+
+    return args
+
+
+def _budgeted_filter(name, function, pass_context):
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if pass_context:
+            return function(args[0], *_check_string_filter(name, args[1:], kwargs), **kwargs)
+        return function(*_check_string_filter(name, args, kwargs), **kwargs)
+
+    return wrapper
+
+
+# filters that can grow a string, and whether they take the eval context first
+_GROWING_FILTERS = {'replace': True, 'indent': False, 'center': False, 'format': False, 'join': True}
+
+
+def _check_string_method(method, args, kwargs):
+    """
+    Checks the result size of the str methods that can grow a string, before they run.
+
+    Returns the args to call the method with, join consumes its iterable here.
+    """
+    s = method.__self__
+    name = method.__name__
+    if name == 'replace' and len(args) >= 2:
+        _check_output_size(_replaced_size(s, str(args[0]), str(args[1]), *args[2:3]))
+    elif name in ('center', 'ljust', 'rjust', 'zfill') and args:
+        _check_output_size(_padded_size(s, args[0]))
+    elif name == 'expandtabs':
+        tab_size = args[0] if args and isinstance(args[0], int) else 8
+        _check_output_size(len(s) + s.count('\t') * tab_size)
+    elif name == 'join' and args:
+        items = list(args[0])
+        _check_output_size(_joined_size(items, s))
+        return (items,) + args[1:]
+    elif name == 'format':
+        _check_format(s, args + tuple(kwargs.values()))
+    elif name == 'format_map' and args:
+        _check_format(s, _format_args(args[0]))
+
+    return args
+
+
+class _BudgetedEnvironment(sandbox.SandboxedEnvironment):
+    """
+    Sandbox that charges loops, calls and repetition against the current render budget.
+    """
+    code_generator_class = _BudgetedCodeGenerator
+    intercepted_binops = frozenset(['+', '*', '**', '%'])
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.globals['range'] = _budgeted_range
+        # results are checked before the filters allocate them, the time and
+        # output checks only run once they are done
+        for name, pass_context in _GROWING_FILTERS.items():
+            self.filters[name] = _budgeted_filter(name, self.filters[name], pass_context)
+
+    @staticmethod
+    def iterate(iterable):
+        return _budgeted_iter(iterable)
+
+    @staticmethod
+    def concat(*values):
+        values = [str(value) for value in values]
+        _check_output_size(sum(len(value) for value in values))
+        return ''.join(values)
+
+    # positional only, like the parent, so templates can pass any keyword argument
+    def call(*args, **kwargs):
+        _budgets.current.check_time()
+        if len(args) >= 3:
+            callee = args[2]
+            if len(args) == 4 and isinstance(callee, runtime.LoopContext):
+                # loop(...) in a recursive loop iterates its argument without going through visit_For
+                args = args[:3] + (_budgeted_iter(args[3]),)
+            elif isinstance(getattr(callee, '__self__', None), str):
+                args = args[:3] + _check_string_method(callee, args[3:], kwargs)
+        return sandbox.SandboxedEnvironment.call(*args, **kwargs)
+
+    def call_binop(self, context, operator, left, right):
+        budget = _budgets.current
+        if operator == '*':
+            for sequence, times in ((left, right), (right, left)):
+                size = _sequence_size(sequence)
+                if size is not None and isinstance(times, int) and size * times > budget.max_output_bytes:
+                    raise RenderBudgetError('ncco went over its output budget')
+        elif operator == '+':
+            left_size, right_size = _sequence_size(left), _sequence_size(right)
+            if left_size is not None and right_size is not None:
+                _check_output_size(left_size + right_size)
+        elif operator == '**':
+            # the result of an int power grows with the exponent, past the output budget it can't be printed anyway
+            if isinstance(left, int) and isinstance(right, int) and right > 0:
+                _check_output_size(max(left.bit_length(), 1) * right // 8)
+        elif operator == '%' and isinstance(left, str):
+            _check_format(left, _format_args(right))
+
+        return super().call_binop(context, operator, left, right)
+
+
+class SandboxedNccoRenderer(Jinja2NccoRenderer):
+    """
+    Renders in a jinja2 sandbox, within loop iteration, output size and time budgets.
+
+    Every loop iteration is charged, so are function calls, and the time and
+    output size are checked after every chunk of output. Operations that can
+    grow a string, like repetition, formatting, padding, replace and join, are
+    checked against the output budget before they allocate. Anything over
+    budget raises RenderBudgetError, and unsafe operations raise InvalidNccoError.
+    """
+
+    def __init__(self, template_cache=None,
+                 max_iterations=DEFAULT_MAX_ITERATIONS,
+                 max_output_bytes=DEFAULT_MAX_OUTPUT_BYTES,
+                 max_render_time=DEFAULT_MAX_RENDER_TIME):
+        self._max_iterations = max_iterations
+        self._max_output_bytes = max_output_bytes
+        self._max_render_time = max_render_time
+        super().__init__(template_cache=template_cache)
+
+    def _create_environment(self):
+        return _BudgetedEnvironment(undefined=jinja2.StrictUndefined)
+
+    def _render_template(self, template, render_params):
+        budget = _RenderBudget(self._max_iterations, self._max_output_bytes, self._max_render_time)
+        _budgets.current = budget
+
+        chunks = []
+        output_size = 0
+        try:
+            for chunk in template.generate(render_params):
+                output_size += len(chunk)
+                if output_size > budget.max_output_bytes:
+                    raise RenderBudgetError('ncco went over its output budget')
+                budget.check_time()
+                chunks.append(chunk)
+        except sandbox.SecurityError:
+            raise InvalidNccoError('ncco uses operations that are not allowed')
+        finally:
+            _budgets.current = None
+
+        return ''.join(chunks)
+
+    def _settings(self):
+        return (('max_iterations', self._max_iterations),
+                ('max_output_bytes', self._max_output_bytes),
+                ('max_render_time', self._max_render_time))
+
+
+def _render_isolated(renderer, ncco, render_params):
+    return renderer.render_compiled(renderer.prepare(ncco), render_params)
+
+
+class PooledNccoRenderer(object):
+    """
+    Renders expensive nccos on an executor so they don't block the event loop.
+
+    Nccos with a complexity below inline_complexity are still rendered inline,
+    as handing them over would cost more than rendering them. Renders that
+    take longer than timeout raise RenderTimeoutError; a render that already
+    started keeps its worker busy until it finishes.
+
+    With a thread pool the templates compiled on the event loop are reused,
+    pass isolated=True for a process pool so workers compile their own.
+    """
+
+    def __init__(self, renderer, executor,
+                 inline_complexity=DEFAULT_INLINE_COMPLEXITY,
+                 timeout=DEFAULT_RENDER_TIMEOUT,
+                 isolated=False):
+        self._renderer = renderer
+        self._executor = executor
+        self._inline_complexity = inline_complexity
+        self._timeout = timeout
+        self._isolated = isolated
+
+    def prepare(self, ncco):
+        return self._renderer.prepare(ncco)
+
+    async def render(self, ncco, render_params):
+        compiled = self._renderer.prepare(ncco)
+        if compiled.complexity < self._inline_complexity:
+            return self._renderer.render_compiled(compiled, render_params)
+
+        loop = asyncio.get_event_loop()
+        if self._isolated:
+            future = loop.run_in_executor(self._executor, _render_isolated, self._renderer, ncco, dict(render_params))
+        else:
+            future = loop.run_in_executor(self._executor, self._renderer.render_compiled, compiled, render_params)
+
+        try:
+            return await asyncio.wait_for(future, self._timeout)
+        except asyncio.TimeoutError:
+            raise RenderTimeoutError('timed out rendering ncco')
+
+    def invalidate(self, nccos):
+        self._renderer.invalidate(nccos)
@@ -1,4 +1,10 @@
-from prometheus_client import Counter, Histogram
+import concurrent.futures
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from nccostorage.metrics import timed
+from nccostorage.renderer.core import RenderBudgetError
 
 # pylint: disable-msg=no-value-for-parameter
 TEMPLATE_REQUEST = Counter('template_count', 'template method call rate')
@@ -6,15 +12,161 @@ TEMPLATE_REQUEST = Counter('template_count', 'template method call rate')
 TEMPLATE_ERROR = Counter('template_error', 'template error rate')
 # pylint: disable-msg=no-value-for-parameter
 TEMPLATE_TIME = Histogram('template_time', 'template request latency (in seconds)')
+# pylint: disable-msg=no-value-for-parameter
+TEMPLATE_BUDGET_EXCEEDED = Counter('template_budget_exceeded', 'rate of renders stopped for going over their budget')
+# pylint: disable-msg=no-value-for-parameter
+TEMPLATE_CACHE_HIT = Counter('template_cache_hit', 'compiled ncco cache hit rate')
+# pylint: disable-msg=no-value-for-parameter
+TEMPLATE_CACHE_MISS = Counter('template_cache_miss', 'compiled ncco cache miss rate')
+# pylint: disable-msg=no-value-for-parameter
+TEMPLATE_CACHE_EVICTION = Counter('template_cache_eviction', 'compiled ncco cache eviction rate')
+# pylint: disable-msg=no-value-for-parameter
+TEMPLATE_CACHE_SIZE = Gauge('template_cache_size', 'number of compiled nccos in cache', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_CACHE_HIT = Counter('render_cache_hit', 'rendered ncco cache hit rate')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_CACHE_MISS = Counter('render_cache_miss', 'rendered ncco cache miss rate')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_CACHE_EVICTION = Counter('render_cache_eviction', 'rendered ncco cache eviction rate')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_CACHE_HIT_RATIO = Gauge('render_cache_hit_ratio', 'rendered ncco cache hits over lookups since start', multiprocess_mode='liveall')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_CACHE_ENTRIES = Gauge('render_cache_entries', 'number of rendered nccos in cache', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_CACHE_BYTES = Gauge('render_cache_bytes', 'size of the rendered nccos in cache (in bytes)', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_POOL_PENDING = Gauge('render_pool_pending', 'number of renders submitted to the pool and not finished yet', multiprocess_mode='livesum')
+# pylint: disable-msg=no-value-for-parameter
+RENDER_POOL_TIME = Histogram('render_pool_time', 'time renders spend in the pool, queueing included (in seconds)')
 
 
 class InstrumentedRenderer(object):
+    """
+    Renderer wrapper exporting render rates, errors and latencies.
+
+    Renders are the hottest path, sample_rate is the fraction of them observed in template_time.
+    """
 
-    def __init__(self, renderer):
+    def __init__(self, renderer, sample_rate=1.0):
         self._renderer = renderer
+        self._sample_rate = sample_rate
 
-    @TEMPLATE_TIME.time()
-    def render(self, ncco, render_params):
+    async def render(self, ncco, render_params):
         TEMPLATE_REQUEST.inc()
-        with TEMPLATE_ERROR.count_exceptions():
-            return self._renderer.render(ncco, render_params)
+        with TEMPLATE_ERROR.count_exceptions(), TEMPLATE_BUDGET_EXCEEDED.count_exceptions(RenderBudgetError):
+            return await timed(TEMPLATE_TIME, self._renderer.render(ncco, render_params), self._sample_rate)
+
+    def prepare(self, ncco):
+        return self._renderer.prepare(ncco)
+
+    def invalidate(self, nccos):
+        self._renderer.invalidate(nccos)
+
+    @property
+    def caches_renders(self):
+        return getattr(self._renderer, 'caches_renders', False)
+
+
+class InstrumentedTemplateCache(object):
+    """
+    Template cache wrapper exporting hits, misses, evictions and its size.
+
+    The size gauge is set on every change rather than read at scrape time,
+    multi-process metrics are read from files and never call back into the
+    process.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        TEMPLATE_CACHE_SIZE.set(len(cache))
+
+    def get(self, key):
+        template = self._cache.get(key)
+        if template is None:
+            TEMPLATE_CACHE_MISS.inc()
+        else:
+            TEMPLATE_CACHE_HIT.inc()
+        return template
+
+    def put(self, key, template):
+        evicted = self._cache.put(key, template)
+        if evicted:
+            TEMPLATE_CACHE_EVICTION.inc(evicted)
+        TEMPLATE_CACHE_SIZE.set(len(self._cache))
+        return evicted
+
+    def discard(self, key):
+        discarded = self._cache.discard(key)
+        if discarded:
+            TEMPLATE_CACHE_SIZE.set(len(self._cache))
+        return discarded
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class InstrumentedRenderCache(object):
+    """
+    Render cache wrapper exporting hits, misses, evictions and its size.
+
+    Gauges are set on every change, like those of InstrumentedTemplateCache.
+    """
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._hits = 0
+        self._lookups = 0
+        RENDER_CACHE_HIT_RATIO.set(0)
+        self._set_size()
+
+    def get(self, key):
+        body = self._cache.get(key)
+        self._lookups += 1
+        if body is None:
+            RENDER_CACHE_MISS.inc()
+            # expired entries are dropped by the lookup
+            self._set_size()
+        else:
+            self._hits += 1
+            RENDER_CACHE_HIT.inc()
+        RENDER_CACHE_HIT_RATIO.set(self._hits / self._lookups)
+        return body
+
+    def put(self, key, ncco, body):
+        evicted = self._cache.put(key, ncco, body)
+        if evicted:
+            RENDER_CACHE_EVICTION.inc(evicted)
+        self._set_size()
+        return evicted
+
+    def discard_ncco(self, ncco):
+        self._cache.discard_ncco(ncco)
+        self._set_size()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def _set_size(self):
+        RENDER_CACHE_ENTRIES.set(len(self._cache))
+        RENDER_CACHE_BYTES.set(self._cache.size_bytes)
+
+
+class InstrumentedExecutor(concurrent.futures.Executor):
+
+    def __init__(self, executor):
+        self._executor = executor
+
+    def submit(self, fn, *args, **kwargs):
+        RENDER_POOL_PENDING.inc()
+        start = time.perf_counter()
+
+        def on_done(_future):
+            RENDER_POOL_PENDING.dec()
+            RENDER_POOL_TIME.observe(time.perf_counter() - start)
+
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(on_done)
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        self._executor.shutdown(wait=wait, **kwargs)
@@ -0,0 +1,129 @@
+"""
+Multi-process serving.
+
+One storage owner process holds the buckets and serves them over a Unix
+socket, and N aiohttp workers share the listening port through
+SO_REUSEPORT and reach the storage through that socket. Metrics are written
+to PROMETHEUS_MULTIPROC_DIR by every process and aggregated on scrape.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import time
+
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+LIVE_COUNTS_REFRESH_INTERVAL = 1.0
+_CODEC_SETTINGS = ('compression', 'compression_threshold')
+
+
+def is_multiprocess():
+    return MULTIPROC_DIR_ENV in os.environ
+
+
+async def multiprocess_stats(_request):
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return web.Response(body=generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+def _run_storage_owner(config):
+    # imported here so the metrics are created once the multiprocess dir is set
+    from nccostorage import configure_logging, create_storage
+    from nccostorage.bucket.instrumentation import InstrumentedBucketStorage
+    from nccostorage.bucket.remote import serve_storage
+
+    configure_logging()
+    logger = logging.getLogger('nccostorage')
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # metrics are read from files on scrape, so the live gauges can't be computed then
+    storage = InstrumentedBucketStorage(create_storage(config['storage']),
+                                        refresh_interval=LIVE_COUNTS_REFRESH_INTERVAL,
+                                        read_sample_rate=config['storage'].get('latency_sample_rate', 1.0))
+    loop.run_until_complete(storage.open())
+    server = loop.run_until_complete(serve_storage(storage, config['storage']['socket']))
+    logger.info(f'msg="serving storage" socket={config["storage"]["socket"]}')
+
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    loop.run_forever()
+
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.run_until_complete(storage.close())
+
+
+def _run_worker(config, worker_id):
+    from nccostorage import create_app
+
+    app = create_app(config)
+    web.run_app(app,
+                host=config['server']['host'],
+                port=config['server']['port'],
+                reuse_port=True,
+                print=print if worker_id == 0 else None)
+
+
+def _wait_for_socket(path, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if not process.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError('storage owner process failed to start')
+        time.sleep(0.05)
+
+
+def run_workers(config, workers):
+    """
+    Serves the app from `workers` processes sharing one storage owner process.
+
+    PROMETHEUS_MULTIPROC_DIR has to be set before nccostorage is imported, as
+    metrics pick their storage when they are created.
+    """
+    if not is_multiprocess():
+        raise RuntimeError(f'{MULTIPROC_DIR_ENV} must be set to run multiple workers')
+
+    storage_config = dict(config['storage'])
+    storage_config.setdefault('socket', os.path.join(tempfile.mkdtemp(prefix='nccostorage-'), 'storage.sock'))
+
+    owner_config = dict(config, storage=storage_config)
+    worker_config = dict(config, storage={
+        'backend': 'remote',
+        'socket': storage_config['socket'],
+        # nccos are encoded and decoded in the workers, not in the owner
+        **{key: storage_config[key] for key in _CODEC_SETTINGS if key in storage_config},
+    })
+
+    owner = multiprocessing.Process(target=_run_storage_owner, args=(owner_config,), name='storage')
+    owner.start()
+    _wait_for_socket(storage_config['socket'], owner)
+
+    processes = [multiprocessing.Process(target=_run_worker, args=(worker_config, worker_id), name=f'worker-{worker_id}')
+                 for worker_id in range(workers)]
+    for process in processes:
+        process.start()
+
+    def stop(_signum, _frame):
+        for process in processes + [owner]:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for process in processes:
+        process.join()
+        multiprocess.mark_process_dead(process.pid)
+
+    # workers are gone, so nobody is using the storage anymore
+    if owner.is_alive():
+        owner.terminate()
+    owner.join()
+    multiprocess.mark_process_dead(owner.pid)
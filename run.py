@@ -1,22 +1,96 @@
-import aiohttp
+import argparse
+import os
 
-from nccostorage import create_app
+
+def _optional_int(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
 
 
 def read_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, help='number of worker processes sharing the port', default=1)
+
+    args = parser.parse_args()
+
     server_config = {
         'host': '0.0.0.0',
-        'port': 8080
+        'port': 8080,
+        'workers': args.workers,
+        # gzip, or br with brotli installed, for responses of at least compression_min_size bytes
+        'compression': os.environ.get('NCCOSTORAGE_RESPONSE_COMPRESSION', 'true') == 'true',
+        'compression_min_size': int(os.environ.get('NCCOSTORAGE_RESPONSE_COMPRESSION_MIN_SIZE', 1024)),
+        # compressed variants of repeated bodies, 0 compresses every response again
+        'compression_cache_bytes': int(os.environ.get('NCCOSTORAGE_RESPONSE_COMPRESSION_CACHE_BYTES', 8 * 1024 * 1024)),
+        # requests handled at once per worker, the rest queue renders first; 0, the default, lets every request in
+        'max_in_flight': int(os.environ.get('NCCOSTORAGE_MAX_IN_FLIGHT', 0)),
+        # queued requests are shed once their wait stays over this many seconds
+        'admission_target_wait': float(os.environ.get('NCCOSTORAGE_ADMISSION_TARGET_WAIT', 0.005)),
+    }
+    renderer_config = {
+        'template_cache_size': 1024,
+        # 'thread' or 'process' renders expensive nccos off the event loop
+        'pool': os.environ.get('NCCOSTORAGE_RENDER_POOL'),
+        # render in a jinja2 sandbox, within loop, output size and time budgets
+        'sandbox': os.environ.get('NCCOSTORAGE_RENDER_SANDBOX', 'false') == 'true',
+        # cache of rendered bodies, 0 disables it
+        'render_cache_bytes': int(os.environ.get('NCCOSTORAGE_RENDER_CACHE_BYTES', 0)),
+        'render_cache_ttl': float(os.environ.get('NCCOSTORAGE_RENDER_CACHE_TTL', 60)),
+        # fraction of renders observed in the latency histogram
+        'latency_sample_rate': float(os.environ.get('NCCOSTORAGE_LATENCY_SAMPLE_RATE', 1.0)),
+    }
+    storage_config = {
+        'backend': os.environ.get('NCCOSTORAGE_STORAGE_BACKEND', 'memory'),
+        'url': os.environ.get('NCCOSTORAGE_REDIS_URL', 'redis://localhost:6379/0'),
+        'directory': os.environ.get('NCCOSTORAGE_DATA_DIR'),
+        # 'zlib' or 'zstd' compresses nccos bigger than compression_threshold bytes
+        'compression': os.environ.get('NCCOSTORAGE_NCCO_COMPRESSION'),
+        'compression_threshold': 1024,
+        # fraction of reads observed in the latency histogram
+        'latency_sample_rate': float(os.environ.get('NCCOSTORAGE_LATENCY_SAMPLE_RATE', 1.0)),
+        # quotas of the in-memory storage, unset for no limit; sizes are stored bytes
+        'max_buckets': _optional_int('NCCOSTORAGE_MAX_BUCKETS'),
+        'max_nccos_per_bucket': _optional_int('NCCOSTORAGE_MAX_NCCOS_PER_BUCKET'),
+        'max_ncco_bytes': _optional_int('NCCOSTORAGE_MAX_NCCO_BYTES'),
+        'max_total_bytes': _optional_int('NCCOSTORAGE_MAX_TOTAL_BYTES'),
+        'memory_budget': _optional_int('NCCOSTORAGE_MEMORY_BUDGET'),
+        'eviction_policy': os.environ.get('NCCOSTORAGE_EVICTION_POLICY', 'expiry'),
     }
     return {
         'server': server_config,
+        'renderer': renderer_config,
+        'storage': storage_config,
     }
 
 
-if __name__ == '__main__':
-    config = read_config()
+def run_single(config):
+    import aiohttp
+
+    from nccostorage import create_app
+
     app = create_app(config)
 
     aiohttp.web.run_app(app,
                         host=config['server']['host'],
                         port=config['server']['port'])
+
+
+def run_multiple(config):
+    import tempfile
+
+    # metrics have to be aggregated across processes, which prometheus_client
+    # only does if this is set before any metric is created
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', tempfile.mkdtemp(prefix='nccostorage-metrics-'))
+
+    from nccostorage.workers import run_workers
+
+    run_workers(config, config['server']['workers'])
+
+
+if __name__ == '__main__':
+    config = read_config()
+
+    if config['server']['workers'] > 1:
+        run_multiple(config)
+    else:
+        run_single(config)
@@ -0,0 +1,63 @@
+"""
+Microbenchmark of DictionaryBucketStorage.get_ncco with and without the lock on the read path.
+
+    $ python tests/load/bench_get_ncco.py --reads 200000 --concurrency 100
+"""
+import argparse
+import asyncio
+import collections
+import time
+
+from nccostorage.bucket import DictionaryBucketStorage
+
+Config = collections.namedtuple('Config', ['reads', 'concurrency', 'nccos'])
+
+
+def read_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reads', type=int, help='total number of get_ncco calls per mode', default=200000)
+    parser.add_argument('--concurrency', type=int, help='number of concurrent readers', default=100)
+    parser.add_argument('--nccos', type=int, help='number of nccos stored in the bucket', default=1000)
+
+    args = parser.parse_args()
+
+    return Config(reads=args.reads, concurrency=args.concurrency, nccos=args.nccos)
+
+
+async def reader(storage, ncco_ids, reads):
+    for i in range(reads):
+        await storage.get_ncco('bench', ncco_ids[i % len(ncco_ids)])
+
+
+async def run_mode(config, lock_reads):
+    storage = DictionaryBucketStorage(lock_reads=lock_reads)
+    await storage.create('bench')
+    ncco_ids = [await storage.add_ncco('bench', '[{"action": "talk", "text": "Hello World!"}]')
+                for _ in range(config.nccos)]
+
+    reads_per_reader = config.reads // config.concurrency
+
+    start = time.perf_counter()
+    await asyncio.gather(*[reader(storage, ncco_ids, reads_per_reader) for _ in range(config.concurrency)])
+    elapsed = time.perf_counter() - start
+
+    await storage.close()
+
+    return reads_per_reader * config.concurrency / elapsed
+
+
+async def run_benchmark(config):
+    for mode, lock_reads in [('locked', True), ('lock-free', False)]:
+        throughput = await run_mode(config, lock_reads)
+        print(f'mode={mode} reads={config.reads} concurrency={config.concurrency} throughput={throughput:.0f}/s')
+
+
+def main():
+    config = read_config()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_benchmark(config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,304 @@
+"""
+Open-loop load test of the HTTP API, reporting latency percentiles and throughput as JSON.
+
+Requests are started on a fixed schedule, whether earlier ones have
+finished or not, and latency is measured from the time a request was due
+rather than when it was sent, so a stalled server shows up in the
+percentiles instead of quietly lowering the request rate.
+
+    $ python tests/load/bench_load.py --target http://localhost:8080 --rate 2000 --duration 30
+    $ python tests/load/bench_load.py --in-process --rate 500 --mix read=2,write=1,render=7 > after.json
+
+--in-process serves create_app through aiohttp.test_utils instead of a
+running server, for repeatable before/after comparisons.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import random
+import sys
+import time
+
+import aiohttp
+from aiohttp import test_utils
+
+Config = collections.namedtuple('Config', ['target', 'in_process', 'rate', 'duration', 'warmup', 'mix', 'templated',
+                                           'buckets', 'nccos', 'connections', 'max_outstanding', 'render_cache_bytes',
+                                           'seed', 'output'])
+
+OPERATIONS = ('read', 'write', 'render')
+PERCENTILES = (50, 90, 99, 99.9, 99.99, 100)
+
+STATIC_NCCO = '[{"action":"talk","text":"Hello World!","voiceName":"Amy"}]'
+TEMPLATED_NCCO = ('[{"action":"talk","text":"Hello {{name}}, you are caller {{caller}}","voiceName":"Amy"},'
+                  '{"action":"connect","endpoint":[{"type":"phone","number":"{{caller}}"}]}]')
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        operation, _, weight = part.partition('=')
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'unknown operation {operation}, expected one of {", ".join(OPERATIONS)}')
+        mix[operation] = float(weight or 1)
+
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('the mix needs at least one operation with a positive weight')
+    return mix
+
+
+def read_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--target', help='url of a running server', default='http://localhost:8080')
+    parser.add_argument('--in-process', action='store_true', help='serve create_app in this process instead of --target')
+    parser.add_argument('--rate', type=float, help='requests started per second', default=1000.0)
+    parser.add_argument('--duration', type=float, help='seconds of measured load', default=10.0)
+    parser.add_argument('--warmup', type=float, help='seconds of load before measuring', default=1.0)
+    parser.add_argument('--mix', type=parse_mix, help='weights of the operations, like read=2,write=1,render=7',
+                        default='read=2,write=1,render=7')
+    parser.add_argument('--templated', type=float, help='fraction of nccos that are templates', default=0.5)
+    parser.add_argument('--buckets', type=int, help='number of buckets seeded before the run', default=10)
+    parser.add_argument('--nccos', type=int, help='number of nccos seeded in every bucket', default=100)
+    parser.add_argument('--connections', type=int, help='maximum number of open connections', default=100)
+    parser.add_argument('--max-outstanding', type=int, help='requests in flight before new ones are dropped',
+                        default=10000)
+    parser.add_argument('--render-cache-bytes', type=int, help='render cache size of the in-process app', default=0)
+    parser.add_argument('--seed', type=int, help='seed of the operation and ncco choices', default=0)
+    parser.add_argument('--output', help='file to write the results to, stdout by default')
+
+    args = parser.parse_args()
+
+    return Config(target=args.target, in_process=args.in_process, rate=args.rate, duration=args.duration,
+                  warmup=args.warmup, mix=args.mix, templated=args.templated, buckets=args.buckets, nccos=args.nccos,
+                  connections=args.connections, max_outstanding=args.max_outstanding,
+                  render_cache_bytes=args.render_cache_bytes, seed=args.seed, output=args.output)
+
+
+class LatencyRecorder(object):
+    """
+    Latencies and outcomes of one operation.
+
+    Latencies are kept as they are and sorted when reported, so percentiles
+    are exact rather than bucketed, which a run of a few million requests
+    can afford.
+    """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self.statuses = collections.Counter()
+
+    def record(self, latency, status):
+        self.statuses[status] += 1
+        if status >= 400:
+            self.errors += 1
+        else:
+            self.latencies.append(latency)
+
+    def record_failure(self, error):
+        self.statuses[type(error).__name__] += 1
+        self.errors += 1
+
+    def report(self, duration):
+        latencies = sorted(self.latencies)
+        report = {
+            'requests': len(latencies) + self.errors,
+            'errors': self.errors,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+            'throughput': round(len(latencies) / duration, 1),
+            'latency_ms': {},
+        }
+        if latencies:
+            report['latency_ms']['mean'] = round(sum(latencies) / len(latencies) * 1000, 3)
+            for percentile in PERCENTILES:
+                index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+                name = 'max' if percentile == 100 else f'p{percentile:g}'
+                report['latency_ms'][name] = round(latencies[index] * 1000, 3)
+
+        return report
+
+
+class Workload(object):
+    """
+    Seeds buckets with static and templated nccos, then picks requests against them.
+    """
+
+    def __init__(self, config):
+        self._config = config
+        self._random = random.Random(config.seed)
+        self._operations = list(config.mix)
+        self._weights = [config.mix[operation] for operation in self._operations]
+        self._bucket_ids = []
+        # (bucket_id, ncco_id)
+        self._nccos = []
+
+    async def seed(self, client):
+        for i in range(self._config.buckets):
+            bucket_id = f'load-{self._config.seed}-{i}'
+            async with client.delete(f'/bucket/{bucket_id}') as resp:
+                await resp.read()
+            async with client.post('/bucket', json={'id': bucket_id}) as resp:
+                resp.raise_for_status()
+
+            nccos = [self._pick_ncco() for _ in range(self._config.nccos)]
+            async with client.post(f'/bucket/{bucket_id}/nccos', json=nccos) as resp:
+                resp.raise_for_status()
+                ncco_ids = (await resp.json())['ncco_ids']
+
+            self._bucket_ids.append(bucket_id)
+            self._nccos.extend((bucket_id, ncco_id) for ncco_id in ncco_ids)
+
+    async def cleanup(self, client):
+        for bucket_id in self._bucket_ids:
+            async with client.delete(f'/bucket/{bucket_id}') as resp:
+                await resp.read()
+
+    def next_request(self):
+        """
+        Returns the operation and the arguments of client.request for it.
+        """
+        operation = self._random.choices(self._operations, self._weights)[0]
+        if operation == 'write':
+            bucket_id = self._random.choice(self._bucket_ids)
+            return operation, ('POST', f'/bucket/{bucket_id}/ncco'), {'json': {'ncco': self._pick_ncco()}}
+
+        bucket_id, ncco_id = self._random.choice(self._nccos)
+        if operation == 'read':
+            return operation, ('GET', f'/bucket/{bucket_id}/ncco/{ncco_id}'), {}
+
+        params = {'name': f'caller-{self._random.randrange(100)}', 'caller': '447700900000'}
+        return operation, ('GET', f'/bucket/{bucket_id}/ncco/{ncco_id}/render'), {'params': params}
+
+    def _pick_ncco(self):
+        return TEMPLATED_NCCO if self._random.random() < self._config.templated else STATIC_NCCO
+
+
+async def send(client, recorders, operation, request_args, request_kwargs, due):
+    try:
+        async with client.request(*request_args, **request_kwargs) as resp:
+            # read the whole body, it's part of the response time and frees the connection
+            await resp.read()
+            status = resp.status
+    except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+        recorders[operation].record_failure(ex)
+    else:
+        recorders[operation].record(time.perf_counter() - due, status)
+
+
+async def run_load(client, workload, config, duration):
+    """
+    Starts config.rate requests a second for duration seconds and returns their recorders.
+    """
+    recorders = {operation: LatencyRecorder() for operation in config.mix}
+    outstanding = set()
+    dropped = 0
+
+    interval = 1 / config.rate
+    start = time.perf_counter()
+    for i in range(int(duration * config.rate)):
+        due = start + i * interval
+        delay = due - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if len(outstanding) >= config.max_outstanding:
+            dropped += 1
+            continue
+
+        task = asyncio.ensure_future(send(client, recorders, *workload.next_request(), due))
+        outstanding.add(task)
+        task.add_done_callback(outstanding.discard)
+
+    if outstanding:
+        await asyncio.gather(*outstanding)
+
+    return recorders, dropped, time.perf_counter() - start
+
+
+def build_report(config, recorders, dropped, elapsed):
+    operations = {operation: recorder.report(elapsed) for operation, recorder in recorders.items()}
+    total = LatencyRecorder()
+    for recorder in recorders.values():
+        total.latencies.extend(recorder.latencies)
+        total.errors += recorder.errors
+        total.statuses.update(recorder.statuses)
+
+    return {
+        'config': {
+            'mode': 'in-process' if config.in_process else config.target,
+            'rate': config.rate,
+            'duration': config.duration,
+            'mix': config.mix,
+            'templated': config.templated,
+            'buckets': config.buckets,
+            'nccos': config.nccos,
+            'connections': config.connections,
+            'seed': config.seed,
+        },
+        'elapsed': round(elapsed, 3),
+        'dropped': dropped,
+        'total': total.report(elapsed),
+        'operations': operations,
+    }
+
+
+def create_in_process_app(config):
+    from nccostorage import create_app
+
+    app = create_app({
+        'storage': {'backend': 'memory'},
+        'renderer': {
+            'template_cache_size': 1024,
+            'sandbox': True,
+            'render_cache_bytes': config.render_cache_bytes,
+        },
+    })
+    # the app logs to stdout, where the report goes
+    logging.getLogger('nccostorage').setLevel(logging.ERROR)
+    return app
+
+
+async def open_client(config):
+    connector = aiohttp.TCPConnector(limit=config.connections)
+    if config.in_process:
+        client = test_utils.TestClient(test_utils.TestServer(create_in_process_app(config)), connector=connector)
+        await client.start_server()
+        return client
+
+    return aiohttp.ClientSession(base_url=config.target, connector=connector)
+
+
+async def run(config):
+    client = await open_client(config)
+    try:
+        workload = Workload(config)
+        await workload.seed(client)
+
+        if config.warmup > 0:
+            await run_load(client, workload, config, config.warmup)
+        recorders, dropped, elapsed = await run_load(client, workload, config, config.duration)
+
+        await workload.cleanup(client)
+    finally:
+        await client.close()
+
+    return build_report(config, recorders, dropped, elapsed)
+
+
+def main():
+    config = read_config()
+
+    report = asyncio.run(run(config))
+
+    output = json.dumps(report, indent=2)
+    if config.output is None:
+        sys.stdout.write(output + '\n')
+    else:
+        with open(config.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Memory used by DictionaryBucketStorage holding many nccos in each storage layout.
+
+    repr        str(ncco) of the decoded json body, what used to be stored
+                when clients sent the ncco as a json array
+    str         the ncco source as a Python str
+    bytes       compact utf-8 json bytes, the NccoCodec format
+    zlib        bytes, zlib compressed above the codec threshold
+
+Besides the total, it reports the overhead per ncco: everything but the
+stored values themselves (bucket records, ncco ids and dict slots).
+
+    $ python tests/load/bench_memory.py --nccos 1000000
+"""
+import argparse
+import asyncio
+import collections
+import gc
+import sys
+import tracemalloc
+
+from nccostorage import jsoncodec
+from nccostorage.bucket import DictionaryBucketStorage, NccoCodec
+
+Config = collections.namedtuple('Config', ['nccos', 'buckets', 'actions', 'layouts'])
+
+LAYOUTS = ['repr', 'str', 'bytes', 'zlib']
+
+
+def read_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nccos', type=int, help='total number of stored nccos', default=1000000)
+    parser.add_argument('--buckets', type=int, help='number of buckets the nccos are spread over', default=1000)
+    parser.add_argument('--actions', type=int, help='number of actions in each ncco', default=2)
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=LAYOUTS)
+
+    args = parser.parse_args()
+
+    return Config(nccos=args.nccos, buckets=args.buckets, actions=args.actions, layouts=args.layouts)
+
+
+def build_ncco(i, actions):
+    ncco = [
+        {'action': 'talk', 'text': f'Hello caller number {i}, please hold.', 'voiceName': 'Amy'},
+        {'action': 'connect', 'eventUrl': [f'https://example.com/events/{i}'], 'from': '447700900000',
+         'endpoint': [{'type': 'phone', 'number': f'4477009{i % 100000:05d}'}]},
+    ]
+    return (ncco * actions)[:actions]
+
+
+def encoder_for(layout):
+    if layout == 'repr':
+        return str
+    elif layout == 'str':
+        return lambda ncco: jsoncodec.dumps(ncco).decode('utf-8')
+    elif layout == 'bytes':
+        codec = NccoCodec()
+    else:
+        codec = NccoCodec(compression='zlib', threshold=256)
+    return lambda ncco: codec.encode(jsoncodec.dumps(ncco).decode('utf-8'))
+
+
+async def measure(config, layout):
+    encode = encoder_for(layout)
+    nccos_per_bucket = config.nccos // config.buckets
+
+    gc.collect()
+    tracemalloc.start()
+    storage = DictionaryBucketStorage()
+    value_bytes = 0
+    for b in range(config.buckets):
+        await storage.create(f'bucket_{b}')
+        for n in range(nccos_per_bucket):
+            value = encode(build_ncco(b * nccos_per_bucket + n, config.actions))
+            value_bytes += sys.getsizeof(value)
+            await storage.add_ncco(f'bucket_{b}', value)
+
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    await storage.close()
+    return current, value_bytes, nccos_per_bucket * config.buckets
+
+
+async def run_benchmark(config):
+    for layout in config.layouts:
+        used, value_bytes, nccos = await measure(config, layout)
+        print(f'layout={layout} nccos={nccos} actions={config.actions} '
+              f'memory={used / 1024 / 1024:.1f}MiB per_ncco={used / nccos:.0f}B '
+              f'overhead_per_ncco={(used - value_bytes) / nccos:.0f}B')
+
+
+def main():
+    config = read_config()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_benchmark(config))
+
+
+if __name__ == '__main__':
+    main()
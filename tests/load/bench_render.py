@@ -0,0 +1,69 @@
+"""
+Microbenchmark of the render path: rendering an ncco and building its response body.
+
+Compares the previous path, which parsed the rendered ncco and dumped it
+again with the json module, against validating it once with jsoncodec and
+sending the rendered bytes as they are.
+
+    $ python tests/load/bench_render.py --renders 100000
+"""
+import argparse
+import collections
+import json
+import time
+
+from nccostorage import jsoncodec
+from nccostorage.renderer import Jinja2NccoRenderer
+
+Config = collections.namedtuple('Config', ['renders', 'actions'])
+
+
+def read_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renders', type=int, help='number of renders per mode', default=100000)
+    parser.add_argument('--actions', type=int, help='number of talk actions in the ncco', default=10)
+
+    args = parser.parse_args()
+
+    return Config(renders=args.renders, actions=args.actions)
+
+
+class RedumpingRenderer(Jinja2NccoRenderer):
+    """
+    Renders the way it was done before jsoncodec: json.loads followed by json.dumps.
+    """
+
+    def render_compiled(self, compiled, render_params):
+        rendered_ncco = self._render_template(compiled.template, render_params)
+        return json.dumps(json.loads(rendered_ncco)).encode('utf-8')
+
+
+def build_ncco(actions):
+    action = '{"action": "talk", "text": "Hello {{name}}, you are caller {{caller}}", "voiceName": "Amy", "bargeIn": false}'
+    return '[' + ', '.join([action] * actions) + ']'
+
+
+def run_mode(config, renderer):
+    ncco = build_ncco(config.actions)
+    params = {'name': 'World', 'caller': '447700900000'}
+    compiled = renderer.prepare(ncco)
+
+    start = time.perf_counter()
+    for _ in range(config.renders):
+        renderer.render_compiled(compiled, params)
+    elapsed = time.perf_counter() - start
+
+    return config.renders / elapsed
+
+
+def main():
+    config = read_config()
+
+    codec = 'orjson' if jsoncodec.orjson is not None else 'json'
+    for mode, renderer in [('redump', RedumpingRenderer()), (f'validate-{codec}', Jinja2NccoRenderer())]:
+        throughput = run_mode(config, renderer)
+        print(f'mode={mode} renders={config.renders} actions={config.actions} throughput={throughput:.0f}/s')
+
+
+if __name__ == '__main__':
+    main()
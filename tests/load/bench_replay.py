@@ -0,0 +1,74 @@
+"""
+Benchmark of PersistentBucketStorage startup replay, from the log and from a snapshot.
+
+    $ python tests/load/bench_replay.py --nccos 1000000 --buckets 1000
+"""
+import argparse
+import asyncio
+import collections
+import tempfile
+import time
+
+from nccostorage.bucket import DictionaryBucketStorage
+from nccostorage.bucket.persistence import PersistentBucketStorage
+
+Config = collections.namedtuple('Config', ['nccos', 'buckets', 'batch'])
+
+NCCO = '[{"action": "talk", "text": "Hello {{name}}, thanks for calling!"}]'
+
+
+def read_config():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nccos', type=int, help='total number of stored nccos', default=1000000)
+    parser.add_argument('--buckets', type=int, help='number of buckets the nccos are spread over', default=1000)
+    parser.add_argument('--batch', type=int, help='number of concurrent writes while populating', default=10000)
+
+    args = parser.parse_args()
+
+    return Config(nccos=args.nccos, buckets=args.buckets, batch=args.batch)
+
+
+async def open_storage(directory, **kwargs):
+    storage = PersistentBucketStorage(DictionaryBucketStorage(), directory, **kwargs)
+    start = time.perf_counter()
+    await storage.open()
+    return storage, time.perf_counter() - start
+
+
+async def populate(config, directory):
+    storage, _ = await open_storage(directory)
+    for bucket in range(config.buckets):
+        await storage.create(f'bucket-{bucket}')
+
+    for offset in range(0, config.nccos, config.batch):
+        await asyncio.gather(*[storage.add_ncco(f'bucket-{i % config.buckets}', NCCO)
+                               for i in range(offset, min(offset + config.batch, config.nccos))])
+
+    await storage.close()
+
+
+async def run_benchmark(config):
+    with tempfile.TemporaryDirectory() as directory:
+        await populate(config, directory)
+
+        storage, elapsed = await open_storage(directory, snapshot_threshold=0)
+        print(f'source=log nccos={config.nccos} replay_time={elapsed:.3f}s')
+
+        # any commit now goes past the threshold and compacts into a snapshot
+        await storage.create('compact')
+        await storage.close()
+
+        storage, elapsed = await open_storage(directory)
+        print(f'source=snapshot nccos={config.nccos} replay_time={elapsed:.3f}s')
+        await storage.close()
+
+
+def main():
+    config = read_config()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run_benchmark(config))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+
+from nccostorage import setup_middlewares
+from nccostorage.admission import (PRIORITY_READ, PRIORITY_RENDER, PRIORITY_WRITE, AdmissionController,
+                                   AdmissionRejected)
+
+
+async def test_queued_requests_are_admitted_by_priority():
+    controller = AdmissionController(max_in_flight=1, interval=1.0)
+    await controller.acquire(PRIORITY_READ)
+
+    admitted = []
+
+    async def request(priority):
+        await controller.acquire(priority)
+        admitted.append(priority)
+        controller.release()
+
+    tasks = [asyncio.ensure_future(request(priority)) for priority in (PRIORITY_WRITE, PRIORITY_READ, PRIORITY_RENDER)]
+    await asyncio.sleep(0)
+    assert controller.queued == 3
+
+    controller.release()
+    await asyncio.gather(*tasks)
+
+    assert admitted == [PRIORITY_RENDER, PRIORITY_READ, PRIORITY_WRITE]
+    assert (controller.in_flight, controller.queued) == (0, 0)
+
+
+async def test_standing_queue_sheds_requests():
+    controller = AdmissionController(max_in_flight=1, target=0.001, interval=0.01)
+    await controller.acquire(PRIORITY_READ)
+
+    # waits over target for a whole interval make the queue standing
+    for _ in range(2):
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire(PRIORITY_RENDER)
+    assert controller.overloaded
+
+    # writes don't even queue then
+    with pytest.raises(AdmissionRejected):
+        await asyncio.wait_for(controller.acquire(PRIORITY_WRITE), 0.0005)
+
+    controller.release()
+    assert await controller.acquire(PRIORITY_WRITE) == 0.0
+
+
+async def test_cancelled_waiter_is_skipped():
+    controller = AdmissionController(max_in_flight=1, interval=1.0)
+    await controller.acquire(PRIORITY_READ)
+
+    waiter = asyncio.ensure_future(controller.acquire(PRIORITY_READ))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    # the slot isn't handed to the request that went away
+    controller.release()
+    assert (controller.in_flight, controller.queued) == (0, 0)
+
+
+async def test_shed_requests_get_503(loop, aiohttp_client):
+    async def slow(_request):
+        await asyncio.sleep(0.05)
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_get('/slow', slow)
+    setup_middlewares(app, admission_controller=AdmissionController(max_in_flight=1, interval=0.01))
+    client = await aiohttp_client(app)
+
+    responses = await asyncio.gather(*[client.get('/slow') for _ in range(3)])
+
+    statuses = sorted(resp.status for resp in responses)
+    assert statuses == [200, 503, 503]
+    assert all(resp.headers['Retry-After'] == '1' for resp in responses if resp.status == 503)
@@ -1,5 +1,6 @@
 import pytest
 from aiohttp import web
+from prometheus_client import REGISTRY
 
 from nccostorage import api, setup_middlewares
 from nccostorage.bucket import BucketOperations, DictionaryBucketStorage
@@ -37,6 +38,18 @@ async def test_create_bucket_invalid_request(app_client):
     assert resp.status == 400
 
 
+async def test_create_bucket_invalid_id(app_client):
+    for bucket_id in (5, [1], {'a': 1}, ''):
+        resp = await app_client.post('/bucket', json={'id': bucket_id})
+        assert resp.status == 400
+
+    # nothing got stored, so string ids still work
+    resp = await app_client.post('/bucket', json={'id': 'my_bucket'})
+    assert resp.status == 201
+    resp = await app_client.get('/bucket')
+    assert [bucket['id'] for bucket in (await resp.json())['buckets']] == ['my_bucket']
+
+
 async def test_create_bucket_success(app_client):
     bucket_id = 'my_bucket'
     bucket_ttl = 360
@@ -89,3 +102,69 @@ async def test_delete_bucket_success(app_client):
 
     resp = await app_client.delete(f'/bucket/{bucket_id}')
     assert resp.status == 204
+
+
+async def test_list_buckets_pages(app_client):
+    for bucket_id in ['c', 'a', 'b', 'd', 'e']:
+        await app_client.post('/bucket', json={'id': bucket_id})
+
+    seen = []
+    params = {'limit': '2'}
+    while True:
+        resp = await app_client.get('/bucket', params=params)
+        assert resp.status == 200
+        body = await resp.json()
+        seen.append([bucket['id'] for bucket in body['buckets']])
+        if body['next_cursor'] is None:
+            break
+        params['cursor'] = body['next_cursor']
+
+    assert seen == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+async def test_list_buckets_invalid_limit(app_client):
+    for limit in ['0', '1001', 'many']:
+        resp = await app_client.get('/bucket', params={'limit': limit})
+        assert resp.status == 400
+
+
+async def test_lookup_bucket(app_client):
+    await app_client.post('/bucket', json={'id': 'my_bucket', 'ttl': 360})
+
+    buckets = app_client.server.app['buckets']
+    await buckets.get('my_bucket').add('[{"action":"talk"}]')
+
+    resp = await app_client.get('/bucket/my_bucket')
+    assert resp.status == 200
+
+    body = await resp.json()
+    assert body['id'] == 'my_bucket'
+    assert body['nccos'] == 1
+    # the stored size, including the digest the codec prefixes
+    assert body['size_bytes'] == len(buckets.codec.encode('[{"action":"talk"}]'))
+    assert body['ttl'] == 360
+    assert body['expires_at'] > 0
+
+    resp = await app_client.get('/bucket/idontexist')
+    assert resp.status == 404
+
+
+async def test_request_metrics_labelled_by_route(app_client):
+    def sample(name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    labels = {'route': '/bucket/{bucket_id}', 'method': 'GET'}
+    found, missing = sample('request_time_count', status='200', **labels), sample('request_time_count', status='404', **labels)
+    unmatched = sample('request_time_count', route='unmatched', method='GET', status='404')
+
+    await app_client.post('/bucket', json={'id': 'my_bucket'})
+    assert (await app_client.get('/bucket/my_bucket')).status == 200
+    assert (await app_client.get('/bucket/other_bucket')).status == 404
+    assert (await app_client.get('/not/a/route')).status == 404
+
+    # every bucket shares the route's series, unknown paths get a single one
+    assert sample('request_time_count', status='200', **labels) == found + 1
+    assert sample('request_time_count', status='404', **labels) == missing + 1
+    assert sample('request_time_count', route='unmatched', method='GET', status='404') == unmatched + 1
+    assert sample('response_size_count', status='200', **labels) >= 1
+    assert sample('requests_in_flight') == 0
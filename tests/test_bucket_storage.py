@@ -0,0 +1,298 @@
+import asyncio
+import collections
+import uuid
+
+import pytest
+
+from nccostorage.bucket import DictionaryBucketStorage, NccoTooLargeError, QuotaExceededError, Quotas
+from nccostorage.bucket.eviction import ExpiryIndex
+
+
+BucketRecord = collections.namedtuple('BucketRecord', ['name', 'deadline'])
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def test_expired_bucket_is_not_visible():
+    clock = FakeClock()
+    storage = DictionaryBucketStorage(clock=clock)
+    expired = []
+    storage.add_expiry_listener(lambda name, ncco_data: expired.append((name, len(ncco_data))))
+
+    await storage.create('my_bucket', ttl=60)
+    ncco_id = await storage.add_ncco('my_bucket', '[]')
+    assert await storage.exists('my_bucket')
+
+    clock.now = 45
+    assert await storage.get_ncco_with_ttl('my_bucket', ncco_id) == ('[]', 15)
+
+    clock.now = 60
+    assert not await storage.exists('my_bucket')
+    assert expired == [('my_bucket', 1)]
+
+    # the name can be reused once expired
+    await storage.create('my_bucket', ttl=60)
+    assert await storage.exists('my_bucket')
+
+    await storage.close()
+
+
+async def test_expiry_scheduler_evicts_buckets():
+    storage = DictionaryBucketStorage()
+    expired = []
+    storage.add_expiry_listener(lambda name, _ncco_data: expired.append(name))
+
+    await storage.create('short', ttl=0.01)
+    await storage.create('long', ttl=60)
+    await storage.create('shorter', ttl=0.005)
+
+    await asyncio.sleep(0.05)
+
+    assert expired == ['shorter', 'short']
+    assert await storage.exists('long')
+
+    await storage.close()
+
+
+async def test_removed_bucket_does_not_expire():
+    storage = DictionaryBucketStorage()
+    expired = []
+    storage.add_expiry_listener(lambda name, _ncco_data: expired.append(name))
+
+    await storage.create('my_bucket', ttl=0.01)
+    assert await storage.remove('my_bucket') == {}
+
+    await asyncio.sleep(0.05)
+
+    assert expired == []
+
+    await storage.close()
+
+
+async def test_removed_buckets_dont_pile_up_in_expiry_queue():
+    storage = DictionaryBucketStorage()
+    await storage.create('kept', ttl=60)
+
+    for _ in range(1000):
+        await storage.create('my_bucket', ttl=60)
+        await storage.remove('my_bucket')
+
+    assert len(storage._expiry_queue) <= 4
+    assert await storage.exists('kept')
+
+    await storage.close()
+
+
+async def test_ncco_ids():
+    storage = DictionaryBucketStorage()
+    await storage.create('my_bucket')
+    ncco_id = await storage.add_ncco('my_bucket', b'[]')
+
+    assert str(uuid.UUID(ncco_id)) == ncco_id
+    assert await storage.get_ncco('my_bucket', ncco_id) == b'[]'
+    assert await storage.get_ncco('my_bucket', 'not-an-id') is None
+    assert await storage.remove_ncco('my_bucket', 'not-an-id') is None
+
+    assert await storage.remove('my_bucket') == {uuid.UUID(ncco_id).int: b'[]'}
+
+    await storage.close()
+
+
+async def test_dump_and_restore():
+    clock = FakeClock()
+    storage = DictionaryBucketStorage(clock=clock)
+    await storage.create('my_bucket', ttl=60)
+    ncco_id = await storage.add_ncco('my_bucket', b'[]')
+
+    clock.now = 20
+    dumped = list(storage.dump())
+    assert dumped == [('my_bucket', 40, {uuid.UUID(ncco_id).int: b'[]'})]
+
+    restored = DictionaryBucketStorage(clock=clock)
+    for name, ttl, ncco_data in dumped:
+        await restored.restore(name, ttl, ncco_data)
+    assert await restored.get_ncco('my_bucket', ncco_id) == b'[]'
+
+    await storage.close()
+    await restored.close()
+
+
+async def test_add_nccos():
+    storage = DictionaryBucketStorage()
+    await storage.create('my_bucket')
+
+    ncco_ids = await storage.add_nccos('my_bucket', [b'[1]', b'[2]', b'[3]'])
+
+    assert [await storage.get_ncco('my_bucket', ncco_id) for ncco_id in ncco_ids] == [b'[1]', b'[2]', b'[3]']
+
+    await storage.close()
+
+
+async def test_scan_and_put_nccos():
+    storage = DictionaryBucketStorage()
+    await storage.create('my_bucket')
+    ncco_ids = await storage.add_nccos('my_bucket', [str(i).encode() for i in range(5)])
+
+    cursor, pages = 0, []
+    while True:
+        cursor, page = await storage.scan_nccos('my_bucket', cursor, count=2)
+        pages.append(page)
+        if cursor == 0:
+            break
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [ncco_id for page in pages for ncco_id, _ in page] == ncco_ids
+
+    await storage.create('copy')
+    assert await storage.put_nccos('copy', dict(page for page in pages[0])) == 2
+    assert await storage.put_nccos('copy', {ncco_ids[0]: b'x', ncco_ids[4]: b'4'}) == 1
+    assert await storage.get_ncco('copy', ncco_ids[0]) == b'x'
+
+    await storage.close()
+
+
+async def test_scan_survives_removals():
+    storage = DictionaryBucketStorage()
+    await storage.create('my_bucket')
+    ncco_ids = await storage.add_nccos('my_bucket', [str(i).encode() for i in range(8)])
+
+    cursor, page = await storage.scan_nccos('my_bucket', 0, count=3)
+    scanned = [ncco_id for ncco_id, _ in page]
+    # already scanned nccos, before and at the cursor, go away halfway
+    await storage.remove_ncco('my_bucket', ncco_ids[0])
+    cursor, page = await storage.scan_nccos('my_bucket', cursor, count=2)
+    scanned += [ncco_id for ncco_id, _ in page]
+    await storage.remove_ncco('my_bucket', ncco_ids[4])
+    await storage.remove_ncco('my_bucket', ncco_ids[1])
+    while cursor != 0:
+        cursor, page = await storage.scan_nccos('my_bucket', cursor, count=2)
+        scanned += [ncco_id for ncco_id, _ in page]
+
+    assert set(ncco_ids[5:]).issubset(scanned)
+    assert set(scanned) == set(ncco_ids)
+
+    await storage.close()
+
+
+async def test_bucket_stats_and_listing():
+    clock = FakeClock()
+    storage = DictionaryBucketStorage(clock=clock)
+    await storage.create('b_bucket', ttl=60)
+    await storage.create('a_bucket', ttl=120)
+
+    ncco_id = await storage.add_ncco('a_bucket', b'[1]')
+    await storage.add_nccos('a_bucket', [b'[22]', b'[333]'])
+    await storage.remove_ncco('a_bucket', ncco_id)
+
+    stats = await storage.bucket_stats('a_bucket')
+    assert (stats.name, stats.nccos, stats.size_bytes, stats.ttl) == ('a_bucket', 2, 9, 120)
+
+    cursor, page = await storage.list_buckets(count=1)
+    assert [stats.name for stats in page] == ['a_bucket']
+    cursor, page = await storage.list_buckets(cursor, count=1)
+    assert [stats.name for stats in page] == ['b_bucket']
+    assert cursor is None
+
+    # expired and removed buckets drop out of the listing
+    clock.now = 60
+    assert await storage.bucket_stats('b_bucket') is None
+    await storage.remove('a_bucket')
+    assert await storage.list_buckets() == (None, [])
+
+    await storage.close()
+
+
+async def test_quotas():
+    storage = DictionaryBucketStorage(quotas=Quotas(max_buckets=2, max_nccos_per_bucket=3, max_ncco_bytes=10,
+                                                    max_total_bytes=21))
+    await storage.create('my_bucket')
+    await storage.create('other_bucket')
+    with pytest.raises(QuotaExceededError):
+        await storage.create('third_bucket')
+
+    with pytest.raises(NccoTooLargeError):
+        await storage.add_ncco('my_bucket', b'[' + b'1' * 10 + b']')
+
+    ncco_ids = await storage.add_nccos('my_bucket', [b'[1]', b'[2]', b'[3]'])
+    with pytest.raises(QuotaExceededError):
+        await storage.add_ncco('my_bucket', b'[4]')
+    # replacing doesn't add nccos
+    assert await storage.put_nccos('my_bucket', {ncco_ids[0]: b'[0]'}) == 0
+
+    await storage.add_nccos('other_bucket', [b'[1,2,3,4]', b'[5]'])
+    with pytest.raises(QuotaExceededError):
+        await storage.add_ncco('other_bucket', b'[6,7]')
+    # a failed batch stores nothing
+    assert storage.live_counts() == (2, 5, 21)
+
+    await storage.remove('my_bucket')
+    assert storage.live_counts() == (1, 2, 12)
+    await storage.create('third_bucket')
+
+    await storage.close()
+
+
+async def fill_over_budget(storage, reads):
+    # three buckets fill the budget, a write to a fourth goes over it
+    ncco_ids = {}
+    for name, ttl in [('a', 30), ('b', 10), ('c', 20)]:
+        await storage.create(name, ttl=ttl)
+        ncco_ids[name] = await storage.add_ncco(name, b'[1]')
+    for name in reads:
+        await storage.get_ncco(name, ncco_ids[name])
+
+    await storage.create('d', ttl=5)
+    await storage.add_ncco('d', b'[1]')
+    return [name for name in 'abcd' if await storage.exists(name)]
+
+
+@pytest.mark.parametrize('policy, reads, kept', [
+    ('expiry', [], ['a', 'c', 'd']),
+    ('lru', ['b', 'a', 'c', 'b'], ['b', 'c', 'd']),
+    ('lfu', ['a', 'a', 'b', 'c', 'c'], ['a', 'c', 'd']),
+])
+async def test_eviction_policies(policy, reads, kept):
+    storage = DictionaryBucketStorage(memory_budget=9, eviction_policy=policy)
+    evicted = []
+    storage.add_eviction_listener(lambda name, ncco_data: evicted.append((name, len(ncco_data))))
+
+    assert await fill_over_budget(storage, reads) == kept
+    assert len(evicted) == 1 and evicted[0][1] == 1
+    assert storage.live_counts() == (3, 3, 9)
+
+    await storage.close()
+
+
+async def test_eviction_spares_written_bucket():
+    storage = DictionaryBucketStorage(memory_budget=6)
+    await storage.create('big', ttl=5)
+    await storage.create('small', ttl=60)
+    await storage.add_ncco('small', b'[1]')
+
+    # even the bucket closest to expiring stays when it's the one written to
+    await storage.add_nccos('big', [b'[1]', b'[2]', b'[3]'])
+    assert await storage.exists('big')
+    assert not await storage.exists('small')
+    # with nothing else left, the budget is exceeded rather than dropping the write
+    assert storage.live_counts() == (1, 3, 9)
+
+    await storage.close()
+
+
+def test_expiry_index_drops_removed_buckets():
+    index = ExpiryIndex()
+    kept = BucketRecord('kept', deadline=60)
+    index.add(kept)
+    for deadline in range(1000):
+        record = BucketRecord('my_bucket', deadline=deadline)
+        index.add(record)
+        index.remove(record)
+
+    assert len(index._heap) <= 4
+    assert index.victim() == 'kept'
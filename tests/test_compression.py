@@ -0,0 +1,99 @@
+import gzip
+
+import pytest
+from aiohttp import web
+from prometheus_client import REGISTRY
+
+from nccostorage import api, setup_middlewares
+from nccostorage.bucket import BucketOperations, DictionaryBucketStorage
+from nccostorage.compression import ResponseCompressor, VariantCache, compress, negotiate
+from nccostorage.renderer import Jinja2NccoRenderer
+
+NCCO = '[' + ','.join(['{"action":"talk","text":"Press 1 for sales, 2 for support, 3 for billing"}'] * 50) + ']'
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+@pytest.fixture
+def app_client(loop, aiohttp_client):
+    app = web.Application()
+    buckets = BucketOperations(DictionaryBucketStorage())
+    api.bucket.setup_routes(app, buckets)
+    api.ncco.setup_routes(app, buckets, Jinja2NccoRenderer())
+    setup_middlewares(app, ResponseCompressor(min_size=1024, cache=VariantCache(), encodings=('gzip',)))
+    return loop.run_until_complete(aiohttp_client(app, auto_decompress=False))
+
+
+def test_negotiate():
+    encodings = ('br', 'gzip')
+
+    assert negotiate('gzip, deflate, br', encodings) == 'br'
+    assert negotiate('gzip;q=0.5, br;q=0', encodings) == 'gzip'
+    assert negotiate('*', encodings) == 'br'
+    assert negotiate('identity', encodings) is None
+    assert negotiate(None, encodings) is None
+
+
+def test_variant_cache_is_bounded():
+    cache = VariantCache(max_bytes=1500)
+    first, second = b'a' * 1000, b'b' * 1000
+
+    cache.put(first, 'gzip', compress(first, 'gzip'))
+    cache.put(second, 'gzip', compress(second, 'gzip'))
+    assert len(cache) == 1
+    assert cache.get(first, 'gzip') is None
+    assert gzip.decompress(cache.get(second, 'gzip')) == second
+
+
+async def test_static_render_is_compressed_once(app_client):
+    await app_client.post('/bucket', json={'id': 'my_bucket'})
+    resp = await app_client.post('/bucket/my_bucket/ncco', json={'ncco': NCCO}, headers={'Accept-Encoding': 'identity'})
+    ncco_id = (await resp.json())['ncco_id']
+
+    hits, saved = sample('response_compression_variant_hit_total'), sample('response_compression_saved_bytes_total',
+                                                                            encoding='gzip')
+    for _ in range(2):
+        resp = await app_client.get(f'/bucket/my_bucket/ncco/{ncco_id}/render', headers={'Accept-Encoding': 'gzip'})
+        assert resp.status == 200
+        assert resp.headers['Content-Encoding'] == 'gzip'
+        assert resp.headers['Vary'] == 'Accept-Encoding'
+        assert gzip.decompress(await resp.read()) == NCCO.encode('utf-8')
+
+    assert sample('response_compression_variant_hit_total') == hits + 1
+    assert sample('response_compression_saved_bytes_total', encoding='gzip') > saved
+
+    # the compressed body weakens the etag, which still answers conditional requests
+    etag = resp.headers['ETag']
+    assert etag.startswith('W/')
+    resp = await app_client.get(f'/bucket/my_bucket/ncco/{ncco_id}/render',
+                                headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert resp.status == 304
+
+    resp = await app_client.get(f'/bucket/my_bucket/ncco/{ncco_id}/render', headers={'Accept-Encoding': 'identity'})
+    assert 'Content-Encoding' not in resp.headers
+    assert await resp.read() == NCCO.encode('utf-8')
+
+
+async def test_one_off_responses_are_not_cached(app_client):
+    await app_client.post('/bucket', json={'id': 'my_bucket'})
+    templated = NCCO.replace('sales', '{{name}}')
+    resp = await app_client.post('/bucket/my_bucket/ncco', json={'ncco': templated},
+                                 headers={'Accept-Encoding': 'identity'})
+    ncco_id = (await resp.json())['ncco_id']
+
+    misses = sample('response_compression_variant_miss_total')
+    for path in [f'/bucket/my_bucket/ncco/{ncco_id}', f'/bucket/my_bucket/ncco/{ncco_id}/render?name=x']:
+        resp = await app_client.get(path, headers={'Accept-Encoding': 'gzip'})
+        assert resp.headers['Content-Encoding'] == 'gzip'
+
+    assert sample('response_compression_variant_miss_total') == misses
+
+
+async def test_small_responses_are_not_compressed(app_client):
+    resp = await app_client.post('/bucket', json={'id': 'my_bucket'}, headers={'Accept-Encoding': 'gzip'})
+
+    assert resp.status == 201
+    assert 'Content-Encoding' not in resp.headers
+    assert 'Vary' not in resp.headers
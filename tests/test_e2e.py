@@ -1,6 +1,8 @@
 """
 Application end to end scenarios
 """
+import json
+
 from nccostorage import create_app
 
 
@@ -26,7 +28,8 @@ async def test_simple_storage_and_retrieval(aiohttp_client):
 
     ncco = await lookup_ncco(client, bucket_name, ncco_id)
 
-    assert ncco == test_ncco
+    # stored as compact json
+    assert ncco == json.dumps(json.loads(test_ncco), separators=(',', ':'))
 
     await remove_ncco(client, bucket_name, ncco_id)
 
@@ -0,0 +1,84 @@
+import pytest
+from prometheus_client import REGISTRY
+
+from nccostorage.bucket import BucketNotFoundError, DictionaryBucketStorage, DuplicateBucketError
+from nccostorage.bucket.instrumentation import InstrumentedBucketStorage
+from nccostorage.renderer import RenderCache, TemplateCache
+from nccostorage.renderer.instrumentation import InstrumentedRenderCache, InstrumentedTemplateCache
+
+
+def sample(name):
+    return REGISTRY.get_sample_value(name)
+
+
+async def test_live_gauges_follow_storage_counts():
+    storage = InstrumentedBucketStorage(DictionaryBucketStorage())
+    await storage.open()
+
+    await storage.create('my_bucket')
+    await storage.create('other_bucket')
+    await storage.add_nccos('my_bucket', [b'[]'] * 1000)
+    ncco_id = await storage.add_ncco('other_bucket', b'[]')
+    assert (sample('live_buckets'), sample('live_nccos')) == (2, 1001)
+
+    # removing something that isn't there must not move the gauge
+    assert await storage.remove_ncco('other_bucket', '00000000-0000-0000-0000-000000000000') is None
+    assert await storage.remove_ncco('other_bucket', ncco_id) == b'[]'
+    assert sample('live_nccos') == 1000
+
+    await storage.remove('my_bucket')
+    assert (sample('live_buckets'), sample('live_nccos')) == (1, 0)
+
+    await storage.close()
+
+
+async def test_read_latency_sampling():
+    storage = InstrumentedBucketStorage(DictionaryBucketStorage(), read_sample_rate=0.0)
+    await storage.create('my_bucket')
+
+    reads = sample('read_count_total')
+    observed = sample('read_time_count')
+    for _ in range(10):
+        await storage.get_ncco('my_bucket', 'some_id')
+
+    # every read is counted, none is timed
+    assert sample('read_count_total') == reads + 10
+    assert sample('read_time_count') == observed
+
+    await storage.close()
+
+
+async def test_missing_buckets_are_not_errors():
+    storage = InstrumentedBucketStorage(DictionaryBucketStorage())
+
+    read_errors, update_errors = sample('read_error_total'), sample('update_error_total')
+    with pytest.raises(BucketNotFoundError):
+        await storage.get_ncco('missing_bucket', 'some_id')
+    with pytest.raises(BucketNotFoundError):
+        await storage.add_ncco('missing_bucket', b'[]')
+    with pytest.raises(DuplicateBucketError):
+        for _ in range(2):
+            await storage.create('my_bucket')
+
+    assert sample('read_error_total') == read_errors
+    assert sample('update_error_total') == update_errors + 1
+
+    await storage.close()
+
+
+def test_cache_gauges_follow_changes():
+    templates = InstrumentedTemplateCache(TemplateCache())
+    renders = InstrumentedRenderCache(RenderCache())
+
+    templates.put('ncco', 'template')
+    assert sample('template_cache_size') == 1
+    templates.discard('ncco')
+    assert sample('template_cache_size') == 0
+
+    renders.put('key', 'ncco', b'body')
+    assert (sample('render_cache_entries'), sample('render_cache_bytes')) == (1, 4)
+    renders.get('key')
+    renders.get('other_key')
+    assert sample('render_cache_hit_ratio') == 0.5
+    renders.discard_ncco('ncco')
+    assert (sample('render_cache_entries'), sample('render_cache_bytes')) == (0, 0)
@@ -1,8 +1,10 @@
+import json
+
 import pytest
 from aiohttp import web
 
 from nccostorage import api, setup_middlewares
-from nccostorage.bucket import BucketOperations, DictionaryBucketStorage
+from nccostorage.bucket import BucketOperations, DictionaryBucketStorage, Quotas
 from nccostorage.renderer import Jinja2NccoRenderer
 
 
@@ -67,6 +69,11 @@ async def test_render_template_missing_attribute(app_client):
     assert resp.status == 400
 
 
+async def test_render_non_existing_bucket(app_client):
+    resp = await app_client.get('/bucket/test_bucket/ncco/some_id/render')
+    assert resp.status == 404
+
+
 ################
 # Lookup Tests #
 ################
@@ -106,7 +113,77 @@ async def test_lookup_existing_ncco(app_client):
 
     body = await resp.json()
     assert body.get('ncco_id') == ncco_id
-    assert body.get('ncco') == ncco
+    assert body.get('ncco') == '[{"action":"{{action_name}}"}]'
+
+
+async def test_numeric_bucket_id(app_client):
+    # only the string form is accepted, the one urls match
+    resp = await app_client.post('/bucket', json={'id': 5})
+    assert resp.status == 400
+    resp = await app_client.post('/bucket', json={'id': '5'})
+    assert resp.status == 201
+
+    resp = await app_client.post('/bucket/5/ncco', json={'ncco': '[]'})
+    assert resp.status == 201
+    ncco_id = (await resp.json())['ncco_id']
+
+    resp = await app_client.get(f'/bucket/5/ncco/{ncco_id}')
+    assert resp.status == 200
+
+
+async def test_lookup_conditional_get(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id, 'ttl': 360})
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json={'ncco': '[{"action": "talk"}]'})
+    ncco_id = (await resp.json())['ncco_id']
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{ncco_id}')
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    assert resp.headers['Cache-Control'] in ('max-age=359', 'max-age=360')
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{ncco_id}', headers={'If-None-Match': f'"other", {etag}'})
+    assert resp.status == 304
+    assert resp.headers['ETag'] == etag
+    assert await resp.read() == b''
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{ncco_id}', headers={'If-None-Match': '"other"'})
+    assert resp.status == 200
+
+
+async def test_render_conditional_get(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json={'ncco': '[{"action": "talk"}]'})
+    static_id = (await resp.json())['ncco_id']
+    resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json={'ncco': '[{"action": "{{action_name}}"}]'})
+    templated_id = (await resp.json())['ncco_id']
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{static_id}/render')
+    assert resp.status == 200
+    etag = resp.headers['ETag']
+    assert 'Cache-Control' in resp.headers
+
+    # differs from the lookup etag, the body isn't the same
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{static_id}')
+    assert resp.headers['ETag'] != etag
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{static_id}/render', headers={'If-None-Match': etag})
+    assert resp.status == 304
+
+    # templated renders depend on the params, they are never cached
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{templated_id}/render', params={'action_name': 'talk'})
+    assert resp.status == 200
+    assert 'ETag' not in resp.headers
+    assert 'Cache-Control' not in resp.headers
+
+    # not even for a wildcard, which must not skip rendering
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{templated_id}/render', headers={'If-None-Match': '*'})
+    assert resp.status == 400
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{static_id}/render', headers={'If-None-Match': '*'})
+    assert resp.status == 304
 
 
 #############
@@ -126,7 +203,24 @@ async def test_add_ncco_response(app_client):
     body = await resp.json()
 
     assert body.get('ncco_id') is not None
-    assert body.get('ncco') == ncco
+    assert body.get('ncco') == '[{"action":"record"}]'
+
+
+async def test_add_ncco_as_json_array(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    req_body = {'ncco': [{'action': 'talk', 'text': 'Hello {{name}}', 'bargeIn': True}]}
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json=req_body)
+    assert resp.status == 201
+
+    body = await resp.json()
+    assert body.get('ncco') == '[{"action":"talk","text":"Hello {{name}}","bargeIn":true}]'
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{body["ncco_id"]}/render', params={'name': 'VAPI'})
+    assert resp.status == 200
+    assert await resp.json() == [{'action': 'talk', 'text': 'Hello VAPI', 'bargeIn': True}]
 
 
 async def test_add_ncco_non_existing_bucket(app_client):
@@ -138,6 +232,20 @@ async def test_add_ncco_non_existing_bucket(app_client):
 
     assert resp.status == 404
 
+    # the bucket is looked up before the body
+    resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json={'ncco': '[{"action": "talk"'})
+
+    assert resp.status == 404
+
+
+async def test_add_ncco_invalid_ncco(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    for ncco in ['[{"action": "record"', '[{"action": "{{action_name"}]']:
+        resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json={'ncco': ncco})
+        assert resp.status == 400
+
 
 async def test_add_ncco_invalid_body(app_client):
     bucket_id = 'test_bucket'
@@ -147,6 +255,168 @@ async def test_add_ncco_invalid_body(app_client):
     assert resp.status == 400
 
 
+###################
+# Add Batch Tests #
+###################
+async def test_add_ncco_over_quotas(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+    app_client.server.app['buckets'].storage.quotas = Quotas(max_buckets=1, max_nccos_per_bucket=1, max_ncco_bytes=64)
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/ncco', json={'ncco': [{'action': 'talk', 'text': 'x' * 64}]})
+    assert resp.status == 413
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/nccos', json=['[]', '[]'])
+    assert resp.status == 429
+
+    resp = await app_client.post('/bucket', json={'id': 'other_bucket'})
+    assert resp.status == 429
+
+
+async def test_add_nccos_json_array(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    nccos = ['[{"action": "talk", "text": "{{text}}"}]', [{'action': 'record'}]]
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/nccos', json=nccos)
+    assert resp.status == 201
+
+    ncco_ids = (await resp.json())['ncco_ids']
+    assert len(ncco_ids) == 2
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{ncco_ids[0]}/render', params={'text': 'hi'})
+    assert await resp.json() == [{'action': 'talk', 'text': 'hi'}]
+
+    resp = await app_client.get(f'/bucket/{bucket_id}/ncco/{ncco_ids[1]}')
+    assert (await resp.json())['ncco'] == '[{"action":"record"}]'
+
+
+async def test_add_nccos_ndjson(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    body = b'[{"action": "talk"}]\n\n"[{\\"action\\": \\"record\\"}]"\n'
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/nccos', data=body,
+                                 headers={'Content-Type': 'application/x-ndjson'})
+    assert resp.status == 201
+
+    ncco_ids = (await resp.json())['ncco_ids']
+    nccos = [(await (await app_client.get(f'/bucket/{bucket_id}/ncco/{ncco_id}')).json())['ncco'] for ncco_id in ncco_ids]
+    assert nccos == ['[{"action":"talk"}]', '[{"action":"record"}]']
+
+
+async def test_add_nccos_invalid_ncco_stores_nothing(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    resp = await app_client.post(f'/bucket/{bucket_id}/nccos', json=['[]', '[{"action": "{{action_name"}]'])
+    assert resp.status == 400
+    assert 'index 1' in (await resp.json())['text']
+
+    buckets = app_client.server.app['buckets']
+    bucket_info = await buckets.remove(bucket_id)
+    assert len(bucket_info) == 0
+
+
+async def test_add_nccos_invalid_body(app_client):
+    bucket_id = 'test_bucket'
+    await app_client.post('/bucket', json={'id': bucket_id})
+
+    for body in [{'ncco': '[]'}, []]:
+        resp = await app_client.post(f'/bucket/{bucket_id}/nccos', json=body)
+        assert resp.status == 400
+
+
+async def test_add_nccos_non_existing_bucket(app_client):
+    resp = await app_client.post('/bucket/test_bucket/nccos', json=['[]'])
+
+    assert resp.status == 404
+
+    resp = await app_client.post('/bucket/test_bucket/nccos', json=[])
+
+    assert resp.status == 404
+
+
+##########################
+# Export and Import Tests #
+##########################
+async def test_export_import_bucket(app_client, monkeypatch):
+    # make sure both sides go through several chunks
+    monkeypatch.setattr(api.ncco, 'EXPORT_CHUNK_SIZE', 7)
+    monkeypatch.setattr(api.ncco, 'IMPORT_CHUNK_SIZE', 7)
+
+    await app_client.post('/bucket', json={'id': 'source'})
+    nccos = [f'[{{"action": "talk", "text": "{i} {{{{name}}}}"}}]' for i in range(50)]
+    resp = await app_client.post('/bucket/source/nccos', json=nccos)
+    ncco_ids = (await resp.json())['ncco_ids']
+
+    resp = await app_client.get('/bucket/source/export')
+    assert resp.status == 200
+    assert resp.content_type == 'application/x-ndjson'
+    exported = await resp.read()
+    assert len(exported.splitlines()) == 50
+
+    await app_client.post('/bucket', json={'id': 'target'})
+    resp = await app_client.post('/bucket/target/import', data=exported)
+    assert resp.status == 200
+    assert (await resp.json())['imported'] == 50
+
+    # ids are kept, so the same render urls work against the target
+    resp = await app_client.get(f'/bucket/target/ncco/{ncco_ids[42]}/render', params={'name': 'VAPI'})
+    assert await resp.json() == [{'action': 'talk', 'text': '42 VAPI'}]
+
+
+async def test_import_bare_nccos(app_client):
+    await app_client.post('/bucket', json={'id': 'test_bucket'})
+
+    body = b'[{"action": "talk"}]\n{"ncco": "[{\\"action\\": \\"record\\"}]"}\n'
+    resp = await app_client.post('/bucket/test_bucket/import', data=body)
+    assert (await resp.json())['imported'] == 2
+
+    resp = await app_client.get('/bucket/test_bucket/export')
+    nccos = sorted(json.loads(line)['ncco'] for line in (await resp.read()).splitlines())
+    assert nccos == ['[{"action":"record"}]', '[{"action":"talk"}]']
+
+
+async def test_export_import_large_ncco(app_client, monkeypatch):
+    await app_client.post('/bucket', json={'id': 'source'})
+    # well over the buffer of StreamReader.readline
+    ncco = json.dumps([{'action': 'talk', 'text': 'x' * 500000}])
+    resp = await app_client.post('/bucket/source/ncco', json={'ncco': ncco})
+    assert resp.status == 201
+
+    resp = await app_client.get('/bucket/source/export')
+    exported = await resp.read()
+
+    await app_client.post('/bucket', json={'id': 'target'})
+    resp = await app_client.post('/bucket/target/import', data=exported)
+    assert resp.status == 200
+    assert (await resp.json())['imported'] == 1
+
+    monkeypatch.setattr(api.ncco, 'MAX_IMPORT_LINE_BYTES', 100000)
+    resp = await app_client.post('/bucket/target/import', data=b'[]\n' + exported)
+    assert resp.status == 413
+    assert 'line 2' in await resp.text()
+
+
+async def test_import_invalid_lines(app_client):
+    await app_client.post('/bucket', json={'id': 'test_bucket'})
+
+    for body in [b'[]\nnot json\n', b'{"ncco_id": "nope", "ncco": "[]"}\n', b'{"ncco_id": 123, "ncco": "[]"}\n', b'{"ncco_id": "nope"}\n']:
+        resp = await app_client.post('/bucket/test_bucket/import', data=body)
+        assert resp.status == 400
+
+
+async def test_export_import_non_existing_bucket(app_client):
+    resp = await app_client.get('/bucket/test_bucket/export')
+    assert resp.status == 404
+
+    resp = await app_client.post('/bucket/test_bucket/import', data=b'[]\n')
+    assert resp.status == 404
+
+
 ################
 # Remove Tests #
 ################
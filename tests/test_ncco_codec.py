@@ -0,0 +1,50 @@
+import pytest
+
+from nccostorage.bucket import NccoCodec
+
+NCCO = '[' + ', '.join(['{"action": "talk", "text": "Hello {{name}}"}'] * 100) + ']'
+
+
+def test_encode_below_threshold_is_plain_utf8():
+    codec = NccoCodec(compression='zlib', threshold=1024)
+
+    # after the digest prefix
+    assert codec.encode('[{"text": "olá"}]').endswith('[{"text": "olá"}]'.encode('utf-8'))
+
+
+def test_zlib_round_trip():
+    codec = NccoCodec(compression='zlib', threshold=64)
+
+    data = codec.encode(NCCO)
+
+    assert len(data) < len(NCCO)
+    assert codec.decode(data) == NCCO
+
+
+def test_decode_ignores_compression_settings():
+    data = NccoCodec(compression='zlib', threshold=64).encode(NCCO)
+
+    assert NccoCodec().decode(data) == NCCO
+    assert NccoCodec().decode(NCCO.encode('utf-8')) == NCCO
+
+
+def test_digest_is_stored_and_independent_of_compression():
+    plain = NccoCodec().encode(NCCO)
+    compressed = NccoCodec(compression='zlib', threshold=64).encode(NCCO)
+
+    assert NccoCodec().digest(plain) == NccoCodec().digest(compressed)
+    assert NccoCodec().digest(plain) != NccoCodec().digest(NccoCodec().encode(NCCO + ' '))
+    # values written before the digest get the same one
+    assert NccoCodec().digest(NCCO.encode('utf-8')) == NccoCodec().digest(plain)
+
+
+def test_zstd_round_trip():
+    pytest.importorskip('zstandard')
+    codec = NccoCodec(compression='zstd', threshold=64)
+
+    assert codec.decode(codec.encode(NCCO)) == NCCO
+
+
+def test_unknown_compression():
+    with pytest.raises(ValueError):
+        NccoCodec(compression='lz4')
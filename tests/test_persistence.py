@@ -0,0 +1,130 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from nccostorage.bucket import DictionaryBucketStorage
+from nccostorage.bucket import persistence
+from nccostorage.bucket.persistence import PersistentBucketStorage
+
+
+async def open_storage(directory, **kwargs):
+    storage = PersistentBucketStorage(DictionaryBucketStorage(), str(directory), **kwargs)
+    await storage.open()
+    return storage
+
+
+async def test_replay_log(tmp_path):
+    storage = await open_storage(tmp_path)
+    await storage.create('my_bucket', ttl=360)
+    await storage.create('removed_bucket', ttl=360)
+    kept_id = await storage.add_ncco('my_bucket', b'[{"action": "talk"}]')
+    removed_id = await storage.add_ncco('my_bucket', b'[{"action": "record"}]')
+    await storage.remove_ncco('my_bucket', removed_id)
+    batch_ids = await storage.add_nccos('my_bucket', [b'[1]', b'[2]'])
+    await storage.remove('removed_bucket')
+    await storage.close()
+
+    storage = await open_storage(tmp_path)
+    assert await storage.exists('my_bucket')
+    assert not await storage.exists('removed_bucket')
+    assert await storage.get_ncco('my_bucket', kept_id) == b'[{"action": "talk"}]'
+    assert await storage.get_ncco('my_bucket', removed_id) is None
+    assert [await storage.get_ncco('my_bucket', ncco_id) for ncco_id in batch_ids] == [b'[1]', b'[2]']
+    await storage.close()
+
+
+async def test_replay_snapshot(tmp_path):
+    storage = await open_storage(tmp_path, snapshot_threshold=1)
+    await storage.create('my_bucket', ttl=360)
+    ncco_id = await storage.add_ncco('my_bucket', b'[{"action": "talk"}]')
+    await storage.close()
+
+    # every commit went past the threshold, so the first log was compacted away
+    files = os.listdir(tmp_path)
+    assert 'snapshot' in files and 'log.0' not in files
+
+    storage = await open_storage(tmp_path)
+    assert await storage.get_ncco('my_bucket', ncco_id) == b'[{"action": "talk"}]'
+    await storage.close()
+
+
+async def test_commits_go_on_during_snapshot(tmp_path):
+    storage = await open_storage(tmp_path, snapshot_threshold=1)
+    write_snapshot = storage._write_snapshot
+    unblocked = threading.Event()
+
+    def slow_write_snapshot(*args):
+        unblocked.wait(5)
+        write_snapshot(*args)
+
+    storage._write_snapshot = slow_write_snapshot
+    await storage.create('my_bucket', ttl=360)
+
+    # committed while the snapshot of the create is still being written
+    ncco_id = await asyncio.wait_for(storage.add_ncco('my_bucket', b'[]'), 1)
+    unblocked.set()
+    await storage.close()
+
+    storage = await open_storage(tmp_path)
+    assert await storage.get_ncco('my_bucket', ncco_id) == b'[]'
+    await storage.close()
+
+
+async def test_close_after_failed_commit(tmp_path):
+    storage = await open_storage(tmp_path)
+
+    def failing_write(_data):
+        raise OSError('disk full')
+
+    storage._write = failing_write
+    create = asyncio.ensure_future(storage.create('my_bucket', ttl=360))
+    await asyncio.sleep(0)
+
+    await asyncio.wait_for(storage.close(), 1)
+    with pytest.raises(OSError):
+        await create
+
+
+async def test_replay_v1_snapshot(tmp_path):
+    ncco_id = '8c7b1a0e-1f9e-4f47-9d0e-0c1d2b3a4f5e'
+    with open(tmp_path / 'snapshot', 'wb') as f:
+        f.write(persistence._SNAPSHOT_MAGIC_V1 + persistence._LOG_INDEX.pack(0))
+        f.write(persistence._encode(persistence._OP_CREATE, 'my_bucket',
+                                    persistence._EXPIRES_AT.pack(time.time() + 360)))
+        f.write(persistence._encode(persistence._OP_NCCO, ncco_id, b'[]'))
+
+    storage = await open_storage(tmp_path)
+    assert await storage.get_ncco('my_bucket', ncco_id) == b'[]'
+    await storage.close()
+
+
+async def test_replay_ignores_torn_record(tmp_path):
+    storage = await open_storage(tmp_path)
+    await storage.create('my_bucket', ttl=360)
+    await storage.close()
+
+    with open(tmp_path / 'log.0', 'ab') as f:
+        f.write(b'\x03\x09\x00')
+
+    storage = await open_storage(tmp_path)
+    assert await storage.exists('my_bucket')
+    await storage.close()
+
+
+async def test_evicted_bucket_stays_evicted(tmp_path):
+    storage = PersistentBucketStorage(DictionaryBucketStorage(memory_budget=3), str(tmp_path))
+    await storage.open()
+    await storage.create('evicted_bucket', ttl=30)
+    await storage.add_ncco('evicted_bucket', b'[1]')
+    await storage.create('my_bucket', ttl=360)
+    await storage.add_ncco('my_bucket', b'[2]')
+    assert not await storage.exists('evicted_bucket')
+    await storage.close()
+
+    storage = await open_storage(tmp_path)
+    assert await storage.exists('my_bucket')
+    assert not await storage.exists('evicted_bucket')
+    await storage.close()
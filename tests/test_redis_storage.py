@@ -0,0 +1,150 @@
+import pytest
+
+from nccostorage.bucket import BucketNotFoundError, DuplicateBucketError
+from nccostorage.bucket.core import DEFAULT_TTL
+
+fakeredis = pytest.importorskip('fakeredis')
+redis_storage = pytest.importorskip('nccostorage.bucket.redis_storage')
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def client(loop):
+    return fakeredis.FakeAsyncRedis()
+
+
+@pytest.fixture
+def storage(client):
+    return redis_storage.RedisBucketStorage(client)
+
+
+async def test_create_bucket(storage, client):
+    await storage.create('my_bucket', ttl=360)
+
+    assert await storage.exists('my_bucket')
+    assert 0 < await client.ttl('nccostorage:bucket:my_bucket') <= 360
+
+    with pytest.raises(DuplicateBucketError):
+        await storage.create('my_bucket', ttl=60)
+
+    # a duplicate create must not reset the ttl
+    assert await client.ttl('nccostorage:bucket:my_bucket') > 60
+
+
+async def test_ncco_operations(storage):
+    await storage.create('my_bucket')
+
+    ncco = b'[{"action": "talk", "text": "Hello VAPI!"}]'
+    ncco_id = await storage.add_ncco('my_bucket', ncco)
+
+    assert await storage.get_ncco('my_bucket', ncco_id) == ncco
+    assert await storage.get_ncco('my_bucket', 'ttl') is None
+
+    data, ttl = await storage.get_ncco_with_ttl('my_bucket', ncco_id)
+    assert data == ncco and 0 < ttl <= DEFAULT_TTL
+
+    assert await storage.remove_ncco('my_bucket', ncco_id) == ncco
+    assert await storage.get_ncco('my_bucket', ncco_id) is None
+
+    # removing the last ncco keeps the bucket around
+    assert await storage.exists('my_bucket')
+
+
+async def test_add_nccos(storage):
+    await storage.create('my_bucket')
+
+    ncco_ids = await storage.add_nccos('my_bucket', [b'[1]', b'[2]'])
+
+    assert [await storage.get_ncco('my_bucket', ncco_id) for ncco_id in ncco_ids] == [b'[1]', b'[2]']
+    assert await storage.add_nccos('my_bucket', []) == []
+
+
+async def test_scan_and_put_nccos(storage):
+    await storage.create('my_bucket')
+    ncco_ids = await storage.add_nccos('my_bucket', [b'[1]', b'[2]', b'[3]'])
+
+    cursor, scanned = 0, {}
+    while True:
+        cursor, page = await storage.scan_nccos('my_bucket', cursor, count=1)
+        scanned.update(page)
+        if cursor == 0:
+            break
+    assert scanned == dict(zip(ncco_ids, [b'[1]', b'[2]', b'[3]']))
+
+    assert await storage.put_nccos('my_bucket', {ncco_ids[0]: b'[0]', 'other_id': b'[4]'}) == 1
+    assert await storage.get_ncco('my_bucket', ncco_ids[0]) == b'[0]'
+
+    with pytest.raises(BucketNotFoundError):
+        await storage.scan_nccos('other_bucket')
+
+
+async def test_ncco_operations_non_existing_bucket(storage):
+    with pytest.raises(BucketNotFoundError):
+        await storage.add_ncco('my_bucket', '[]')
+
+    with pytest.raises(BucketNotFoundError):
+        await storage.add_nccos('my_bucket', ['[]'])
+
+    with pytest.raises(BucketNotFoundError):
+        await storage.get_ncco('my_bucket', 'some_id')
+
+    with pytest.raises(BucketNotFoundError):
+        await storage.get_ncco_with_ttl('my_bucket', 'some_id')
+
+    with pytest.raises(BucketNotFoundError):
+        await storage.remove_ncco('my_bucket', 'some_id')
+
+
+async def test_remove_bucket(storage):
+    assert await storage.remove('my_bucket') is None
+
+    await storage.create('my_bucket')
+    ncco_id = await storage.add_ncco('my_bucket', b'[]')
+
+    assert await storage.remove('my_bucket') == {ncco_id: b'[]'}
+    assert not await storage.exists('my_bucket')
+
+
+async def test_bucket_stats_and_listing(storage):
+    await storage.create('b_bucket', ttl=60)
+    await storage.create('a_bucket', ttl=120)
+
+    ncco_id = await storage.add_ncco('a_bucket', b'[1]')
+    await storage.add_nccos('a_bucket', [b'[22]', b'[333]'])
+    await storage.remove_ncco('a_bucket', ncco_id)
+
+    stats = await storage.bucket_stats('a_bucket')
+    assert (stats.name, stats.nccos, stats.size_bytes, stats.ttl) == ('a_bucket', 2, 9, 120)
+    assert await storage.bucket_stats('c_bucket') is None
+
+    cursor, page = await storage.list_buckets(count=1)
+    assert [stats.name for stats in page] == ['a_bucket']
+    cursor, page = await storage.list_buckets(cursor, count=1)
+    assert [stats.name for stats in page] == ['b_bucket']
+
+    await storage.remove('a_bucket')
+    assert [stats.name for stats in (await storage.list_buckets())[1]] == ['b_bucket']
+
+
+async def test_create_sweeps_expired_buckets(client):
+    clock = FakeClock()
+    storage = redis_storage.RedisBucketStorage(client, sweep_count=3, clock=clock)
+    for name in ('a_bucket', 'b_bucket', 'c_bucket'):
+        await storage.create(name, ttl=60)
+    # as if the server had expired them
+    await client.delete('nccostorage:bucket:a_bucket', 'nccostorage:bucket:c_bucket')
+
+    clock.now = 61
+    await storage.create('d_bucket', ttl=60)
+
+    # b_bucket is still there, so it's kept
+    assert await client.zrange('nccostorage:buckets', 0, -1) == [b'b_bucket', b'd_bucket']
+    assert await client.zcard('nccostorage:bucket_expiries') == 2
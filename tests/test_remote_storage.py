@@ -0,0 +1,46 @@
+import pytest
+
+from nccostorage.bucket import BucketNotFoundError, DictionaryBucketStorage, DuplicateBucketError
+from nccostorage.bucket.remote import RemoteBucketStorage, serve_storage
+
+
+@pytest.fixture
+async def remote_storage(loop, tmp_path):
+    path = str(tmp_path / 'storage.sock')
+    server = await serve_storage(DictionaryBucketStorage(), path)
+    storage = RemoteBucketStorage(path, pool_size=2)
+
+    yield storage
+
+    await storage.close()
+    server.close()
+    await server.wait_closed()
+
+
+async def test_remote_ncco_operations(remote_storage):
+    await remote_storage.create('my_bucket', 360)
+    assert await remote_storage.exists('my_bucket')
+
+    ncco_id = await remote_storage.add_ncco('my_bucket', '[]')
+    assert await remote_storage.get_ncco('my_bucket', ncco_id) == '[]'
+    assert (await remote_storage.get_ncco_with_ttl('my_bucket', ncco_id))[0] == '[]'
+    assert await remote_storage.remove_ncco('my_bucket', ncco_id) == '[]'
+
+    _, page = await remote_storage.list_buckets()
+    assert [(stats.name, stats.nccos) for stats in page] == [('my_bucket', 0)]
+
+    assert await remote_storage.remove('my_bucket') == {}
+    assert not await remote_storage.exists('my_bucket')
+
+
+async def test_remote_errors(remote_storage):
+    await remote_storage.create('my_bucket', 360)
+
+    with pytest.raises(DuplicateBucketError):
+        await remote_storage.create('my_bucket', 360)
+
+    with pytest.raises(BucketNotFoundError):
+        await remote_storage.get_ncco('other_bucket', 'some_id')
+
+    # the connection is still usable after an error
+    assert await remote_storage.exists('my_bucket')
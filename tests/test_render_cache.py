@@ -0,0 +1,79 @@
+from nccostorage.renderer import CachingNccoRenderer, Jinja2NccoRenderer, RenderCache
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingRenderer(Jinja2NccoRenderer):
+
+    def __init__(self):
+        super().__init__()
+        self.renders = 0
+
+    async def render(self, ncco, render_params):
+        self.renders += 1
+        return await super().render(ncco, render_params)
+
+
+NCCO = '[{"action": "talk", "text": "{{text}}"}]'
+
+
+def test_render_cache_byte_limit():
+    cache = RenderCache(max_bytes=10)
+
+    assert cache.put('a', 'ncco_a', b'12345') == 0
+    assert cache.put('b', 'ncco_b', b'12345') == 0
+    assert cache.get('a') == b'12345'
+
+    # 'b' is the least recently used
+    assert cache.put('c', 'ncco_c', b'123') == 1
+    assert cache.get('b') is None
+    assert cache.size_bytes == 8
+
+    # never cached, it would evict everything else
+    assert cache.put('d', 'ncco_d', b'12345678901') == 0
+    assert cache.get('d') is None
+
+
+def test_render_cache_ttl():
+    clock = FakeClock()
+    cache = RenderCache(ttl=60, clock=clock)
+
+    cache.put('a', 'ncco_a', b'[]')
+    clock.now = 60
+
+    assert cache.get('a') is None
+    assert len(cache) == 0
+    assert cache.size_bytes == 0
+
+
+async def test_caching_renderer_normalizes_params():
+    renderer = CountingRenderer()
+    caching_renderer = CachingNccoRenderer(renderer, RenderCache())
+
+    first = await caching_renderer.render(NCCO, {'text': 'hello', 'conversation_uuid': 'CON-1'})
+    second = await caching_renderer.render(NCCO, {'conversation_uuid': 'CON-2', 'text': 'hello'})
+    assert first == second == b'[{"action": "talk", "text": "hello"}]'
+    assert renderer.renders == 1
+
+    await caching_renderer.render(NCCO, {'text': 'bye'})
+    assert renderer.renders == 2
+
+
+async def test_caching_renderer_invalidate():
+    renderer = CountingRenderer()
+    cache = RenderCache()
+    caching_renderer = CachingNccoRenderer(renderer, cache)
+
+    await caching_renderer.render(NCCO, {'text': 'hello'})
+    caching_renderer.invalidate([NCCO])
+    assert len(cache) == 0
+
+    await caching_renderer.render(NCCO, {'text': 'hello'})
+    assert renderer.renders == 2
@@ -0,0 +1,223 @@
+import concurrent.futures
+import time
+
+import pytest
+
+from nccostorage.renderer import (CompiledNcco, InvalidNccoError, Jinja2NccoRenderer, PooledNccoRenderer, RenderBudgetError,
+                                  RenderError, RenderTimeoutError, SandboxedNccoRenderer, TemplateCache)
+
+
+def test_template_cache_evicts_least_recently_used():
+    cache = TemplateCache(max_size=2)
+
+    assert cache.put('a', 'template_a') == 0
+    assert cache.put('b', 'template_b') == 0
+
+    # touch 'a' so 'b' becomes the eviction candidate
+    assert cache.get('a') == 'template_a'
+    assert cache.put('c', 'template_c') == 1
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 'template_a'
+    assert cache.get('c') == 'template_c'
+
+
+async def test_render_reuses_compiled_template():
+    cache = TemplateCache()
+    renderer = Jinja2NccoRenderer(template_cache=cache)
+    ncco = '[{"action": "{{action_name}}"}]'
+
+    assert await renderer.render(ncco, {'action_name': 'talk'}) == b'[{"action": "talk"}]'
+    template = cache.get(ncco)
+    assert template is not None
+
+    assert await renderer.render(ncco, {'action_name': 'record'}) == b'[{"action": "record"}]'
+    assert cache.get(ncco) is template
+
+
+async def test_render_invalidate():
+    cache = TemplateCache()
+    renderer = Jinja2NccoRenderer(template_cache=cache)
+    ncco = '[{"action": "{{action_name}}"}]'
+
+    await renderer.render(ncco, {'action_name': 'talk'})
+    renderer.invalidate([ncco])
+
+    assert len(cache) == 0
+
+
+async def test_render_rejects_invalid_json_output():
+    renderer = Jinja2NccoRenderer()
+
+    with pytest.raises(InvalidNccoError):
+        await renderer.render('[{"action": "talk", "text": "{{text}}"}]', {'text': 'say "hi"'})
+
+
+async def test_render_missing_params():
+    renderer = Jinja2NccoRenderer()
+
+    with pytest.raises(RenderError):
+        await renderer.render('[{"action": "{{action_name}}"}]', {})
+
+
+async def test_render_optional_params():
+    renderer = Jinja2NccoRenderer()
+
+    assert await renderer.render('[{"text": "{{ name | default(\'x\') }}"}]', {}) == b'[{"text": "x"}]'
+    assert await renderer.render('[{"text": "{{ name | d(\'x\') }}"}]', {'name': 'y'}) == b'[{"text": "y"}]'
+
+    ncco = '[{% if name is defined %}{"text": "{{ name }}"}{% endif %}]'
+    assert await renderer.render(ncco, {}) == b'[]'
+    assert await renderer.render(ncco, {'name': 'y'}) == b'[{"text": "y"}]'
+
+    # guarded in one place only, still needed in the other
+    with pytest.raises(RenderError):
+        await renderer.render('[{% if name is defined %}{% endif %}{"text": "{{ name }}"}]', {})
+
+
+async def test_prepare_static_ncco_skips_jinja2():
+    renderer = Jinja2NccoRenderer()
+
+    compiled = renderer.prepare('[{"action":"talk","text":"hello"}]')
+
+    assert compiled.is_static
+    assert compiled.body == b'[{"action":"talk","text":"hello"}]'
+    assert await renderer.render('[{"action":"talk","text":"hello"}]', {}) is compiled.body
+
+
+def test_prepare_records_template_variables():
+    renderer = Jinja2NccoRenderer()
+
+    compiled = renderer.prepare('[{"action": "{{action_name}}", "text": "{{text}}"}]')
+
+    assert not compiled.is_static
+    assert compiled.variables == {'action_name', 'text'}
+    assert compiled.required_variables == {'action_name', 'text'}
+
+    compiled = renderer.prepare('[{"action": "{{action_name}}", "text": "{{text|default(\'hi\')}}"}]')
+
+    assert compiled.variables == {'action_name', 'text'}
+    assert compiled.required_variables == {'action_name'}
+
+    compiled = renderer.prepare('[{% if lang == "es" %}{"text": "{{es_text}}"}{% else %}{"text": "{{en_text}}"}{% endif %}]')
+
+    assert compiled.variables == {'lang', 'es_text', 'en_text'}
+    assert compiled.required_variables == {'lang'}
+
+
+async def test_render_conditional_variables():
+    renderer = Jinja2NccoRenderer()
+    ncco = '[{% if lang == "es" %}{"text": "{{es_text}}"}{% else %}{"text": "{{en_text}}"}{% endif %}]'
+
+    assert await renderer.render(ncco, {'lang': 'en', 'en_text': 'hi'}) == b'[{"text": "hi"}]'
+
+    with pytest.raises(RenderError):
+        await renderer.render(ncco, {'lang': 'es', 'en_text': 'hi'})
+
+
+def test_prepare_invalid_ncco():
+    renderer = Jinja2NccoRenderer()
+
+    with pytest.raises(InvalidNccoError):
+        renderer.prepare('[{"action": "talk"')
+
+    with pytest.raises(InvalidNccoError):
+        renderer.prepare('[{"action": "{{action_name"}]')
+
+
+LOOP_NCCO = '[{% for i in range(count|int) %}{"action": "talk", "text": "{{i}}"}{% if not loop.last %},{% endif %}{% endfor %}]'
+
+
+async def test_pooled_render_on_threads():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        renderer = PooledNccoRenderer(Jinja2NccoRenderer(), executor)
+
+        body = await renderer.render(LOOP_NCCO, {'count': '2'})
+
+    assert body == b'[{"action": "talk", "text": "0"},{"action": "talk", "text": "1"}]'
+
+
+async def test_pooled_render_on_processes():
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        renderer = PooledNccoRenderer(Jinja2NccoRenderer(), executor, isolated=True)
+
+        body = await renderer.render(LOOP_NCCO, {'count': '1'})
+
+    assert body == b'[{"action": "talk", "text": "0"}]'
+
+
+class SlowRenderer(object):
+
+    def prepare(self, ncco):
+        return CompiledNcco(template=ncco, complexity=1000)
+
+    def render_compiled(self, compiled, render_params):
+        time.sleep(0.2)
+        return b'[]'
+
+
+async def test_pooled_render_timeout():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        renderer = PooledNccoRenderer(SlowRenderer(), executor, timeout=0.01)
+
+        with pytest.raises(RenderTimeoutError):
+            await renderer.render('[]', {})
+
+
+async def test_sandboxed_render():
+    renderer = SandboxedNccoRenderer()
+
+    body = await renderer.render(LOOP_NCCO, {'count': '2'})
+
+    assert body == b'[{"action": "talk", "text": "0"},{"action": "talk", "text": "1"}]'
+
+
+async def test_sandboxed_render_budgets():
+    renderer = SandboxedNccoRenderer(max_iterations=100, max_output_bytes=1000)
+
+    over_budget = [
+        # single huge loop
+        '[{% for i in range(10**9) %}{% endfor %}]',
+        # nested loops, each within budget
+        '[{% for i in range(50) %}{% for j in range(50) %}{% endfor %}{% endfor %}]',
+        # loops over anything else, with nothing to output
+        '[{% set s = "x" * 50 %}{% for i in s %}{% for j in s %}{% endfor %}{% endfor %}]',
+        '[{% for i in range(10) %}{% for c in "x" * 500 %}{% endfor %}{% endfor %}]',
+        '[{% for i in ["x" * 50] * 50 recursive %}{% if i|length > 1 %}{{ loop(i) }}{% endif %}{% endfor %}]',
+        # output
+        '[{"action": "talk", "text": "{{ "a" * 100000 }}"}]',
+        '[{% for i in range(count|int) %}{"action": "talk", "text": "{{i}}"},{% endfor %}]',
+        # operations that grow a string before any output is checked
+        '[{"text": "{{ ("a" * 100)|replace("a", "a" * 100) }}"}]',
+        '[{"text": "{{ ("a\\n" * 100)|indent(100) }}"}]',
+        '[{"text": "{{ "x"|center(10**8) }}"}]',
+        '[{"text": "{{ "%*s" % (10**8, "x") }}"}]',
+        '[{"text": "{{ "%100000000s" % "x" }}"}]',
+        '[{"text": "{{ "%s"|format("x" * 2000) }}"}]',
+        '[{"text": "{{ "{:{}}".format("x", 10**8) }}"}]',
+        '[{"text": "{{ "{:>100000000}".format("x") }}"}]',
+        '[{"text": "{{ "x".rjust(10**8) }}"}]',
+        '[{"text": "{{ ("a" * 100).replace("a", "a" * 100) }}"}]',
+        '[{"text": "{{ ("a" * 600) ~ ("a" * 600) }}"}]',
+        '[{"text": "{{ ("a" * 600) + ("a" * 600) }}"}]',
+        '[{"text": "{{ ["a" * 600, "a" * 600]|join }}"}]',
+        '[{"text": "{{ ",".join(["a" * 600] * 2) }}"}]',
+        '[{"text": "{{ 10**100000 }}"}]',
+    ]
+    for ncco in over_budget:
+        with pytest.raises(RenderBudgetError):
+            await renderer.render(ncco, {'count': '99'})
+
+
+async def test_sandboxed_render_time_budget():
+    renderer = SandboxedNccoRenderer(max_render_time=0)
+
+    with pytest.raises(RenderBudgetError):
+        await renderer.render(LOOP_NCCO, {'count': '2'})
+
+
+async def test_sandboxed_render_unsafe_operation():
+    renderer = SandboxedNccoRenderer()
+
+    with pytest.raises(InvalidNccoError):
+        await renderer.render('[{"action": "{{ action.__class__.__mro__ }}"}]', {'action': 'talk'})